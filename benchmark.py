@@ -0,0 +1,308 @@
+#!/usr/bin/env python
+'''
+Benchmark of process_choices.py on the designs in the test directories
+Author: Mike Lake
+Copyright 2013 Mike Lake
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+Usage: ./benchmark.py [options] [test_directory ...]
+
+Each test directory e.g. test/check_main_1 is copied to a temp directory and
+process_choices.py is run on it repeats times, each time as a new process so
+that the peak memory is for that run only. The stage timings are read from
+out_timings.dat and the outputs are checked against the out_*.orig files.
+If no test directories are given then all of test/c*_*_* are used.
+
+Options:
+    -n repeats        the number of runs of each test, default 3
+    -o name           write the report to name.json and name.csv, the default
+                      name is reports/benchmark_<date>_<commit>
+    --compare file    a json report from an earlier run to compare with
+    --numeric engine  passed to process_choices.py: exact, float or sympy
+    --no-lmat         passed to process_choices.py
+
+The json report has the commit, the versions and for each test the timings of
+every run and the median of them. The csv report has a row for each stage of
+each test with the median and minimum wall time, the median cpu time and the
+peak memory so reports from different commits can be put side by side.
+
+Versions:
+2026.10.18: First version.
+2026.10.18: The reports are written to the reports directory by default.
+'''
+
+import os, sys, glob, json, shutil, time
+import platform
+import subprocess
+from tempfile import mkdtemp
+from datetime import datetime
+
+TESTDIR = 'test'  # where the test directories are
+REPEATS = 3       # the default number of runs of each test
+REPORTS = 'reports'  # where the reports are written if there is no -o
+
+
+def usage():
+    print __doc__[__doc__.index('Usage:'):__doc__.index('The json report')]
+
+
+def median(values):
+    values = sorted(values)
+    n = len(values)
+    if n == 0:
+        return None
+    if n % 2:
+        return values[n//2]
+    return (values[n//2 - 1] + values[n//2]) / 2.0
+
+
+def git_commit():
+    ''' Returns the commit of the working tree, with a + if it has changes, or None. '''
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.STDOUT).strip()
+        changes = subprocess.check_output(['git', 'status', '--porcelain', '--untracked-files=no']).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    if changes:
+        commit = commit + '+'
+    return commit
+
+
+def versions():
+    ''' Returns a dict of the versions of python and the modules the calculation uses. '''
+    code = 'import numpy, sympy; print numpy.__version__, sympy.__version__'
+    try:
+        (numpy_version, sympy_version) = subprocess.check_output([sys.executable, '-c', code]).split()
+    except (OSError, ValueError, subprocess.CalledProcessError):
+        (numpy_version, sympy_version) = (None, None)
+    return {'python': platform.python_version(), 'numpy': numpy_version,
+            'sympy': sympy_version, 'machine': platform.node()}
+
+
+def read_timings(filename):
+    '''
+    Reads out_timings.dat and returns a list of tuples (stage, wall, cpu,
+    peak_rss) in the order of the stages.
+    '''
+    stages = []
+    fh = open(filename, 'r')
+    lines = fh.read().splitlines()
+    fh.close()
+    for line in lines[1:]:
+        (stage, wall, cpu, rss) = line.split('\t')
+        if rss:
+            rss = float(rss)
+        else:
+            rss = None
+        stages.append((stage, float(wall), float(cpu), rss))
+    return stages
+
+
+def run_one(test_dir, options):
+    '''
+    Runs process_choices.py once on a copy of test_dir. Returns a dict of the
+    wall time of the whole process, whether the outputs match the originals,
+    the stage timings and the files that differ.
+    '''
+    (operation, effects) = os.path.basename(test_dir).split('_')[:2]
+    tempdir = mkdtemp(prefix='choice.benchmark.')
+    try:
+        workdir = os.path.join(tempdir, os.path.basename(test_dir))
+        shutil.copytree(test_dir, workdir)
+        for filename in glob.glob(os.path.join(workdir, 'out_*.dat')):
+            os.remove(filename)
+
+        start = time.time()
+        subprocess.check_output([sys.executable, './process_choices.py', workdir, operation, effects] + options,
+                                stderr=subprocess.STDOUT)
+        wall = time.time() - start
+
+        differ = []
+        for orig in sorted(glob.glob(os.path.join(workdir, 'out_*.orig'))):
+            new = orig[:-len('.orig')] + '.dat'
+            if not os.path.exists(new) or open(orig).read() != open(new).read():
+                differ.append(os.path.basename(new))
+
+        timings = os.path.join(workdir, 'out_timings.dat')
+        if os.path.exists(timings):
+            stages = read_timings(timings)
+        else:
+            stages = []
+    finally:
+        shutil.rmtree(tempdir)
+
+    return {'wall': wall, 'ok': not differ, 'differ': differ, 'stages': stages}
+
+
+def run_test(test_dir, repeats, options):
+    '''
+    Runs one test repeats times and returns a dict of the runs and a summary
+    of each stage: the median and minimum wall time, the median cpu time and
+    the largest peak memory over the runs.
+    '''
+    runs = [run_one(test_dir, options) for i in range(repeats)]
+
+    names = []
+    for run in runs:
+        for (stage, wall, cpu, rss) in run['stages']:
+            if stage not in names:
+                names.append(stage)
+    stages = []
+    for name in names:
+        rows = [row for run in runs for row in run['stages'] if row[0] == name]
+        rss = [row[3] for row in rows if row[3] is not None]
+        stages.append({'stage': name,
+                       'wall_median': median([row[1] for row in rows]),
+                       'wall_min': min([row[1] for row in rows]),
+                       'cpu_median': median([row[2] for row in rows]),
+                       'peak_rss_mb': max(rss) if rss else None})
+
+    return {'name': os.path.basename(test_dir),
+            'ok': all([run['ok'] for run in runs]),
+            'wall_median': median([run['wall'] for run in runs]),
+            'wall_min': min([run['wall'] for run in runs]),
+            'stages': stages,
+            'runs': runs}
+
+
+def write_csv(report, filename):
+    ''' Writes a row for each stage of each test and one for the whole process. '''
+    fh = open(filename, 'w')
+    fh.write('commit,test,stage,ok,runs,wall_median,wall_min,cpu_median,peak_rss_mb\n')
+    for test in report['tests']:
+        rows = [(item['stage'], item['wall_median'], item['wall_min'], item['cpu_median'], item['peak_rss_mb'])
+                for item in test['stages']]
+        rows.append(('process', test['wall_median'], test['wall_min'], None, None))
+        for (stage, wall_median, wall_min, cpu_median, rss) in rows:
+            values = [report['commit'] or '', test['name'], stage, str(test['ok']), str(len(test['runs']))]
+            for value in (wall_median, wall_min, cpu_median, rss):
+                if value is None:
+                    values.append('')
+                else:
+                    values.append('%.4f' % value)
+            fh.write(','.join(values) + '\n')
+    fh.close()
+
+
+def compare(old, new):
+    '''
+    Prints the median wall time of each test and of its slowest stages in
+    the old and new reports and the speed up.
+    '''
+    old_tests = dict([(test['name'], test) for test in old['tests']])
+    print ''
+    print 'Compared with %s of %s:' % (old.get('commit'), old.get('date'))
+    print '%-24s %-14s %10s %10s %8s' % ('test', 'stage', 'old (s)', 'new (s)', 'speed up')
+    for test in new['tests']:
+        if test['name'] not in old_tests:
+            continue
+        old_test = old_tests[test['name']]
+        old_stages = dict([(item['stage'], item) for item in old_test['stages']])
+        rows = [('process', old_test['wall_median'], test['wall_median'])]
+        for item in test['stages']:
+            if item['stage'] in old_stages and item['stage'] != 'total':
+                rows.append((item['stage'], old_stages[item['stage']]['wall_median'], item['wall_median']))
+        # Only the whole process and the stages that take a noticeable time.
+        for (stage, old_wall, new_wall) in rows:
+            if stage != 'process' and max(old_wall, new_wall) < 0.05:
+                continue
+            if new_wall > 0:
+                speedup = '%.2fx' % (old_wall / new_wall)
+            else:
+                speedup = ''
+            print '%-24s %-14s %10.3f %10.3f %8s' % (test['name'], stage, old_wall, new_wall, speedup)
+
+
+def main():
+
+    args = sys.argv[1:]
+    repeats = REPEATS
+    name = None
+    old = None
+    options = []
+    dirs = []
+    while args:
+        arg = args.pop(0)
+        try:
+            if arg == '-n':
+                repeats = int(args.pop(0))
+            elif arg == '-o':
+                name = os.path.abspath(args.pop(0))
+            elif arg == '--compare':
+                old = json.load(open(args.pop(0)))
+            elif arg == '--numeric':
+                options.extend([arg, args.pop(0)])
+            elif arg == '--no-lmat':
+                options.append(arg)
+            elif arg.startswith('-'):
+                usage()
+                print 'Error, unknown option %s' % arg
+                sys.exit(1)
+            else:
+                dirs.append(os.path.abspath(arg))
+        except (IndexError, ValueError, IOError) as e:
+            usage()
+            print 'Error, with option %s: %s' % (arg, e)
+            sys.exit(1)
+
+    # process_choices.py is run from the directory of this script.
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+
+    if not dirs:
+        dirs = sorted(glob.glob(os.path.join(TESTDIR, 'c*_*_*')))
+    for test_dir in dirs:
+        if not os.path.isdir(test_dir):
+            usage()
+            print 'Error, %s is not a test directory' % test_dir
+            sys.exit(1)
+
+    commit = git_commit()
+    now = datetime.now()
+    if name is None:
+        if not os.path.isdir(REPORTS):
+            os.makedirs(REPORTS)
+        name = os.path.join(REPORTS, 'benchmark_%s_%s' % (now.strftime('%Y.%m.%d'), (commit or 'unknown').replace('+', 'plus')))
+
+    report = {'commit': commit, 'date': now.strftime('%Y-%m-%d %H:%M:%S'),
+              'repeats': repeats, 'options': options, 'versions': versions(),
+              'tests': []}
+
+    print '%-24s %10s %10s  %s' % ('test', 'median (s)', 'min (s)', 'outputs')
+    for test_dir in dirs:
+        try:
+            test = run_test(test_dir, repeats, options)
+        except subprocess.CalledProcessError as e:
+            print '%-24s failed: %s' % (os.path.basename(test_dir), e.output.strip())
+            continue
+        report['tests'].append(test)
+        if test['ok']:
+            outputs = 'OK'
+        else:
+            outputs = 'differ: ' + ' '.join(test['runs'][0]['differ'])
+        print '%-24s %10.3f %10.3f  %s' % (test['name'], test['wall_median'], test['wall_min'], outputs)
+
+    fh = open(name + '.json', 'w')
+    json.dump(report, fh, indent=1, sort_keys=True)
+    fh.close()
+    write_csv(report, name + '.csv')
+    print ''
+    print 'Report written to %s.json and %s.csv' % (name, name)
+
+    if old:
+        compare(old, report)
+
+
+if __name__ == '__main__':
+    main()
@@ -53,14 +53,38 @@ Versions:
             Release to Nectar.
 2015.06.30: Timeout set for long running calculations.
             Release to Nectar.
+2026.10.18: Calculations run in a pool of long-lived worker processes from
+            choice_pool.py instead of a new process_choices.py each time.
+2026.10.18: Added RUNNER to choose the worker pool, a fork server or a new 
+            process_choices.py for each calculation.
+2026.10.18: The inputs and outputs are passed to the worker without any files 
+            except in TEST mode or with the subprocess runner.
+2026.10.18: Results are cached by choice_cache.py so a design submitted again
+            is not calculated again, and each result has a permalink.
+2026.10.18: Added ASYNC where the calculation runs in a thread and a job page 
+            polls for the result, so a request never waits for a calculation.
+2026.10.18: The job page shows the stage the calculation is up to and has a 
+            button to cancel it.
+2026.10.18: Added the optimise operation, which improves the choice sets to be
+            checked, to the form and as a button on the results of a check.
+2026.10.18: The cache is in ~/.choice_cache, private to the user the app runs
+            as, instead of /tmp/choice.cache.
+2026.10.18: The version is now 2026.10.18. It is part of the cache keys so
+            results cached by earlier versions are calculated again.
+2026.10.18: optimise() converts the cached inputs of a check back to str, as the
+            disk cache returns them as unicode. A result whose msg is an input
+            read error is not cached.
+2026.10.18: A job is queued until a worker is free and only then running, so a
+            job waiting behind long ones is not reported as lost. Each process
+            takes at most MAX_JOBS jobs at once, after that the server is busy.
 
 Don't forget to update version number below!
 '''
 
-version = '2015.06.30'
+version = '2026.10.18'
 
 
-from bottle import route, run, template, request
+from bottle import route, run, template, request, redirect
 from bottle import static_file
 from bottle import debug
 from bottle import FlupFCGIServer
@@ -75,22 +99,50 @@ from tempfile import mkdtemp
 import shutil   # for removing a dir tree
 import datetime
 import re       # only used once in validation
+import threading, time  # for the asynchronous jobs
 
 # Our own modules
 from choice_common import get_expected_io, write_errors
+import choice_pool
+import choice_cache
 
 TIMEOUT = 300 # the maximum time in seconds for a process_choices.py to run 
+RUNNER = 'pool' # how calculations are run: pool, forkserver or subprocess (see choice_pool.py)
+POOL_SIZE = 3 # the number of worker processes for the pool runner
+CACHE_SIZE = 100 # the number of results each process keeps in memory
+CACHE_BYTES = 100*2**20 # the maximum size of the results kept on disk
+ASYNC = True # return a job page that polls for the result instead of waiting for it
+MAX_JOBS = 4*POOL_SIZE # the most jobs each process runs or queues at once in ASYNC mode
+NOT_CACHED = ('taking too long', 'was cancelled', 'Problem reading') # msgs of results not to cache
 
 # Test for test or not. Just touch TEST.
 # and remove the file TEST to go back to production.
 # If TEST is True then the following will change:
 # - the app will run under a local fastcgi server,
 # - the temp dir will be a local one in your current directory,
-# - files in the temp dir will not be deleted at the end of the script.
+# - files in the temp dir will not be deleted at the end of the script,
+# - the cache dir will be a local one in your current directory.
 if os.path.isfile('TEST'):
     TEST = True
+    CACHE_DIR = 'cache'
 else:
     TEST = False
+    CACHE_DIR = os.path.expanduser('~/.choice_cache') # must be private, see choice_cache.py
+
+# The results of earlier calculations, see choice_cache.py.
+# A job that has run for much longer than the timeout is taken to be lost.
+cache = choice_cache.ResultCache(CACHE_SIZE, CACHE_DIR, CACHE_BYTES, TIMEOUT + 60)
+
+# The jobs of this process that are queued or running, see submit_job().
+jobs = threading.BoundedSemaphore(MAX_JOBS)
+BUSY = 'Error: the server is busy with other designs, please submit yours again in a few minutes.'
+
+# Start the worker processes now so they are ready for the first calculation.
+# The subprocess runner runs a new process_choices.py for each calculation.
+if RUNNER == 'pool':
+    runner = choice_pool.WorkerPool(POOL_SIZE, TIMEOUT)
+elif RUNNER == 'forkserver':
+    runner = choice_pool.ForkServer(TIMEOUT)
 
 
 def get_form_data(request):
@@ -226,9 +278,9 @@ def inputs_validation(inputs):
     If all is OK we should return False. 
     '''
 
-    # Check radio buttons of name="corc". They must be either "check" or "construct".
-    if inputs['corc'] != 'check' and inputs['corc'] != 'construct':
-        return 'Problem with radio buttons. Not either check or construct.'
+    # Check radio buttons of name="corc". They must be either "check", "construct" or "optimise".
+    if inputs['corc'] != 'check' and inputs['corc'] != 'construct' and inputs['corc'] != 'optimise':
+        return 'Problem with radio buttons. Not either check, construct or optimise.'
     
     # Check radio buttons of name="effect". They must be either "check" or "construct".
     if inputs['effect'] != 'main' and inputs['effect'] != 'mplusall' and inputs['effect'] != 'mplussome':
@@ -318,6 +370,167 @@ def inputs_validation(inputs):
 
 
 
+def calculate(inputs, operation, effect, report=None, cancelled=None, waiting=None):
+    '''
+    Runs the calculation for the validated inputs. Returns a tuple (errors, 
+    outputs, tt) where errors is a message for the error page or None if the
+    calculation ran, outputs is a dict of the contents of each output and tt
+    is the time taken in seconds as a string. 
+    report, cancelled and waiting are passed to the runner, see choice_pool.py,
+    they are not used by the subprocess runner.
+    '''
+    (inputs_to_write, outputs_to_read) = get_expected_io(operation, effect)
+
+    # The inputs and outputs are passed to the worker without any files, 
+    # except in TEST mode so they can be looked at or when running 
+    # process_choices.py as a subprocess.
+    use_files = TEST or RUNNER == 'subprocess'
+
+    if use_files:
+        # Inputs are OK so now create a temp directory and write the input files.
+        try:
+            if TEST:
+                tempdir = 'temp'    # Use a local temp dir.
+            else:
+                tempdir = mkdtemp(dir='/tmp', prefix='choice.')
+        except:
+            errors = 'Error: unable to create temporary directory.'
+            return (errors, None, None)
+
+        # Writes input files to the tempdir.  
+        write_input_files(inputs, tempdir)
+
+    # We will time how long the processing takes. 
+    start_time = datetime.datetime.now()
+    
+    # Here is where we run the program that calculates the "discrete choices".
+    # With files it reads it's input data and writes it's output data as files from /tmp
+    # subprocess.call(args, *, stdin=None, stdout=None, stderr=None, shell=False, timeout=None)
+    try:
+        if not use_files:
+            outputs = runner.run_texts(inputs, operation, effect, report, cancelled, waiting)
+        elif RUNNER == 'pool' or RUNNER == 'forkserver':
+            runner.run(tempdir, operation, effect, report, cancelled, waiting)
+        else:
+            subprocess.check_output(['./process_choices.py', tempdir, operation, effect], stderr=subprocess.STDOUT, timeout=TIMEOUT)
+    except choice_pool.WorkerError as e:
+        errors = 'Error: %s' % e
+        return (errors, None, None)
+    except subprocess.CalledProcessError as e: 
+        # Just return a simple string rather than a dict like errors['output']. 
+        errors = 'Error: %s (returncode %d)' % (e.output, e.returncode) 
+        return (errors, None, None)
+    except (subprocess.TimeoutExpired, choice_pool.WorkerTimeout) as e:
+        # Command '['./process_choices.py', 'temp', 'construct', 'main']' timed out after 5 seconds
+        errors = 'Error: the calculation was taking too long so it had to be ended. The maximum time allowed is %d seconds.' % TIMEOUT
+        return (errors, None, None)
+    except OSError as e: 
+        errors = 'Error: %s ' % e 
+        return (errors, None, None)
+    
+
+    # Get the finishing time as a timedelta object.
+    dt = datetime.datetime.now() - start_time
+    tt = '%.2f' % dt.total_seconds()  # time taken 
+
+    if use_files:
+        outputs = read_output_files(outputs_to_read, tempdir)
+
+        # Cleanup but only if not in TEST mode. 
+        if not TEST:
+            shutil.rmtree(tempdir)
+    else:
+        # As for read_output_files() an output that was not made is None.
+        outputs = dict([(name, outputs.get(name)) for name in outputs_to_read + ['errors']])
+
+    return (None, outputs, tt)
+
+
+def save_result(key, inputs, operation, effect, outputs, tt):
+    '''
+    Saves the result in the cache under key unless the calculation was ended
+    by its time limit, cancelled or could not read its inputs, which are the
+    msgs in NOT_CACHED. Returns True if it was saved.
+    '''
+    if outputs['msg'] and any([item in outputs['msg'] for item in NOT_CACHED]):
+        return False
+    cache.put(key, {'operation':operation, 'effect':effect, 
+        'inputs':inputs, 'outputs':outputs, 'time':tt})
+    return True
+
+
+def run_job(key, inputs, operation, effect):
+    '''
+    Runs a calculation in a thread of its own for the asynchronous mode. The
+    job page polls job_status() until the result is in the cache. The job is
+    queued until a worker is free, its started time is refreshed while it 
+    waits so it is the time the calculation started when it is running.
+    '''
+    started = [time.time()]
+    def waiting():
+        started[0] = time.time()
+        cache.set_job(key, {'status':'queued', 'started':started[0]})
+    def report(state):
+        cache.set_job(key, {'status':'running', 'started':started[0], 'progress':state})
+    def cancelled():
+        return cache.is_cancelled(key)
+
+    try:
+        try:
+            (errors, outputs, tt) = calculate(inputs, operation, effect, report, cancelled, waiting)
+        except Exception as e:
+            errors = 'Error: %s' % e
+        if not errors and not save_result(key, inputs, operation, effect, outputs, tt):
+            errors = 'Error: %s' % outputs['msg']
+        if errors:
+            cache.set_job(key, {'status':'failed', 'errors':errors})
+        cache.cancel_job(key, False)
+    finally:
+        jobs.release()
+
+
+def submit_job(key, inputs, operation, effect):
+    '''
+    Starts the job for these inputs unless it is already queued or running, 
+    as it will be if the same design was submitted again before it finished.
+    Returns False if this process already has MAX_JOBS jobs so it can't take
+    another one, otherwise True.
+    '''
+    if job_status(key)['status'] in ('queued', 'running'):
+        return True
+    if not jobs.acquire(False):
+        return False
+    cache.cancel_job(key, False)
+    cache.set_job(key, {'status':'queued', 'started':time.time()})
+    job = threading.Thread(target=run_job, args=(key, inputs, operation, effect))
+    job.daemon = True
+    job.start()
+    return True
+
+
+def job_status(key):
+    '''
+    Returns a dict with the status of the job key, one of done, queued, running,
+    failed or unknown, and for a failed job the errors or for a running job its
+    progress, a dict of the stage and the steps done of the total in it.
+    '''
+    if cache.get(key):
+        return {'status':'done'}
+    job = cache.get_job(key)
+    if not job:
+        return {'status':'unknown'}
+    # A job that has run for much longer than the timeout, or has not been 
+    # refreshed while queued, was lost e.g. when its web server process was
+    # restarted. 
+    if job['status'] in ('queued', 'running') and not cache.is_active(job):
+        return {'status':'failed', 'errors':'Error: the calculation was lost, please submit your design again.'}
+    if job['status'] == 'failed':
+        return {'status':'failed', 'errors':job['errors']}
+    if job['status'] == 'queued':
+        return {'status':'queued'}
+    return {'status':'running', 'progress':job.get('progress')}
+
+
 #####################
 # Routes defined here
 #####################
@@ -414,52 +627,101 @@ def process():
         if key not in inputs_to_write:
             del inputs[key]
 
-    # Inputs are OK so now create a temp directory and write the input files.
-    try:
-        if TEST:
-            tempdir = 'temp'    # Use a local temp dir.
-        else:
-            tempdir = mkdtemp(dir='/tmp', prefix='choice.')
-    except:
-        errors = 'Error: unable to create temporary directory.'
+    # If these inputs have been calculated before then show that result. 
+    # The key includes the version so a new release calculates them again.
+    permalink = choice_cache.make_key(operation, effect, inputs, version)
+    result = cache.get(permalink)
+    if result:
+        return template('results_page', inputs=inputs, outputs=result['outputs'], 
+            time=result['time'], test=TEST, permalink=permalink)
+
+    if ASYNC:
+        # Return a job page straight away, it shows the results when they are ready.
+        if not submit_job(permalink, inputs, operation, effect):
+            return template('error_page', errors=BUSY, now=now)
+        redirect('/choice/job/%s' % permalink)
+
+    (errors, outputs, tt) = calculate(inputs, operation, effect)
+    if errors:
         return template('error_page', errors=errors, now=now)
 
-    # Writes input files to the tempdir.  
-    write_input_files(inputs, tempdir)
-
-    # We will time how long the processing takes. 
-    start_time = datetime.datetime.now()
+    if not save_result(permalink, inputs, operation, effect, outputs, tt):
+        permalink = None
     
-    # Here is where we run the program that calculates the "discrete choices".
-    # It reads it's input data and writes it's output data as files from /tmp
-    # subprocess.call(args, *, stdin=None, stdout=None, stderr=None, shell=False, timeout=None)
-    try:
-        subprocess.check_output(['./process_choices.py', tempdir, operation, effect], stderr=subprocess.STDOUT, timeout=TIMEOUT)
-    except subprocess.CalledProcessError as e: 
-        # Just return a simple string rather than a dict like errors['output']. 
-        errors = 'Error: %s (returncode %d)' % (e.output, e.returncode) 
+    # Return results page. 
+    return template('results_page', inputs=inputs, outputs=outputs, time=tt, test=TEST, permalink=permalink)
+
+
+# Improve the choice sets of a check result, the result is shown as for process().
+@route('/choice/optimise/<key>', method='POST')
+@route('/choice/optimise/<key>/', method='POST')
+def optimise(key):
+    now = datetime.datetime.now().strftime('%y.%m.%d   %I:%M:%S %P')
+    result = cache.get(key)
+    if not result or result['operation'] != 'check':
+        errors = 'Error: these choice sets are no longer available, please submit your design again.'
         return template('error_page', errors=errors, now=now)
-    except subprocess.TimeoutExpired as e:
-        # Command '['./process_choices.py', 'temp', 'construct', 'main']' timed out after 5 seconds
-        errors = 'Error: the calculation was taking too long so it had to be ended. The maximum time allowed is %d seconds.' % TIMEOUT
+
+    operation = 'optimise'
+    effect = result['effect']
+    # The inputs are unicode if the result came from the disk cache's json.
+    inputs = dict([(str(name), str(value)) for (name, value) in result['inputs'].items()])
+    permalink = choice_cache.make_key(operation, effect, inputs, version)
+    if cache.get(permalink):
+        redirect('/choice/result/%s' % permalink)
+
+    if ASYNC:
+        if not submit_job(permalink, inputs, operation, effect):
+            return template('error_page', errors=BUSY, now=now)
+        redirect('/choice/job/%s' % permalink)
+
+    (errors, outputs, tt) = calculate(inputs, operation, effect)
+    if errors:
         return template('error_page', errors=errors, now=now)
-    except OSError as e: 
-        errors = 'Error: %s ' % e 
+
+    if not save_result(permalink, inputs, operation, effect, outputs, tt):
+        permalink = None
+    return template('results_page', inputs=inputs, outputs=outputs, time=tt, test=TEST, permalink=permalink)
+
+
+# Serve a result again from its permalink without calculating it.
+@route('/choice/result/<key>')
+@route('/choice/result/<key>/')
+def result(key):
+    now = datetime.datetime.now().strftime('%y.%m.%d   %I:%M:%S %P')
+    result = cache.get(key)
+    if not result:
+        errors = 'Error: this result is no longer available, please submit your design again.'
         return template('error_page', errors=errors, now=now)
-    
+    return template('results_page', inputs=result['inputs'], outputs=result['outputs'], 
+        time=result['time'], test=TEST, permalink=key)
 
-    # Get the finishing time as a timedelta object.
-    dt = datetime.datetime.now() - start_time
-    tt = '%.2f' % dt.total_seconds()  # time taken 
 
-    outputs = read_output_files(outputs_to_read, tempdir)
+# Serve the page for a job which polls its status until the result is ready.
+@route('/choice/job/<key>')
+@route('/choice/job/<key>/')
+def job(key):
+    now = datetime.datetime.now().strftime('%y.%m.%d   %I:%M:%S %P')
+    if job_status(key)['status'] == 'unknown':
+        errors = 'Error: there is no such job, please submit your design again.'
+        return template('error_page', errors=errors, now=now)
+    return template('job_page', job=key, now=now)
 
-    # Cleanup but only if not in TEST mode. 
-    if not TEST:
-        shutil.rmtree(tempdir)
-    
-    # Return results page. 
-    return template('results_page', inputs=inputs, outputs=outputs, time=tt, test=TEST)
+
+# Cancel a job, the job page then shows that it was cancelled.
+@route('/choice/cancel/<key>', method='POST')
+@route('/choice/cancel/<key>/', method='POST')
+def cancel(key):
+    if job_status(key)['status'] in ('queued', 'running'):
+        cache.cancel_job(key)
+    return job_status(key)
+
+
+# Return the status of a job as json for the job page.
+@route('/choice/status/<key>')
+@route('/choice/status/<key>/')
+def status(key):
+    return job_status(key)
 
 
 #####################
@@ -0,0 +1,273 @@
+'''
+Module that caches the results of the choice calculations
+Author: Mike Lake
+Copyright 2013 Mike Lake
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+The same designs are often submitted again e.g. the examples on the start page.
+A result is stored under a key that is a hash of the inputs so a design that is
+submitted again can be shown without calculating it again. The key is also used
+in the permalink for the result and as the id of an asynchronous job. 
+There are two tiers:
+memory: the most recently used results in each web server process.
+disk:   a directory of results shared by all the web server processes which
+        keeps them when the processes are restarted. When it gets bigger than
+        its maximum size the least recently used results are removed.
+        It must be owned by the user the web server runs as and private to it,
+        as anyone who can write to it can plant results. 
+
+Versions:
+Add a date here and a description of the changes to this file here. If the change
+results in a new release at Nectar then document that in the main file choice.py.
+2026.10.18: First version.
+2026.10.18: Added set_job() and get_job() for the asynchronous jobs.
+2026.10.18: Added cancel_job() and is_cancelled().
+2026.10.18: The cache directory is made private with private_dir().
+2026.10.18: The .job and .cancel files are removed by evict() as well.
+2026.10.18: set_job() evicts when a job ends without a result, and evict() 
+            keeps the .job files of queued and running jobs.
+'''
+
+import os, re, json, hashlib, errno, time
+import threading
+from collections import OrderedDict
+from tempfile import mkstemp
+
+# A key is a sha1 hex digest. Only these are used as filenames.
+KEY_PATTERN = re.compile('[0-9a-f]{40}$')
+# The files in the cache directory, all are removed by evict().
+EXTENSIONS = ('.json', '.job', '.cancel')
+
+
+def private_dir(path):
+    '''
+    Makes the directory path if it does not exist, with only this user able 
+    to use it. Raises an OSError if it is not a directory owned by this user,
+    e.g. another user made it first, as they could then plant results in it.
+    '''
+    try:
+        os.makedirs(path, 0700)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+    stat = os.lstat(path)
+    if not os.path.isdir(path) or os.path.islink(path) or stat.st_uid != os.getuid():
+        raise OSError('The cache directory %s must be a directory owned by this user.' % path)
+    if stat.st_mode & 0077:
+        os.chmod(path, 0700)
+
+
+def canonical_inputs(inputs):
+    '''
+    Returns a copy of the input texts with the spacing made the same so that
+    inputs that differ only in whitespace have the same key. The order of the
+    choice sets and of the options in a set is kept as the results depend on
+    it e.g. the numbering of duplicate sets.
+    Example: ' 4 3  3\\n\\n' --> '4 3 3'
+    '''
+    canonical = {}
+    for key in inputs.keys():
+        lines = [' '.join(line.split()) for line in inputs[key].splitlines()]
+        canonical[key] = '\n'.join([line for line in lines if line])
+    return canonical
+
+
+def make_key(operation, effect, inputs, salt=''):
+    '''
+    Returns the key for a calculation. salt is added to the key e.g. the
+    version of the program so that a new version does not use old results.
+    '''
+    data = json.dumps([salt, operation, effect, canonical_inputs(inputs)], sort_keys=True)
+    return hashlib.sha1(data).hexdigest()
+
+
+class ResultCache(object):
+    '''
+    A cache of results with memory_size results in memory and up to max_bytes
+    of results in the directory cache_dir. If cache_dir is None then there is
+    only the memory tier. A result is any dict that can be saved as json.
+    A queued or running job that was started more than job_timeout seconds 
+    ago is taken to be lost.
+    '''
+    def __init__(self, memory_size, cache_dir=None, max_bytes=0, job_timeout=3600):
+        super(ResultCache,self).__init__()
+        self.memory_size = memory_size
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.job_timeout = job_timeout
+        self.memory = OrderedDict()
+        self.jobs = {}  # the job status when there is no cache_dir
+        self.cancelled = set()  # the cancelled jobs when there is no cache_dir
+        self.lock = threading.Lock()
+        if cache_dir:
+            private_dir(cache_dir)
+
+    def filename(self, key, extension='.json'):
+        return os.path.join(self.cache_dir, key + extension)
+
+    def get(self, key):
+        ''' Returns the result for key or None if it is not in the cache. '''
+        if not KEY_PATTERN.match(key):
+            return None
+
+        with self.lock:
+            if key in self.memory:
+                # Move it to the most recently used end.
+                result = self.memory.pop(key)
+                self.memory[key] = result
+                return result
+
+        if not self.cache_dir:
+            return None
+        try:
+            fh = open(self.filename(key), 'r')
+            result = json.load(fh)
+            fh.close()
+            # The modification time is used as the last used time.
+            os.utime(self.filename(key), None)
+        except (IOError, OSError, ValueError):
+            # Not there, just removed by another process or only half written.
+            return None
+
+        self.remember(key, result)
+        return result
+
+    def put(self, key, result):
+        ''' Saves the result under key in both tiers. '''
+        self.remember(key, result)
+        if not self.cache_dir:
+            return
+
+        self.write(self.filename(key), result)
+        self.evict()
+
+        # The job that calculated it, if any, is finished.
+        try:
+            os.unlink(self.filename(key, '.job'))
+        except OSError:
+            pass
+
+    def write(self, filename, data):
+        ''' Saves data as json in filename. '''
+        # Write to a temp file and rename it so other processes never see
+        # a half written file.
+        (fd, tempname) = mkstemp(dir=self.cache_dir, prefix='.tmp.')
+        fh = os.fdopen(fd, 'w')
+        json.dump(data, fh)
+        fh.close()
+        os.rename(tempname, filename)
+
+    def set_job(self, key, job):
+        '''
+        Saves job, a dict with the status of the job that is calculating the
+        result for key. The status is on disk so any web server process can 
+        answer a request for it. A job that has ended without a result, e.g.
+        it failed or was cancelled, evicts as put() does for a result.
+        '''
+        if not self.cache_dir:
+            with self.lock:
+                self.jobs[key] = job
+            return
+        self.write(self.filename(key, '.job'), job)
+        if not self.is_active(job):
+            self.evict()
+
+    def get_job(self, key):
+        ''' Returns the job dict saved by set_job() or None. '''
+        if not KEY_PATTERN.match(key):
+            return None
+        if not self.cache_dir:
+            with self.lock:
+                return self.jobs.get(key)
+        try:
+            fh = open(self.filename(key, '.job'), 'r')
+            job = json.load(fh)
+            fh.close()
+        except (IOError, ValueError):
+            return None
+        return job
+
+    def cancel_job(self, key, cancel=True):
+        '''
+        Asks the job for key to cancel its calculation, or if cancel is False 
+        forgets that it was asked to, as for a new job for the same key.
+        '''
+        if not KEY_PATTERN.match(key):
+            return
+        if not self.cache_dir:
+            with self.lock:
+                if cancel:
+                    self.cancelled.add(key)
+                else:
+                    self.cancelled.discard(key)
+            return
+        if cancel:
+            open(self.filename(key, '.cancel'), 'w').close()
+        else:
+            try:
+                os.unlink(self.filename(key, '.cancel'))
+            except OSError:
+                pass
+
+    def is_active(self, job):
+        ''' Returns True if the job dict is of a job that is queued or running and not lost. '''
+        return (job.get('status') in ('queued', 'running') and 
+                time.time() - job.get('started', 0) <= self.job_timeout)
+
+    def is_cancelled(self, key):
+        ''' Returns True if the job for key has been asked to cancel. '''
+        if not self.cache_dir:
+            return key in self.cancelled
+        return os.path.exists(self.filename(key, '.cancel'))
+
+    def remember(self, key, result):
+        ''' Saves the result in memory, forgetting the least recently used. '''
+        with self.lock:
+            self.jobs.pop(key, None)
+            self.memory.pop(key, None)
+            self.memory[key] = result
+            while len(self.memory) > self.memory_size:
+                self.memory.popitem(last=False)
+
+    def evict(self):
+        '''
+        Removes the least recently used files until the disk tier fits in 
+        max_bytes. The .job and .cancel files count too so those of jobs that
+        ended without a result don't pile up, but the .job file of an active
+        job is kept as a stage can run for a long time without rewriting it.
+        '''
+        files = []
+        total = 0
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith(EXTENSIONS):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.cache_dir, name))
+            except OSError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, name))
+            total = total + stat.st_size
+
+        files.sort()
+        for (mtime, size, name) in files:
+            if total <= self.max_bytes:
+                break
+            if name.endswith('.job') and self.is_active(self.get_job(name[:-4]) or {}):
+                continue
+            try:
+                os.unlink(os.path.join(self.cache_dir, name))
+            except OSError:
+                pass  # another process has just removed it
+            total = total - size
@@ -24,6 +24,8 @@ results in a new release at Nectar then document that in the main file choice.py
 2013.10.23: Added a main() so this program can run independently for debugging. 
 2013.10.29: Added sort() to output lists.
 2013.11.08: Added write_errors(). 
+2026.10.18: Added timings to the expected outputs.
+2026.10.18: Added the optimise operation.
 '''
 
 import sys  # Only needed in main()
@@ -50,14 +52,18 @@ def get_expected_io (operation, effects):
 
     # Work out the expected inputs and outputs.
     expected_inputs = ['factors', 'levels', 'msize'] 
-    expected_outputs = ['bmat', 'cinv', 'correln', 'cmat', 'lmat', 'msg'] 
+    expected_outputs = ['bmat', 'cinv', 'correln', 'cmat', 'lmat', 'msg', 'timings'] 
 
-    # Options for operation are 'check' or 'construct'.
+    # Options for operation are 'check', 'construct' or 'optimise'.
     if operation == 'check':
         expected_inputs.append('chsets')
     elif operation == 'construct':
         expected_inputs.extend(['tmts', 'gens'])
         expected_outputs.append('chsets')
+    elif operation == 'optimise':
+        # The choice sets to check are improved and the improved ones are output.
+        expected_inputs.append('chsets')
+        expected_outputs.append('chsets')
     else:
         pass
    
@@ -82,10 +88,10 @@ def get_expected_io (operation, effects):
 def main():
 
     # There must be just two args:
-    # <check | construct> and <main | mplusall | mplussome>
+    # <check | construct | optimise> and <main | mplusall | mplussome>
     if len(sys.argv) != 3: 
         print 'This is normally used as a module and not run as a main program.'
-        print 'python ./choice_common.py <check | construct> and <main | mplusall | mplussome>'
+        print 'python ./choice_common.py <check | construct | optimise> and <main | mplusall | mplussome>'
         sys.exit()
     
     (operation, effects) = (sys.argv[1], sys.argv[2])
@@ -0,0 +1,339 @@
+'''
+Module that runs the choice calculations in a pool of long-lived worker processes
+Author: Mike Lake
+Copyright 2013 Mike Lake
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+Starting a new process_choices.py for every calculation means numpy and sympy
+are imported every time which takes a few seconds. There are two ways here of
+avoiding that:
+WorkerPool: each worker in the pool imports process_choices once and then runs
+    calculations sent to it down a pipe. A worker that takes longer than the 
+    timeout is killed and replaced.
+ForkServer: a server process imports process_choices once and then forks a 
+    new child for each calculation, so each calculation still has a process 
+    of its own. A child that takes longer than the timeout is killed.
+
+Versions:
+Add a date here and a description of the changes to this file here. If the change
+results in a new release at Nectar then document that in the main file choice.py.
+2026.10.18: First version.
+2026.10.18: Added ForkServer.
+2026.10.18: Added run_texts() to pass the inputs and outputs without any files.
+2026.10.18: The workers send the progress of a calculation while it runs and 
+            a calculation can be cancelled.
+2026.10.18: WorkerPool.call() calls waiting() about once a second while all the
+            workers are busy, so a queued calculation is not taken to be lost.
+'''
+
+import os, sys, time, signal, traceback
+import multiprocessing
+from multiprocessing.connection import Listener, Client
+from tempfile import mkdtemp
+import threading
+import Queue
+
+
+class WorkerTimeout(Exception):
+    ''' The calculation took longer than the timeout so its worker was killed. '''
+    pass
+
+
+class WorkerError(Exception):
+    ''' The calculation failed, the message is the traceback from the worker. '''
+    pass
+
+
+# The least time in seconds between the progress messages from a calculation.
+PROGRESS_INTERVAL = 0.5
+
+
+def run_job(conn, process_choices, job):
+    '''
+    Runs a job (name, args) to call process_choices.name(*args) and returns 
+    the reply (ok, output) where output is what the function returned or the
+    traceback if it failed. While it runs the progress is sent on conn as
+    ('progress', state) and a 'cancel' received on conn cancels it. 
+    '''
+    last = [0]
+    def report(progress):
+        now = time.time()
+        if now - last[0] >= PROGRESS_INTERVAL:
+            conn.send(('progress', progress.state()))
+            last[0] = now
+        while conn.poll():
+            if conn.recv() == 'cancel':
+                progress.cancel()
+
+    try:
+        (name, args) = job
+        progress = process_choices.Progress(report=report)
+        return (True, getattr(process_choices, name)(*args, progress=progress))
+    except Exception:
+        return (False, traceback.format_exc())
+
+
+def wait_for_reply(conn, timeout, report=None, cancelled=None):
+    '''
+    Waits for the reply to a job sent on conn, passing each progress message
+    to report(state). If cancelled() returns True then 'cancel' is sent to 
+    the calculation, which then ends with a message saying so. Returns the
+    reply or None if there is none within timeout seconds.
+    '''
+    deadline = time.time() + timeout
+    cancel_sent = False
+    while True:
+        wait = deadline - time.time()
+        if wait <= 0:
+            return None
+        if conn.poll(min(wait, 1)):
+            reply = conn.recv()
+            if reply[0] != 'progress':
+                return reply
+            if report:
+                report(reply[1])
+        if cancelled and not cancel_sent and cancelled():
+            conn.send('cancel')
+            cancel_sent = True
+
+
+def worker_loop(conn):
+    '''
+    This is the main loop of a worker process. Each job received on conn is a
+    tuple (name, args) and is run by run_job(). A job of None ends the loop.
+    '''
+    # Imported here so only the worker processes import numpy and sympy.
+    import process_choices
+
+    while True:
+        try:
+            job = conn.recv()
+        except EOFError:
+            break
+        if job is None:
+            break
+        if job == 'cancel':
+            continue  # it arrived after its calculation had finished
+        conn.send(run_job(conn, process_choices, job))
+
+
+class Worker(object):
+    ''' A worker process and our end of the pipe to it. '''
+    def __init__(self):
+        super(Worker,self).__init__()
+        (self.conn, child_conn) = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=worker_loop, args=(child_conn,))
+        self.process.daemon = True  # end the workers when we end
+        self.process.start()
+        child_conn.close()
+
+    def kill(self):
+        ''' Kills the worker process, with SIGKILL if it ignores SIGTERM. '''
+        self.process.terminate()
+        self.process.join(1)
+        if self.process.is_alive():
+            os.kill(self.process.pid, signal.SIGKILL)
+            self.process.join()
+        self.conn.close()
+
+
+class WorkerPool(object):
+    '''
+    A pool of size worker processes. The workers are started when the pool is
+    created so they have already imported everything by the first calculation.
+    Each call of run() uses a free worker and waits for one if all are busy,
+    so the pool can be shared by the threads of a web server process.
+    '''
+    def __init__(self, size, timeout):
+        super(WorkerPool,self).__init__()
+        self.timeout = timeout
+        self.idle = Queue.Queue()
+        for i in range(size):
+            self.idle.put(Worker())
+
+    def run(self, input_dir, operation, effects, report=None, cancelled=None, waiting=None):
+        '''
+        Runs a calculation which reads its input files and writes its output
+        files in input_dir, like running: process_choices.py input_dir operation effects
+        report, cancelled and waiting are as for call().
+        '''
+        self.call('run_calculation', input_dir, operation, effects, report=report, cancelled=cancelled, waiting=waiting)
+
+    def run_texts(self, texts, operation, effects, report=None, cancelled=None, waiting=None):
+        '''
+        Runs a calculation without any files. texts is a dict of the contents
+        of each input file and a dict of the contents of each output file is
+        returned, see process_choices.run_calculation_texts().
+        report, cancelled and waiting are as for call().
+        '''
+        return self.call('run_calculation_texts', texts, operation, effects, report=report, cancelled=cancelled, waiting=waiting)
+
+    def call(self, name, *args, **kwargs):
+        '''
+        Calls process_choices.name(*args) on a free worker and returns what
+        it returns. Raises WorkerTimeout if it runs for longer than the 
+        timeout, the worker is then killed and replaced. Raises WorkerError
+        if the calculation fails.
+        The keyword args are report, called with the progress state dict of 
+        the calculation while it runs, cancelled, called about once a second
+        and if it returns True the calculation is cancelled, and waiting, 
+        called about once a second while it waits for a free worker. 
+        '''
+        while True:
+            try:
+                worker = self.idle.get(timeout=1)
+                break
+            except Queue.Empty:
+                if kwargs.get('waiting'):
+                    kwargs['waiting']()
+        try:
+            worker.conn.send((name, args))
+            reply = wait_for_reply(worker.conn, self.timeout, kwargs.get('report'), kwargs.get('cancelled'))
+            if reply is None:
+                worker.kill()
+                worker = Worker()
+                raise WorkerTimeout('the calculation took longer than %d seconds' % self.timeout)
+            (ok, output) = reply
+        except (EOFError, IOError) as e:
+            # The worker has died e.g. out of memory so replace it.
+            worker.kill()
+            worker = Worker()
+            raise WorkerError('the worker process ended unexpectedly (%s)' % e)
+        finally:
+            self.idle.put(worker)
+
+        if not ok:
+            raise WorkerError(output)
+        return output
+
+
+def forkserver_loop(address, authkey, ready):
+    '''
+    This is the main loop of the fork server process. It listens on address
+    and forks a child for each connection. The child sends its pid, receives
+    a job (name, args), runs it with run_job() as for worker_loop(), replies
+    and then exits. 
+    '''
+    # Imported here so the children start with numpy and sympy already imported.
+    import process_choices
+
+    # The children are reaped automatically.
+    signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+
+    # A socket may be left behind by an earlier server that was killed.
+    if os.path.exists(address):
+        os.unlink(address)
+    listener = Listener(address, family='AF_UNIX', authkey=authkey)
+    ready.set()
+
+    while True:
+        try:
+            conn = listener.accept()
+        except Exception:
+            # e.g. a connection that failed authentication
+            continue
+
+        if os.fork() == 0:
+            # The child. It must not close the listener as that removes the socket.
+            signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+            status = 0
+            try:
+                conn.send(os.getpid())
+                reply = run_job(conn, process_choices, conn.recv())
+                conn.send(reply)
+                if not reply[0]:
+                    status = 1
+            except Exception:
+                status = 1
+                try:
+                    conn.send((False, traceback.format_exc()))
+                except Exception:
+                    pass
+            sys.stdout.flush()
+            os._exit(status)
+
+        conn.close()
+
+
+class ForkServer(object):
+    '''
+    A fork server which runs each calculation in a new child process forked 
+    from a server that has already imported everything. It has the same run()
+    as a WorkerPool. The server is started when this is created and is 
+    restarted if it has died. 
+    '''
+    def __init__(self, timeout):
+        super(ForkServer,self).__init__()
+        self.timeout = timeout
+        self.address = os.path.join(mkdtemp(prefix='choice_forkserver.'), 'socket')
+        self.authkey = os.urandom(20)
+        self.lock = threading.Lock()
+        self.server = None
+        self.start()
+
+    def start(self):
+        ''' Starts the server and waits until it is listening. '''
+        ready = multiprocessing.Event()
+        self.server = multiprocessing.Process(target=forkserver_loop, args=(self.address, self.authkey, ready))
+        self.server.daemon = True  # end the server when we end
+        self.server.start()
+        ready.wait(self.timeout)
+
+    def connect(self):
+        ''' Returns a connection to a new child, restarting the server if needed. '''
+        with self.lock:
+            if not self.server.is_alive():
+                self.start()
+        return Client(self.address, family='AF_UNIX', authkey=self.authkey)
+
+    def run(self, input_dir, operation, effects, report=None, cancelled=None, waiting=None):
+        ''' As for WorkerPool.run() '''
+        self.call('run_calculation', input_dir, operation, effects, report=report, cancelled=cancelled)
+
+    def run_texts(self, texts, operation, effects, report=None, cancelled=None, waiting=None):
+        ''' As for WorkerPool.run_texts() '''
+        return self.call('run_calculation_texts', texts, operation, effects, report=report, cancelled=cancelled)
+
+    def call(self, name, *args, **kwargs):
+        '''
+        Calls process_choices.name(*args) in a new child and returns what it
+        returns. Raises WorkerTimeout if it runs for longer than the timeout,
+        the child is then killed. Raises WorkerError if the calculation fails.
+        The keyword args are as for WorkerPool.call(), there is no waiting.
+        '''
+        try:
+            conn = self.connect()
+        except (EOFError, IOError, OSError) as e:
+            raise WorkerError('unable to connect to the fork server (%s)' % e)
+        try:
+            pid = conn.recv()
+            conn.send((name, args))
+            reply = wait_for_reply(conn, self.timeout, kwargs.get('report'), kwargs.get('cancelled'))
+            if reply is None:
+                try:
+                    os.kill(pid, signal.SIGKILL)
+                except OSError:
+                    pass  # it has just finished
+                raise WorkerTimeout('the calculation took longer than %d seconds' % self.timeout)
+            (ok, output) = reply
+        except (EOFError, IOError) as e:
+            # The child has died e.g. out of memory.
+            raise WorkerError('the calculation process ended unexpectedly (%s)' % e)
+        finally:
+            conn.close()
+
+        if not ok:
+            raise WorkerError(output)
+        return output
@@ -0,0 +1,244 @@
+#!/usr/bin/env python
+'''
+Generates random designs as input files for process_choices.py
+Author: Mike Lake
+Copyright 2013 Mike Lake
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+Usage: ./generate_design.py output_dir operation effects k levels m p [options]
+
+    operation   check or construct
+    effects     main, mplusall or mplussome
+    k           the number of factors
+    levels      the number of levels of every factor e.g. 3, or of each factor
+                e.g. 4,3,3,3, or mixed for random levels from 2 to 5
+    m           the choice set size
+    p           the number of choice sets
+
+Options:
+    --twofis density  the fraction of the pairs of factors that are two factor
+                      interactions for mplussome, default 0.5
+    --gens g          the number of sets of generators for construct, default
+                      1, the number of tmts is then p/g
+    --seed seed       the seed of the random numbers, default 1
+
+The in_*.dat files are written to output_dir which is created if needed.
+Every choice set has m different treatment combinations so the design can be
+checked, but choice sets may be repeated and the design may not be able to
+estimate all the effects, just like the designs users enter. The generators of
+construct vary every factor so its designs can usually estimate the effects.
+
+Versions:
+2026.10.18: First version.
+2026.10.18: The generators are nonzero in every factor where there are enough
+            such vectors, so every factor varies within each choice set.
+'''
+
+import os, sys, random
+
+
+def make_levels(k, levels, rand):
+    '''
+    Returns a list of the levels of each of the k factors from levels, which is
+    an int for every factor, a list for each factor or 'mixed' for random levels.
+    '''
+    if levels == 'mixed':
+        return [rand.randint(2, 5) for i in range(k)]
+    if isinstance(levels, (list, tuple)):
+        if len(levels) != k:
+            raise ValueError('there are %d levels for %d factors' % (len(levels), k))
+        return [int(item) for item in levels]
+    return [int(levels)] * k
+
+
+def product(values):
+    result = 1
+    for value in values:
+        result = result * value
+    return result
+
+
+def random_tmt(levels, rand):
+    return tuple([rand.randrange(level) for level in levels])
+
+
+def random_choicesets(levels, m, p, rand):
+    ''' Returns p choice sets, each a list of m different tmts. '''
+    if m > product(levels):
+        raise ValueError('m = %d is more than the %d treatment combinations' % (m, product(levels)))
+    choicesets = []
+    for i in range(p):
+        options = []
+        while len(options) < m:
+            tmt = random_tmt(levels, rand)
+            if tmt not in options:
+                options.append(tmt)
+        choicesets.append(options)
+    return choicesets
+
+
+def random_generators(levels, m, g, rand):
+    '''
+    Returns g sets of generators, each a list of m-1 different nonzero
+    vectors, so adding them to a tmt gives a choice set of m different tmts.
+    Each value is from 1 to level-1 so every factor varies within every choice
+    set, as a factor that doesn't vary can't be estimated. If there are not
+    m-1 such vectors, e.g. binary factors and m > 2, the values can be 0 but
+    every factor is nonzero in at least one generator of each set.
+    '''
+    if m > product(levels):
+        raise ValueError('m = %d is more than the %d treatment combinations' % (m, product(levels)))
+    nonzero = product([level - 1 for level in levels]) >= m - 1
+    zero = tuple([0] * len(levels))
+    generators = []
+    for i in range(g):
+        gens = []
+        while len(gens) < m - 1:
+            if nonzero:
+                gen = tuple([rand.randrange(1, level) for level in levels])
+            else:
+                gen = random_tmt(levels, rand)
+            if gen != zero and gen not in gens:
+                gens.append(gen)
+            if len(gens) == m - 1 and not all([any(column) for column in zip(*gens)]):
+                gens = []
+        generators.append(gens)
+    return generators
+
+
+def random_twofis(k, density, rand):
+    ''' Returns a sorted list of pairs of factors (from 1), at least one pair. '''
+    pairs = [(i, j) for i in range(1, k+1) for j in range(i+1, k+1)]
+    count = max(1, int(round(density * len(pairs))))
+    return sorted(rand.sample(pairs, count))
+
+
+def count_effects(levels, effects, twofis):
+    ''' Returns the number of effects (rows of B) for the effects model. '''
+    k = len(levels)
+    count = sum([level - 1 for level in levels])
+    if effects == 'mplusall':
+        twofis = [(i, j) for i in range(1, k+1) for j in range(i+1, k+1)]
+    if effects != 'main':
+        count = count + sum([(levels[i-1] - 1) * (levels[j-1] - 1) for (i, j) in twofis])
+    return count
+
+
+def generate_design(operation, effects, k, levels, m, p, twofis=0.5, gens=1, seed=1, attempt=0):
+    '''
+    Returns a dict of the text of each input file, e.g. design['levels'] is
+    the text of in_levels.dat, and a dict of the size of the design: k, m, p,
+    t the number of different tmts in the choice sets and numEffects.
+    The args are as for the command line, levels is as for make_levels().
+    Each attempt is a different design with the same levels and model, so
+    another attempt can be made if a design can't estimate the effects.
+    '''
+    rand = random.Random(seed)
+    levels = make_levels(k, levels, rand)
+    texts = {'factors': '%d' % k,
+             'levels': ' '.join([str(level) for level in levels]),
+             'msize': '%d' % m}
+
+    # The model is chosen before the choice sets so that it is the same for
+    # every p with the same seed.
+    pairs = []
+    if effects == 'mplusall' or effects == 'mplussome':
+        texts['det'] = ''
+    if effects == 'mplussome':
+        if k < 2:
+            raise ValueError('mplussome needs at least 2 factors')
+        pairs = random_twofis(k, twofis, rand)
+        texts['twofis'] = ' '.join(['%d,%d' % pair for pair in pairs])
+    elif effects != 'main' and effects != 'mplusall':
+        raise ValueError('effects must be main, mplusall or mplussome')
+
+    if attempt:
+        rand.seed(seed * 1000003 + attempt)
+    if operation == 'check':
+        choicesets = random_choicesets(levels, m, p, rand)
+        texts['chsets'] = '\n'.join([' '.join([str(item) for tmt in options for item in tmt]) for options in choicesets])
+    elif operation == 'construct':
+        g = max(1, min(gens, p))
+        generators = random_generators(levels, m, g, rand)
+        tmts = [random_tmt(levels, rand) for i in range((p + g - 1) // g)]
+        texts['tmts'] = '\n'.join([' '.join([str(item) for item in tmt]) for tmt in tmts])
+        texts['gens'] = '\n'.join([' '.join([str(item) for gen in gen_set for item in gen]) for gen_set in generators])
+        # the choice sets as in process_choices.Design.from_generators()
+        choicesets = [[tmt] + [tuple([(a + b) % level for (a, b, level) in zip(tmt, gen, levels)]) for gen in gen_set]
+                      for tmt in tmts for gen_set in generators]
+    else:
+        raise ValueError('operation must be check or construct')
+
+    size = {'k': k, 'levels': levels, 'm': m, 'p': len(choicesets),
+            't': len(set([tmt for options in choicesets for tmt in options])),
+            'numEffects': count_effects(levels, effects, pairs)}
+    return (texts, size)
+
+
+def write_design(output_dir, texts):
+    ''' Writes each text to in_name.dat in output_dir. '''
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+    for name in texts.keys():
+        fh = open(os.path.join(output_dir, 'in_%s.dat' % name), 'w')
+        fh.write(texts[name])
+        fh.close()
+
+
+def usage():
+    print __doc__[__doc__.index('Usage:'):__doc__.index('The in_*.dat')]
+
+
+def main():
+    args = sys.argv[1:]
+    options = {}
+    for option in ('--twofis', '--gens', '--seed'):
+        if option in args:
+            index = args.index(option)
+            try:
+                options[option[2:]] = args[index+1]
+            except IndexError:
+                usage()
+                print 'Error, %s needs a value' % option
+                sys.exit(1)
+            del args[index:index+2]
+
+    if len(args) != 7:
+        usage()
+        print 'Error, number of args must be seven.'
+        sys.exit(1)
+
+    (output_dir, operation, effects, k, levels, m, p) = args
+    try:
+        if levels != 'mixed':
+            levels = [int(item) for item in levels.split(',')]
+            if len(levels) == 1:
+                levels = levels[0]
+        (texts, size) = generate_design(operation, effects, int(k), levels, int(m), int(p),
+                                        twofis=float(options.get('twofis', 0.5)),
+                                        gens=int(options.get('gens', 1)),
+                                        seed=int(options.get('seed', 1)))
+    except ValueError as e:
+        usage()
+        print 'Error, %s' % e
+        sys.exit(1)
+
+    write_design(output_dir, texts)
+    print 'Wrote %s: k=%d levels=%s m=%d p=%d t=%d numEffects=%d' % (output_dir, size['k'],
+        ' '.join([str(level) for level in size['levels']]), size['m'], size['p'], size['t'], size['numEffects'])
+
+
+if __name__ == '__main__':
+    main()
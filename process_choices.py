@@ -40,6 +40,57 @@ results in a new release at Nectar then document that in the main file choice.py
 2013.11.18: Added code to check for fraction input in det. 
 2013.11.21: Added maximum time to run for. 
 2013.11.27: Fixed code errors with detString. 
+2026.10.18: Added an exact fraction-free (Bareiss) engine for C, det and inverse 
+            which is now the default. The old sympy engine can be selected with 
+            the --numeric option.
+2026.10.18: Added a float64 engine (--numeric float) which escalates to the exact 
+            engine if the result is borderline. 
+2026.10.18: Lambda is constructed by construct_lambda() with one scatter-add. 
+2026.10.18: Added TreatmentIndex, a mixed-radix index from tmt combination to column.
+2026.10.18: Added Design, a compact array of mixed-radix tmt codes for the choice 
+            sets, used from input through to Lambda in all the calculations.
+2026.10.18: B is constructed by construct_bmat() from the contrast tables at once.
+2026.10.18: B is normalised with cached closed-form constants from contrast_norms().
+2026.10.18: Repeated tmts and duplicate choice sets are found by sorting the codes.
+2026.10.18: C is accumulated over the choice sets by accumulate_cint() without Lambda.
+            Added the option --no-lmat which skips Lambda and out_lmat.dat.
+2026.10.18: tmts, gens and chsets are parsed by parse_int_matrix() straight into
+            int32 arrays and their row widths are checked when they are read.
+2026.10.18: Moved the calculation out of main() into run_calculation() so it can be
+            run by long-lived worker processes as well as from the command line.
+2026.10.18: Added evaluate_design() which does the calculation without files or
+            global state. The calculations take the deadline, numeric engine and
+            out_lmat in their inputs instead of using START, NUMERIC and OUT_LMAT.
+2026.10.18: Added parse_input_texts() and run_calculation_texts() so the web app
+            can pass the inputs and outputs to a worker without any files.
+2026.10.18: Added Progress which is passed through every stage of the calculation
+            to report its progress, end it at its deadline or cancel it.
+2026.10.18: Progress times each stage and the calculation writes out_timings.dat.
+2026.10.18: Fixed a missing * in the optimal det for an odd number of binary
+            factors with two factor interactions, which raised a TypeError.
+2026.10.18: Added IncrementalDesign which updates det(C) and C^-1 with low rank
+            updates as choice sets are added, removed or swapped. The optimal
+            main effects det is now calculated by optimal_det_main().
+2026.10.18: Added search_generators() and the --search option which searches for
+            the most efficient generators for construct on all the cpus.
+2026.10.18: Added the optimise operation which improves the choice sets to check
+            by coordinate exchange with IncrementalDesign, from several starts 
+            on all the cpus, and the --time option for its time budget.
+2026.10.18: The efficiencies are calculated from the logs of det C and of the
+            optimal det, which for the optimal designs are found in closed form,
+            instead of the nth root of their exact ratio. The optimal det for
+            binary factors with two factor interactions was always 0 because of
+            an integer division so that efficiency was never shown.
+2026.10.18: The exact engine finds the rank, det and adjugate of Cint with ldlt(),
+            a fraction-free symmetric elimination of only one triangle.
+2026.10.18: optimise_design() has OPTIMISE_STARTS starts however many processes
+            it can use, and runs them one after another in a worker process.
+            OPTIMISE_TIME is the time for all of the starts.
+2026.10.18: parse_int_matrix() accepts unicode text, e.g. inputs loaded from json,
+            which it parsed as its UCS-2/UCS-4 bytes and so always rejected.
+2026.10.18: The peak RSS of out_timings.dat is reset by each Progress, so in a
+            long-lived worker it is the peak of that calculation and not of
+            the biggest calculation the worker has run.
 
 
 Details
@@ -93,16 +144,26 @@ Description of all output files:
     out_cmat.dat        Information matrix C
     out_lmat.dat        Lambda matrix
     out_msg.dat         Output messages for the user's browser.
+    out_timings.dat     Wall time, CPU time and peak memory of each stage.
 
 '''
 
-import os, re, sys
+import os, re, sys, time, random
+import multiprocessing
 import numpy as np
 import itertools
 import sympy
 from sympy.matrices import *
+try:
+    import mpmath
+except ImportError:
+    from sympy import mpmath  # older sympy has its own copy
 from datetime import datetime, timedelta
 #from time import sleep  # add e.g. sleep(3) for testing
+try:
+    import resource  # for the peak memory, only on Unix
+except ImportError:
+    resource = None
 
 # Our own modules
 from choice_common import get_expected_io, write_errors
@@ -112,9 +173,21 @@ from choice_common import get_expected_io, write_errors
 # Global variables 
 ##################
 
-global START, MAX_TIME 
-START = datetime.now()
+# These are the defaults for the command line, evaluate_design() takes them as args.
+global MAX_TIME, NUMERIC, OUT_LMAT, SEARCH, OPTIMISE_TIME
 MAX_TIME = 1000           # Maximum time in seconds to run for.
+NUMERIC = 'exact'         # Engine for C, det and inverse: exact, float or sympy
+FLOAT_COND_LIMIT = 1e10   # Float engine escalates to exact above this condition number.
+OUT_LMAT = True           # Write out_lmat.dat, only then is the dense Lambda constructed.
+CHUNK_SIZE = 2**20        # Number of B entries gathered at once when accumulating C.
+REFRESH_UPDATES = 100     # Low rank updates of C^-1 before IncrementalDesign recalculates it.
+SEARCH_SAMPLES = 10000    # Most candidate generators tried by search_generators().
+SEARCH_BLOCK = 50         # Most candidates scored by a process of the search at a time.
+SEARCH = None             # The number of best generators to search for, None to not search.
+OPTIMISE_TIME = 60        # Seconds optimise_design() can run for, shared by its starts.
+OPTIMISE_STARTS = 8       # Starts of optimise_design(): the entered sets then random designs.
+OPTIMISE_CANDIDATES = 1000  # Most tmts tried for each option by exchange_design().
+LOG_DPS = 30              # Decimal digits of the logs of det C used for the efficiencies.
 
 
 ###################
@@ -153,6 +226,134 @@ class myComb(object):
         return str(self.val) #+ ' modulo ' + str(self.nmod)
 
 
+class Outputs(dict):
+    '''
+    The outputs of a calculation. Each key is the name of an output file e.g.
+    'cmat' for out_cmat.dat and its value is the text of that file. The 
+    matrices themselves are kept in self.arrays with the same keys.
+    The time taken by save_matrix() to format the matrices as text is added
+    up in self.format_wall and self.format_cpu.
+    '''
+    def __init__(self, *args, **kwargs):
+        super(Outputs,self).__init__(*args, **kwargs)
+        self.arrays = {}
+        self.format_wall = 0.0
+        self.format_cpu = 0.0
+
+
+class Cancelled(BaseException):
+    '''
+    Raised by Progress to end a calculation, the message says why. Like 
+    KeyboardInterrupt it is not an Exception so the "except Exception:" 
+    around each stage does not catch it.
+    '''
+    pass
+
+
+class Progress(object):
+    '''
+    The progress of a calculation through its stages: parse, duplicates, 
+    B matrix, Lambda matrix, C matrix, rank, det, inverse, correlation and 
+    flags. The calculation calls start() at each stage and 
+    step() inside the long loops, and both of these end the calculation by 
+    raising Cancelled once the deadline, a datetime or None, has passed or 
+    cancel() has been called. 
+    report(progress) is called at each start() and step() so the progress 
+    can be shown to the user, and it may call cancel(). 
+    msg is the message so far and outputs the Outputs so far, these are 
+    returned by the calculation if it is ended.
+    Each stage is timed and self.timings has a dict for each stage that has 
+    ended with its wall and cpu time in seconds and the peak memory (RSS) of
+    the process in MB since this Progress was made. The peak is reset for 
+    each calculation on Linux, elsewhere it is the peak of the process so far
+    which in a long-lived worker can be from an earlier calculation and then
+    peak_reset is False. The time taken to format the outputs is taken 
+    out of the stages it was in and is given as a stage of its own by 
+    timings_text().
+    '''
+    def __init__(self, deadline=None, report=None):
+        super(Progress,self).__init__()
+        self.deadline = deadline
+        self.report = report
+        self.cancelled = False
+        self.stage = None
+        self.done = 0
+        self.total = 0
+        self.msg = ''
+        self.outputs = Outputs()
+        self.timings = []
+        self.lap = None  # the clocks when the current stage started
+        self.peak_reset = reset_peak_rss()
+
+    def start(self, stage, msg=None, total=0):
+        ''' Starts the next stage which has total steps, 0 if not known. '''
+        self.finish()
+        self.lap = self.clocks()
+        self.stage = stage
+        self.done = 0
+        self.total = total
+        if msg is not None:
+            self.msg = msg
+        self.check()
+
+    def step(self, count=1):
+        ''' Records that count more steps of this stage are done. '''
+        self.done = self.done + count
+        self.check()
+
+    def check(self):
+        ''' Reports the progress and raises Cancelled if the calculation should end. '''
+        if self.report:
+            self.report(self)
+        if self.cancelled:
+            raise Cancelled('Calculation was cancelled.')
+        if past_deadline(self.deadline):
+            raise Cancelled('Calculation is taking too long ... exiting.')
+
+    def cancel(self):
+        ''' Ends the calculation at its next start() or step(). '''
+        self.cancelled = True
+
+    def clocks(self):
+        ''' Returns the wall, cpu and output formatting times so far. '''
+        return (time.time(), sum(os.times()[:2]), self.outputs.format_wall, self.outputs.format_cpu)
+
+    def finish(self):
+        ''' Ends the timing of the current stage, if there is one. '''
+        if self.lap is None:
+            return
+        now = self.clocks()
+        self.timings.append({'stage': self.stage, 
+            'wall': (now[0] - self.lap[0]) - (now[2] - self.lap[2]),
+            'cpu': (now[1] - self.lap[1]) - (now[3] - self.lap[3]),
+            'peak_rss': peak_rss()})
+        self.lap = None
+
+    def timings_text(self):
+        '''
+        Returns the timings as the text of out_timings.dat, a header line and 
+        then a tab separated line for each stage, the output formatting and 
+        the total, e.g.
+        stage       wall_s  cpu_s   peak_rss_mb
+        parse       0.0012  0.0010  61.2
+        '''
+        rows = [(item['stage'], item['wall'], item['cpu'], item['peak_rss']) for item in self.timings]
+        rows.append(('formatting', self.outputs.format_wall, self.outputs.format_cpu, peak_rss()))
+        rows.append(('total', sum([row[1] for row in rows]), sum([row[2] for row in rows]), peak_rss()))
+        text = 'stage\twall_s\tcpu_s\tpeak_rss_mb\n'
+        for (stage, wall, cpu, rss) in rows:
+            if rss is None:
+                rss = ''
+            else:
+                rss = '%.1f' % rss
+            text += '%s\t%.4f\t%.4f\t%s\n' % (stage, wall, cpu, rss)
+        return text
+
+    def state(self):
+        ''' Returns the progress as a dict e.g. for json. '''
+        return {'stage': self.stage, 'done': self.done, 'total': self.total}
+
+
 ###################
 # General functions 
 ###################
@@ -160,17 +361,92 @@ class myComb(object):
 
 def usage ():
     print ''
-    print 'Usage: %s <input_dir> <check|construct> <main|mplusall|mplussome>' % sys.argv[0]
+    print 'Usage: %s <input_dir> <check|construct|optimise> <main|mplusall|mplussome> [--numeric exact|float|sympy] [--no-lmat] [--search N] [--time T]' % sys.argv[0]
     print '  input_dir               <-- a directory of data input files'
-    print '  check|construct         <-- select one of these two options'
+    print '  check|construct|optimise <-- select one of these three options'
     print '  main|mplusall|mplussome <-- select one of these three options '
+    print '  --numeric exact|float|sympy <-- optional, engine for C, det and inverse (default exact)'
+    print '  --no-lmat               <-- optional, do not construct Lambda or write out_lmat.dat'
+    print '  --search N              <-- optional for construct, search for the best N generators'
+    print '  --time T                <-- optional for optimise, the seconds to optimise for (default %d)' % OPTIMISE_TIME
     print ''
 
 
-def read_input_files(input_dir, expected_input):
+def parse_int_matrix(text, width=None):
+    '''
+    Parses text of whitespace separated integers, one row per non-blank line,
+    into an int32 array. The whole buffer is checked and converted at once 
+    rather than value by value. Raises a ValueError if a value is not an
+    integer, if the rows have different numbers of values or if width is 
+    given and the rows don't have that many values. text can be str or
+    unicode, e.g. from json, as long as it is all ASCII.
+    '''
+    if isinstance(text, unicode):
+        # The buffer of a unicode object is UCS-2/UCS-4, not one byte per character.
+        try:
+            text = text.encode('ascii')
+        except UnicodeError:
+            raise ValueError('invalid literal for int(): only integers are allowed')
+    if text.strip() == '':
+        return np.zeros((0, width or 0), dtype=np.int32)
+    buf = np.frombuffer(text, dtype=np.uint8)
+    space = (buf == ord(' ')) | ((buf >= ord('\t')) & (buf <= ord('\r')))
+    digit = (buf >= ord('0')) & (buf <= ord('9'))
+    sign = (buf == ord('-')) | (buf == ord('+'))
+    # each value starts at a non-space character after a space
+    starts = ~space & np.concatenate(([True], space[:-1]))
+    if not np.all(space | digit | (sign & starts)):
+        raise ValueError('invalid literal for int(): only integers are allowed')
+
+    # the number of values on each non-blank line
+    line = np.cumsum(buf == ord('\n'))
+    counts = np.bincount(line[starts])
+    lines = np.nonzero(counts)[0]
+    counts = counts[lines]
+    if width is None:
+        width = counts[0]
+    bad = np.nonzero(counts != width)[0]
+    if len(bad) > 0:
+        raise ValueError('line %d has %d values, expected %d' % (lines[bad[0]] + 1, counts[bad[0]], width))
+
+    values = np.fromstring(text, dtype=np.int32, sep=' ')
+    if len(values) != counts.sum():
+        raise ValueError('invalid literal for int(): only integers are allowed')
+    return values.reshape(len(counts), width or 0)
+
+
+def read_input_files(input_dir, expected_input, errors=None):
     '''
     expected_input is a list of the input variables that we expect. For each expected 
     variable we look for a file named "in_variable.dat" and read this file. 
+    The contents are converted by parse_input_texts() and the resulting 
+    dictionary of inputs is returned. errors is as for parse_input_texts().
+    '''
+    texts = {}
+    for name in expected_input:
+        filename = 'in_' + name + '.dat'
+        if name == 'det':
+            # The det is optional so there might be no input file.
+            try: 
+                fh = open(filename, 'r')
+                texts[name] = fh.read()
+                fh.close()
+            except IOError as e:
+                # TODO I still have to check what happens if in_det.dat can't be read.
+                write_errors('Reading in_det.dat, got IOError: %s\n' % e)
+        else:
+            fh = open(filename, 'r')
+            texts[name] = fh.read()
+            fh.close()
+
+    return parse_input_texts(texts, expected_input, errors)
+
+
+def parse_input_texts(texts, expected_input, errors=None, log=write_errors):
+    '''
+    texts is a dictionary of the contents of the input files, e.g. texts['levels']
+    is the contents of in_levels.dat, and expected_input is a list of the input
+    variables that we expect. 
     Most of the input files have different formats; some are integers, some are 
     matrices, some are lists of numbers. There names are based on the variable names 
     i.e. 'factors', 'levels', 'msize', 'chsets', 'tmts', 'gens', 'det', 'twofis'
@@ -180,89 +456,87 @@ def read_input_files(input_dir, expected_input):
              It appears this check has been removed? 
     The output dictionary will be the string inputs converted to the required output 
     types so inputs['det'] will be a int or float or exponent, inputs['twofis'] will
-    be a list of integers etc. 
+    be a list of integers etc. The tmts, gens and chsets are int32 arrays and 
+    their row widths are checked against levels and msize.
+    If errors is a list then a message for each matrix that can't be read is 
+    appended to it. Other problems are passed to log, which by default 
+    appends them to errors.txt.
     '''
 
     inputs = {}  # We will be returning this dictionary.
+    if errors is None:
+        errors = []
 
     # factors should be a single integer
     if 'factors' in expected_input:
-        fh = open('in_factors.dat', 'r')
-        contents = fh.read()
-        fh.close()
+        contents = texts['factors']
         try:
             factors = int(contents)
         except ValueError as e: 
-            write_errors('Reading in_factors.dat: %s\n' % e)
+            log('Reading in_factors.dat: %s\n' % e)
             factors = False
 
         inputs['factors'] = factors    
 
     # levels read in as string e.g. '4 3 3 3' & converted to list of ints.
     if 'levels' in expected_input:
-        fh = open('in_levels.dat', 'r')
-        levelsString = fh.read()
-        fh.close()
+        levelsString = texts['levels']
         try:
             levels = [int(i) for i in levelsString.split()]
         except ValueError as e:
             levels = False
-            write_errors('Reading in_levels.dat: %s\n' % e)
+            log('Reading in_levels.dat: %s\n' % e)
 
         inputs['levels'] = levels
 
     # choice set size (m) read in as a string, it's a single integer e.g. 2
     if 'msize' in expected_input:
-        fh = open('in_msize.dat', 'r')
-        cssString = fh.read()
-        fh.close()
+        cssString = texts['msize']
         try:
             choicesetsize = int(cssString)
         except ValueError as e:
             choicesetsize = False
-            write_errors('Reading in_msize.dat: %s\n' % e)
+            log('Reading in_msize.dat: %s\n' % e)
 
         inputs['msize'] = choicesetsize
 
-    # tmts matrix read in and converted to a list of tuples.
+    # The number of values in each row of tmts, gens and chsets, if known.
+    (tmtsWidth, gensWidth, chsetsWidth) = (None, None, None)
+    if inputs.get('levels') and inputs.get('msize'):
+        tmtsWidth = len(inputs['levels'])
+        gensWidth = (inputs['msize'] - 1) * tmtsWidth
+        chsetsWidth = inputs['msize'] * tmtsWidth
+
+    # tmts matrix read in as an int32 array, one row per tmt.
     if 'tmts' in expected_input:
-        # MRL version is here, uses two list comprehensions and split() 
-        tmts = []
-        fh = open('in_tmts.dat', 'r')
-        lines = fh.readlines()
-        fh.close()
         try:
-            tmts = [[int(char) for char in line.split()] for line in lines]
+            tmts = parse_int_matrix(texts['tmts'], tmtsWidth)
         except ValueError as e:
-            write_errors('Reading in_tmts.dat: %s\n' % e)
+            log('Reading in_tmts.dat: %s\n' % e)
+            errors.append('Problem reading in_tmts.dat: %s\n' % e)
             tmts = False 
 
         inputs['tmts'] = tmts
 
-    # generators read in and converted to list of tuples.
+    # generators read in as an int32 array, one row per generator.
     if 'gens' in expected_input:
-        generators = []
-        fh = open('in_gens.dat', 'r')
-        lines = fh.readlines()
-        fh.close()
         try:
-            gens = [[int(char) for char in line.split()] for line in lines]
+            gens = parse_int_matrix(texts['gens'], gensWidth)
         except ValueError as e:
-            write_errors('Reading in_gens.dat: %s\n' % e)
+            log('Reading in_gens.dat: %s\n' % e)
+            errors.append('Problem reading in_gens.dat: %s\n' % e)
             gens = False 
 
         inputs['gens'] = gens
 
-    # chsets for checking your own sets 
+    # chsets for checking your own sets, one row per choice set.
     if 'chsets' in expected_input:
-        fh = open('in_chsets.dat', 'r')
-        lines = fh.readlines()
-        fh.close()
         try:
-            chsets = [[int(char) for char in line.split()] for line in lines]
+            chsets = parse_int_matrix(texts['chsets'], chsetsWidth)
         except ValueError as e:
-            write_errors('Reading in_chsets.dat: %s\n' % e)
-            gens = False 
+            log('Reading in_chsets.dat: %s\n' % e)
+            errors.append('Problem reading in_chsets.dat: %s\n' % e)
+            chsets = False 
 
         inputs['chsets'] = chsets
 
@@ -280,15 +554,8 @@ def read_input_files(input_dir, expected_input):
  
         # Note: In the tests below We set detString to None because later we
         # cast to a float and a float(False) = 0.0 which we don't want.
-        try: 
-            fh = open('in_det.dat', 'r')
-            detString = fh.read()
-            fh.close()
-        except IOError as e:
-            # TODO I still have to check what happens if in_det.dat can't be read.
-            # detString & detString_is_OK remain as initial values as above.
-            write_errors('Reading in_det.dat, got IOError: %s\n' % e)
-            detString = None
+        # If in_det.dat couldn't be read then detString is None.
+        detString = texts.get('det')
        
         # At this point detString will be either None or whatever was in the
         # file if successfully read. 
@@ -315,7 +582,7 @@ def read_input_files(input_dir, expected_input):
                 pass 
        
         # Here we try a blank or nothing.  
-        if not detString_is_OK:
+        if not detString_is_OK and detString is not None:
             pat = re.compile('\s*$') # will match just nothing or only whitespace
             if re.match(pat, detString):
                 # Matches nothing or only whitespace. 
@@ -324,7 +591,7 @@ def read_input_files(input_dir, expected_input):
 
         # If det is still not OK then detString remains as None.
         if not detString_is_OK:
-            write_errors('Setting determinant of C to default value = None\n')
+            log('Setting determinant of C to default value = None\n')
             optdet = None
 
         # At this stage optdet should be a valid numerical value or None.
@@ -336,9 +603,7 @@ def read_input_files(input_dir, expected_input):
 
     # twofis - Note TODO check are integers <= k
     if 'twofis' in expected_input:
-        fh = open('in_twofis.dat', 'r')
-        line = fh.read()
-        fh.close()
+        line = texts['twofis']
         twofis = []
         try:
             for factor in line.split():
@@ -346,7 +611,7 @@ def read_input_files(input_dir, expected_input):
                 temp = [int(char) for char in factor.split(',')] 
                 twofis.append(temp)
         except ValueError as e:
-            write_errors('Reading in_twofis.dat: %s\n' % e)
+            log('Reading in_twofis.dat: %s\n' % e)
             twofis = False 
 
         inputs['twofis'] = twofis
@@ -367,6 +632,103 @@ def write_output_files(outputs):
         fh.close()
 
 
+def save_matrix(outputs, name, mat):
+    ''' Saves a matrix in outputs as the text of out_name.dat and in outputs.arrays. '''
+    wall = time.time()
+    cpu = sum(os.times()[:2])
+    outputs[name] = ''.join(str(mat)).replace('[','').replace(']','').replace(',','') + '\n'
+    outputs.arrays[name] = mat
+    outputs.format_wall += time.time() - wall
+    outputs.format_cpu += sum(os.times()[:2]) - cpu
+
+
+def reset_peak_rss():
+    '''
+    Resets the peak memory (RSS) of this process to its current RSS, so a
+    long-lived worker's peak is that of its current calculation. Returns True
+    if it was reset, which needs Linux 4.0 or later. 
+    '''
+    try:
+        fh = open('/proc/self/clear_refs', 'w')
+        try:
+            fh.write('5')
+        finally:
+            fh.close()
+    except (IOError, OSError):
+        return False
+    return True
+
+
+def peak_rss():
+    '''
+    Returns the peak memory (RSS) of this process in MB since it was last
+    reset by reset_peak_rss(), or None if not known. 
+    '''
+    try:
+        fh = open('/proc/self/status')
+        try:
+            for line in fh:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024.0
+        finally:
+            fh.close()
+    except (IOError, OSError, ValueError):
+        pass
+    if resource is None:
+        return None
+    # The peak of the whole life of the process, Linux gives this in KB.
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def past_deadline(deadline):
+    ''' Returns True if the deadline, a datetime or None for no deadline, has passed. '''
+    return deadline is not None and datetime.now() > deadline
+
+
+def cancellable(calculation):
+    '''
+    Decorator for the calculation functions. It puts a Progress for the 
+    deadline in inputs['progress'] if there is not one already, and if the 
+    progress ends the calculation it returns the outputs so far with a 
+    message saying why. The timings of the stages are added to the outputs
+    as 'timings'.
+    '''
+    def run(inputs):
+        if inputs.get('progress') is None:
+            inputs = dict(inputs, progress=Progress(inputs.get('deadline')))
+        progress = inputs['progress']
+        try:
+            outputs = calculation(inputs)
+        except Cancelled as e:
+            outputs = progress.outputs
+            outputs['msg'] = progress.msg + '%s\n' % e
+        progress.finish()
+        outputs['timings'] = progress.timings_text()
+        outputs.arrays['timings'] = progress.timings
+        return outputs
+    run.__name__ = calculation.__name__
+    run.__doc__ = calculation.__doc__
+    return run
+
+
+def as_int_matrix(mat, width):
+    '''
+    Returns a matrix given as text in the format of the input files, or as 
+    an array or a list of rows, as an int32 array. Raises a ValueError if
+    the rows don't have width values. 
+    '''
+    if isinstance(mat, basestring):
+        return parse_int_matrix(mat, width)
+    mat = np.asarray(mat)
+    if mat.size == 0:
+        return np.zeros((0, width), dtype=np.int32)
+    if mat.ndim != 2 or mat.shape[1] != width:
+        raise ValueError('each row must have %d values' % width)
+    if mat.dtype.kind not in 'iu':
+        raise ValueError('only integers are allowed')
+    return mat.astype(np.int32)
+
+
 def lexico(mat):
     ''' Sorts the rows of a matrix lexicographically. '''
     mat = np.matrix(mat) # ensure the variable is a numpy matrix
@@ -420,6 +782,102 @@ def lcm(values):
         return 0
 
 
+def optimal_det_factors(levels, choicesetsize):
+    '''
+    Returns a list of a tuple (ratio, power) for each factor, where ratio is an
+    exact sympy number, so that the det of the C matrix of the optimal main
+    effects design for this choice set size is the product of ratio**power.
+    '''
+    levels = sympy.Matrix(levels)
+    factors = len(levels)
+    prodlevels = np.product(levels)
+    Sumdiffs = list(np.repeat(0, factors))
+    result = []
+    for q in range(factors):
+        if levels[q] == 2:
+            if choicesetsize%2 == 0:
+                Sumdiffs[q] = np.power(choicesetsize, 2)/4
+            else:
+                Sumdiffs[q] = (np.power(choicesetsize, 2) - 1)/4
+        else:
+            if levels[q] >= choicesetsize:
+                Sumdiffs[q] = choicesetsize * (choicesetsize - 1)/2
+            else:
+                x = choicesetsize//levels[q]
+                y = choicesetsize%levels[q]
+                Sumdiffs[q] = (np.power(choicesetsize, 2) - (levels[q] * np.power(x, 2) + 2 * x * y + y))/2
+        result.append(((2 * levels[q] * Sumdiffs[q])/(np.power(choicesetsize, 2) * (levels[q] - 1) * prodlevels), levels[q] - 1))
+    return result
+
+
+def optimal_det_main(levels, choicesetsize):
+    '''
+    Returns a tuple (optdet, optdet2) of the determinants of the C matrix of 
+    the optimal main effects designs, for this choice set size and for the 
+    optimal choice set size, as exact sympy numbers.
+    For many effects these are very large rationals, log_optimal_det_main()
+    gives their logs much more quickly.
+    '''
+    numEffects = sum([int(lvl) - 1 for lvl in levels])
+    prodlevels = np.product(sympy.Matrix(levels))
+    optdet = 1
+    optdet2 = np.power((1/prodlevels), numEffects)
+    for (ratio, power) in optimal_det_factors(levels, choicesetsize):
+        optdet = optdet * np.power(ratio, power)
+
+    return (optdet, optdet2)
+
+
+def log_value(x):
+    '''
+    Returns the natural log of x as an mpmath number with LOG_DPS digits, or
+    -inf if x is 0. x can be an int, a float or a sympy number or expression.
+    The log of a rational p/q is log(p) - log(q) so it does not underflow
+    however small x is.
+    '''
+    with mpmath.workdps(LOG_DPS):
+        if isinstance(x, (int, long, float)):
+            return mpmath.log(x)
+        x = sympy.sympify(x)
+        if x.is_Rational:
+            return mpmath.log(x.p) - mpmath.log(x.q)
+        return mpmath.log(mpmath.mpf(str(x.evalf(LOG_DPS + 5))))
+
+
+def log_optimal_det_main(levels, choicesetsize):
+    ''' Returns the natural logs of the dets from optimal_det_main(). '''
+    numEffects = sum([int(lvl) - 1 for lvl in levels])
+    prodlevels = np.product([int(lvl) for lvl in levels])
+    with mpmath.workdps(LOG_DPS):
+        logoptdet = mpmath.fsum([power * log_value(ratio) for (ratio, power) in optimal_det_factors(levels, choicesetsize)])
+        logoptdet2 = -numEffects * log_value(prodlevels)
+    return (logoptdet, logoptdet2)
+
+
+def log_optimal_det_2fis(factors, choicesetsize):
+    '''
+    Returns the natural log of the det of the C matrix of the optimal design 
+    for main effects and all two factor interactions when all the factors 
+    are binary.
+    '''
+    if factors%2 == 0:
+        ratio = sympy.Rational((choicesetsize-1)*(factors+2), choicesetsize*(factors+1)*2**factors)
+    else:
+        ratio = sympy.Rational((choicesetsize-1)*(factors+1), choicesetsize*factors*2**factors)
+    with mpmath.workdps(LOG_DPS):
+        return (factors + factors*(factors-1)//2) * log_value(ratio)
+
+
+def log_efficiency(logdet, logoptdet, numEffects):
+    '''
+    Returns the efficiency in % of a design whose det(C) is exp(logdet) 
+    compared with one whose det(C) is exp(logoptdet), as a float.
+    Example: log_efficiency(log(1/8), log(1), 3) --> 50.0
+    '''
+    with mpmath.workdps(LOG_DPS):
+        return float(100 * mpmath.exp((mpmath.mpf(logdet) - logoptdet) / numEffects))
+
+
 def construct_poly_contrasts():
     ''' Construct the othogonal polynomial contrasts. '''
     orthogpolys = []
@@ -436,10 +894,924 @@ def construct_poly_contrasts():
     return orthogpolys
 
 
+def construct_bmat(allTmts, levels, choose2fis, orthogpolys):
+    '''
+    Constructs the unnormalised B matrix as an integer matrix with one column
+    for each row of allTmts. The main effect rows of each factor are the 
+    orthogonal polynomial contrasts indexed by the levels of that factor in 
+    all tmts at once. The rows of each 2fi in choose2fis (1-based factor 
+    pairs) are the row-wise products of the contrast rows of its two factors,
+    the second factor varying fastest.
+    '''
+    allTmts = np.asarray(allTmts)
+    levels = [int(item) for item in levels]
+    
+    # the main effects contrasts of each factor, one column per tmt
+    blocks = [np.asarray(orthogpolys[levels[f] - 2])[:,allTmts[:,f]] for f in range(len(levels))]
+    
+    # the interaction contrasts as Khatri-Rao products of the main effects
+    rows = list(blocks)
+    for (f1, f2) in choose2fis:
+        block1 = blocks[f1-1]
+        block2 = blocks[f2-1]
+        rows.append((block1[:,np.newaxis,:] * block2[np.newaxis,:,:]).reshape(-1, allTmts.shape[0]))
+    
+    return np.matrix(np.vstack(rows))
+
+
+# Squared norms of the rows of each orthogonal polynomial table, by number of levels - 2
+POLY_NORM2 = [[int(item) for item in np.asarray(np.multiply(poly, poly).sum(axis=1)).ravel()]
+              for poly in construct_poly_contrasts()]
+# Cache of the normalising constants, by levels and 2fis 
+NORM_CACHE = {}
+
+
+def contrast_norms(levels, choose2fis):
+    '''
+    Returns the squared normalising constant of each row of the B matrix from
+    construct_bmat() as a list of integers. For a main effect contrast of 
+    factor f it is the squared norm of the contrast times prod(levels)/l_f. 
+    For a 2fi of factors f1 and f2 it is the product of the squared norms of 
+    the two contrasts times prod(levels)/(l_f1*l_f2). The result is cached. 
+    '''
+    levels = tuple([int(item) for item in levels])
+    choose2fis = tuple([tuple(item) for item in choose2fis])
+    key = (levels, choose2fis)
+    if key not in NORM_CACHE:
+        size = 1
+        for lvl in levels:
+            size *= lvl
+        norms = []
+        for lvl in levels: # main effects
+            norms.extend([item * (size // lvl) for item in POLY_NORM2[lvl - 2]])
+        for (f1, f2) in choose2fis: # interactions
+            l1 = levels[f1-1]
+            l2 = levels[f2-1]
+            norms.extend([n1 * n2 * (size // (l1 * l2)) for n1 in POLY_NORM2[l1 - 2] for n2 in POLY_NORM2[l2 - 2]])
+        NORM_CACHE[key] = norms
+    return list(NORM_CACHE[key])
+
+
+def normalise_bmat(bint, bnorms):
+    '''
+    Returns B as a sympy matrix with each row of the integer matrix bint 
+    divided by the square root of its squared norm in bnorms. Each distinct
+    entry of a row is only converted to sympy once.
+    '''
+    bint = np.asarray(bint)
+    rows = []
+    for i in range(bint.shape[0]):
+        norm = sympy.sqrt(bnorms[i])
+        values = dict([(value, sympy.Integer(value)/norm) for value in set(bint[i].tolist())])
+        rows.append([values[value] for value in bint[i].tolist()])
+    return sympy.Matrix(rows)
+
+
+def encode_rows(mat, low, radix):
+    '''
+    Encodes each row of an integer matrix as a single mixed-radix integer. 
+    low and radix give the smallest value and the number of possible values
+    in each column. Rows that sort lexicographically have codes that sort 
+    the same way. Python integers are used if the codes won't fit in 64 bits.
+    '''
+    mat = np.asarray(mat)
+    if np.prod([float(item) for item in radix]) < 2**62:
+        mat = mat.astype(np.int64)
+    else:
+        mat = mat.astype(object)
+    codes = np.zeros(mat.shape[0], dtype=mat.dtype)
+    for f in range(mat.shape[1]):
+        codes = codes * int(radix[f]) + (mat[:,f] - int(low[f]))
+    return codes
+
+
+def code_dtype(levels):
+    '''
+    Returns the smallest integer dtype that can hold the mixed-radix codes 
+    of treatment combinations with these levels. 
+    '''
+    size = np.prod([float(item) for item in levels])
+    if size < 2**31:
+        return np.int32
+    elif size < 2**62:
+        return np.int64
+    else:
+        return object
+
+
+def encode_treatments(mat, levels):
+    '''
+    Encodes each row of a matrix of treatment combinations as a mixed-radix
+    integer code using levels as the radix. Raises a ValueError if a value is
+    not in the range 0 to level-1 of its factor.
+    '''
+    mat = np.asarray(mat)
+    levels = [int(item) for item in levels]
+    if mat.size > 0 and (np.any(mat.min(axis=0) < 0) or np.any(mat.max(axis=0) >= levels)):
+        raise ValueError('Treatment combinations must have values from 0 to the number of levels - 1.')
+    return encode_rows(mat, [0 for item in levels], levels).astype(code_dtype(levels))
+
+
+def decode_treatments(codes, levels):
+    '''
+    Decodes mixed-radix codes back to a matrix of treatment combinations,
+    one row per code. 
+    '''
+    codes = np.asarray(codes).ravel()
+    levels = [int(item) for item in levels]
+    mat = np.zeros((len(codes), len(levels)), dtype=int)
+    for f in range(len(levels)-1, -1, -1):
+        mat[:,f] = codes % levels[f]
+        codes = codes // levels[f]
+    return mat
+
+
+class Design(object):
+    '''
+    A compact representation of a set of choice sets. codes is a (p, m) 
+    integer array where each entry is the mixed-radix code of the treatment
+    combination of one option, with levels as the radix. Codes sort in the
+    same order as the treatment combinations sort lexicographically.
+    '''
+    def __init__(self, codes, levels):
+        super(Design,self).__init__()
+        self.codes = np.ascontiguousarray(codes)
+        self.levels = [int(item) for item in levels]
+        self.msize = self.codes.shape[1]
+
+    @classmethod
+    def from_rows(cls, rows, levels, msize):
+        ''' From a matrix with one choice set per row e.g. as in in_chsets.dat '''
+        rows = np.asarray(rows)
+        factors = len(levels)
+        if rows.ndim != 2 or rows.shape[1] != msize * factors:
+            raise ValueError('Each choice set must have %d values (m times k).' % (msize * factors))
+        codes = encode_treatments(rows.reshape(rows.shape[0] * msize, factors), levels)
+        return cls(codes.reshape(rows.shape[0], msize), levels)
+
+    @classmethod
+    def from_text(cls, text, levels, msize):
+        ''' From text in the format of in_chsets.dat '''
+        rows = parse_int_matrix(text, msize * len(levels))
+        return cls.from_rows(rows, levels, msize)
+
+    @classmethod
+    def from_generators(cls, tmts, generators, levels, msize):
+        '''
+        Constructs the choice sets by adding each set of generators to each 
+        treatment combination, modulo the levels. tmts is a (t, k) matrix and
+        generators is a (g, m-1, k) array. The choice sets are in tmt order
+        and then generator order.
+        '''
+        levels = [int(item) for item in levels]
+        tmts = np.asarray(tmts)
+        generators = np.asarray(generators).reshape(-1, msize - 1, len(levels))
+        encode_treatments(tmts, levels)  # checks the range of the values
+        # options[tmt, gen, option, factor]
+        options = np.zeros((len(tmts), len(generators), msize, len(levels)), dtype=int)
+        options[:,:,0,:] = tmts[:,np.newaxis,:]
+        options[:,:,1:,:] = (tmts[:,np.newaxis,np.newaxis,:] + generators[np.newaxis,:,:,:]) % levels
+        codes = encode_treatments(options.reshape(-1, len(levels)), levels)
+        return cls(codes.reshape(-1, msize), levels)
+
+    def __len__(self):
+        return self.codes.shape[0]
+
+    def tmt_codes(self):
+        ''' Returns the sorted unique codes of all the treatment combinations. '''
+        return np.unique(self.codes)
+
+    def treatments(self):
+        ''' Returns a lexicographically sorted matrix of all the unique tmt combinations. '''
+        return decode_treatments(self.tmt_codes(), self.levels)
+
+    def sorted(self):
+        ''' Returns a Design with the options sorted lexicographically within each choice set. '''
+        return Design(np.sort(self.codes, axis=1), self.levels)
+
+    def repeats(self):
+        ''' Returns the indices of the choice sets that have a repeated tmt combination. '''
+        if self.msize < 2:
+            return np.zeros(0, dtype=int)
+        codes = np.sort(self.codes, axis=1)
+        return np.nonzero(np.any(codes[:,1:] == codes[:,:-1], axis=1))[0]
+
+    def duplicates(self):
+        '''
+        Returns the sorted 1-based numbers of the choice sets that are the 
+        same as an earlier choice set, option for option. Each is listed once
+        for every earlier choice set it matches, as when comparing all pairs.
+        '''
+        if len(self) < 2:
+            return np.zeros(0, dtype=int)
+        order = np.lexsort(self.codes.T[::-1]) # stable, so equal sets keep their order
+        codes = self.codes[order]
+        new = np.concatenate(([True], np.any(codes[1:] != codes[:-1], axis=1)))
+        # the position of each choice set within its group of equal sets
+        starts = np.nonzero(new)[0]
+        position = np.arange(len(self)) - starts[np.cumsum(new) - 1]
+        return np.sort(np.repeat(order + 1, position))
+
+    def unique(self):
+        ''' Returns a Design with the repeated choice sets removed, sorted lexicographically. '''
+        if len(self) < 2:
+            return self
+        order = np.lexsort(self.codes.T[::-1])
+        codes = self.codes[order]
+        keep = np.concatenate(([True], np.any(codes[1:] != codes[:-1], axis=1)))
+        return Design(codes[keep], self.levels)
+
+    def to_rows(self):
+        ''' Returns a matrix with one choice set per row as in in_chsets.dat '''
+        return decode_treatments(self.codes, self.levels).reshape(len(self), self.msize * len(self.levels))
+
+    def to_text(self):
+        ''' Returns the choice sets as text in the format of in_chsets.dat '''
+        return ''.join([' '.join([str(item) for item in row]) + '\n' for row in self.to_rows().tolist()])
+
+
+class TreatmentIndex(object):
+    '''
+    Index from a treatment combination to its column in the B matrix.
+    Each treatment is encoded as a mixed-radix integer using levels, so 
+    finding the column of a treatment is a single table (or dict) lookup
+    instead of a scan through all the treatments. allTmts must be sorted 
+    lexicographically and its row order gives the column numbers. The values
+    must be in range for levels, as they are in a Design, otherwise a 
+    ValueError is raised.
+    '''
+    TABLE_LIMIT = 2**22   # use a lookup table if there are fewer codes than this
+
+    def __init__(self, allTmts, levels):
+        super(TreatmentIndex,self).__init__()
+        allTmts = np.asarray(allTmts)
+        self.t = allTmts.shape[0]
+        levels = np.array([int(item) for item in levels])
+        self.levels = levels
+        self.codes = encode_treatments(allTmts, levels)
+        size = np.prod([float(item) for item in levels])
+        if size <= self.TABLE_LIMIT:
+            self.table = -np.ones(int(size), dtype=np.int64)
+            self.table[self.codes] = np.arange(self.t)
+            self.lookup = None
+        else:
+            self.table = None
+            self.lookup = dict(zip(self.codes.tolist(), range(self.t)))
+
+    def encode(self, mat):
+        ''' Returns the codes of the rows of a matrix of treatments. '''
+        return encode_treatments(mat, self.levels)
+
+    def columns(self, mat):
+        ''' Returns the B column of each row of a matrix of treatments. '''
+        codes = self.encode(mat)
+        if self.table is not None:
+            return self.table[codes]
+        return np.array([self.lookup[code] for code in codes.tolist()], dtype=np.int64)
+
+    def columns_of_codes(self, codes):
+        ''' Returns the B column of each treatment given as codes from encode_treatments(). '''
+        codes = np.asarray(codes)
+        if self.table is not None:
+            return self.table[codes.astype(np.int64)]
+        return np.array([self.lookup[code] for code in codes.tolist()], dtype=np.int64)
+
+    def __getitem__(self, tmt):
+        ''' Returns the B column of a single treatment e.g. index[(0, 2, 1, 1)] '''
+        return int(self.columns(np.array([tmt]))[0])
+
+
+def construct_lambda(design, index):
+    '''
+    Constructs the Lambda matrix, without the 1/(p*m^2) scale, as an integer
+    matrix. design is the Design of the choice sets and index is the 
+    TreatmentIndex of all the unique treatment combinations. Every option of
+    every choice set is located with the index, then all option pairs are
+    counted with one scatter-add and the diagonal filled.
+    '''
+    t = index.t
+    (p, choicesetsize) = design.codes.shape
+
+    # get the index for each option in each choiceset
+    lind = index.columns_of_codes(design.codes.ravel()).reshape(p, choicesetsize)
+
+    # every pair of options (i, j) with i < j in every choiceset
+    (first, second) = np.triu_indices(choicesetsize, 1)
+    rows = lind[:, first].ravel()
+    cols = lind[:, second].ravel()
+
+    # count the pairs in both directions, the off diagonals are minus the counts
+    counts = np.bincount(rows * t + cols, minlength=t*t) + np.bincount(cols * t + rows, minlength=t*t)
+    counts = counts.reshape(t, t)
+    lmat = -counts
+    # calculate the diagonal entries of lambda
+    lmat[np.diag_indices(t)] = counts.sum(axis=1)
+
+    return np.matrix(lmat)
+
+
+def rational_matrix(mat, denominator, progress=None):
+    '''
+    Returns the integer matrix mat divided by denominator as a sympy matrix of
+    rationals, the same as sympy.Matrix(mat)/denominator but made a row at a
+    time so that progress, if given, can be stepped for each row.
+    '''
+    mat = np.asarray(mat)
+    if progress:
+        progress.total = len(mat)
+    rows = []
+    for row in mat.tolist():
+        rows.append([sympy.Rational(item, denominator) for item in row])
+        if progress:
+            progress.step()
+    return sympy.Matrix(rows)
+
+
+def accumulate_cint(bint, design, index, progress=None):
+    '''
+    Returns Cint = Bint*Lint*Bint' as an integer array, where Lint is the 
+    Lambda matrix from construct_lambda(), without constructing Lambda. 
+    A choice set whose options have the B columns b_1 .. b_m adds
+        sum over pairs (b_i - b_j)(b_i - b_j)' = m * sum b_i b_i' - s s'
+    where s = sum b_i. The first term is summed over all the options at once
+    using the number of times each tmt occurs and the second is summed over 
+    blocks of choice sets, so only O(numEffects^2) memory is needed.
+    progress, if given, is stepped for each block.
+    '''
+    bint = np.asarray(bint)
+    (p, choicesetsize) = design.codes.shape
+    n = bint.shape[0]
+    # Use python integers if the sums could overflow 64 bit integers.
+    if 2 * p * choicesetsize**2 * int(np.abs(bint).max())**2 >= 2**62:
+        bint = bint.astype(object)
+    else:
+        bint = bint.astype(np.int64)
+
+    # get the index for each option in each choiceset
+    lind = index.columns_of_codes(design.codes.ravel()).reshape(p, choicesetsize)
+
+    counts = np.bincount(lind.ravel(), minlength=index.t)
+    cint = choicesetsize * np.dot(bint * counts, bint.T)
+    block = max(1, CHUNK_SIZE // (n * choicesetsize))
+    if progress:
+        progress.total = (p + block - 1) // block
+    for start in range(0, p, block):
+        sums = bint[:,lind[start:start+block]].sum(axis=2) # one column per choice set
+        cint = cint - np.dot(sums, sums.T)
+        if progress:
+            progress.step()
+    return cint
+
+
+###########################
+# Numerical engines for C
+###########################
+
+def bareiss(mat, progress=None):
+    '''
+    Fraction-free (Bareiss) Gauss-Jordan elimination of a square integer matrix.
+    All the arithmetic is done with python integers; every division is exact so
+    no fractions are ever formed.
+    Returns a tuple (rank, det, adj) where adj is the adjugate matrix as a list
+    of lists of integers i.e. inverse = adj/det. If the matrix is singular then
+    det is 0 and adj is None. progress, if given, is stepped for each column.
+    '''
+    n = len(mat)
+    # Augment with the identity matrix; the right hand side becomes the adjugate.
+    a = [[int(item) for item in mat[i]] + [int(i == j) for j in range(n)] for i in range(n)]
+    sign = 1    # changes for every row swap
+    prev = 1    # the previous pivot
+    row = 0     # the row the next pivot will be placed in
+    for col in range(n):
+        if progress:
+            progress.step()
+        # find a row with a nonzero entry in this column
+        pivot = None
+        for i in range(row, n):
+            if a[i][col] != 0:
+                pivot = i
+                break
+        if pivot is None:
+            # No pivot so the matrix is singular, but keep going to get the rank.
+            continue
+        if pivot != row:
+            a[row], a[pivot] = a[pivot], a[row]
+            sign = -sign
+        piv = a[row][col]
+        prow = a[row]
+        # eliminate this column from every other row, dividing exactly by prev
+        for i in range(n):
+            if i == row:
+                continue
+            ai = a[i]
+            factor = ai[col]
+            a[i] = [(piv * ai[j] - factor * prow[j]) // prev for j in range(2*n)]
+        prev = piv
+        row = row + 1
+
+    rank = row
+    if rank < n:
+        return (rank, 0, None)
+
+    # The left hand side is now det*I and the right hand side is det*inverse.
+    det = sign * prev
+    adj = [[sign * item for item in a[i][n:]] for i in range(n)]
+    return (rank, det, adj)
+
+
+def ldlt(mat, progress=None):
+    '''
+    Fraction-free symmetric (LDL') elimination of a square integer matrix that
+    is symmetric positive semidefinite, such as Cint. As for bareiss() all the
+    arithmetic is done with python integers and every division is exact.
+    The pivots are taken down the diagonal so no rows are swapped and, as 
+    each remaining block stays symmetric, only its upper triangle is updated. 
+    A zero pivot of a semidefinite matrix has a zero row which is skipped, so
+    the rank is the number of nonzero pivots. If C is nonsingular the 
+    adjugate is then found by back substitution, again only one triangle as 
+    it is symmetric too. This is about a quarter of the work of bareiss().
+    Returns a tuple (rank, det, adj) as for bareiss(), or None if the matrix 
+    turns out not to be symmetric positive semidefinite. progress, if given, 
+    is stepped for each column of the elimination and of the adjugate.
+    '''
+    n = len(mat)
+    a = [[int(item) for item in mat[i]] for i in range(n)]
+    if any([a[i][j] != a[j][i] for i in range(n) for j in range(i)]):
+        return None
+    # w[i] is row i of the identity after the same elimination, only the
+    # entries up to the diagonal can be nonzero.
+    w = [[int(i == j) for j in range(i+1)] for i in range(n)]
+    prev = 1    # the previous pivot
+    rank = 0
+    for k in range(n):
+        if progress:
+            progress.step()
+        piv = a[k][k]
+        if piv < 0:
+            return None
+        if piv == 0:
+            # The rest of the row must be zero too, if not it is not semidefinite.
+            if any(a[k][k+1:]):
+                return None
+            continue
+        prow = a[k]
+        pw = w[k]
+        # eliminate this column from every later row, dividing exactly by prev
+        for i in range(k+1, n):
+            factor = prow[i]  # a[i][k] as a[i] is the same as its column
+            ai = a[i]
+            wi = w[i]
+            if factor == 0:
+                ai[i:] = [(piv * item) // prev for item in ai[i:]]
+                wi[:] = [(piv * item) // prev for item in wi]
+            else:
+                ai[i:] = [(piv * x - factor * y) // prev for (x, y) in zip(ai[i:], prow[i:])]
+                wi[:k+1] = [(piv * x - factor * y) // prev for (x, y) in zip(wi[:k+1], pw)]
+                wi[k+1:] = [(piv * item) // prev for item in wi[k+1:]]
+        prev = piv
+        rank = rank + 1
+
+    if rank < n:
+        return (rank, 0, None)
+
+    # Row i is now sum(a[i][j]*x[j] for j >= i) = w[i]*b for the solution x
+    # of mat*x = b, and the pivots a[i][i] are the leading principal minors 
+    # with the last one the det. Column c of the adjugate is y = det*x for
+    # b = e_c and, as it is symmetric, only y[c:] are needed. 
+    det = prev
+    adj = [[0] * n for i in range(n)]
+    for c in range(n):
+        if progress:
+            progress.step()
+        y = [0] * n
+        for i in range(n-1, c-1, -1):
+            ai = a[i]
+            total = det * w[i][c] - sum([x * z for (x, z) in zip(ai[i+1:], y[i+1:])])
+            y[i] = total // ai[i]
+            adj[i][c] = adj[c][i] = y[i]
+    return (rank, det, adj)
+
+
+class SympyEngine(object):
+    '''
+    The original engine: C = B*Lambda*B' is formed from the normalised sympy
+    matrices and sympy is used for the determinant and inverse.
+    '''
+    def __init__(self, bmat, lmat):
+        super(SympyEngine,self).__init__()
+        self.msg = ''
+        self.cmat = bmat*lmat*bmat.T
+
+    def rank(self):
+        return np.linalg.matrix_rank(self.cmat)
+
+    def det(self):
+        return self.cmat.det()
+
+    def logdet(self):
+        return log_value(self.det())
+
+    def inv(self):
+        return self.cmat.inv()
+
+
+class ExactEngine(object):
+    '''
+    Exact engine using fraction-free integer elimination.
+    The normalised B is D*Bint where D = diag(1/sqrt(bnorms)) and Lambda is
+    Lint/lscale, so C = D*Cint*D/lscale where Cint = Bint*Lint*Bint' is the
+    integer matrix from accumulate_cint(). The rank, det and adjugate are found
+    together from Cint with ldlt(), or bareiss() if Cint is not semidefinite,
+    and the normalising constants and Lambda scale are only applied at the end.
+    The elimination is done by the first call of rank(), det() or inv() so it
+    is part of the rank stage of the progress.
+    '''
+    def __init__(self, cint, bnorms, lscale, progress=None):
+        super(ExactEngine,self).__init__()
+        cint = np.asarray(cint).tolist()
+        self.msg = ''
+        self.n = len(cint)
+        self.bnorms = [sympy.Rational(item) for item in bnorms]
+        self.lscale = lscale
+        self.progress = progress
+        self._cint = cint
+        self._rank = None
+
+        # sqrt(bnorms[i]*bnorms[j]) is used for every entry of C and C^-1
+        n = self.n
+        self._roots = [[sympy.sqrt(self.bnorms[i] * self.bnorms[j]) for j in range(n)] for i in range(n)]
+        self.cmat = sympy.Matrix(n, n, lambda i, j:
+            sympy.Rational(cint[i][j], lscale) / (self.bnorms[i] * self.bnorms[j]) * self._roots[i][j])
+
+    def eliminate(self):
+        ''' Finds the rank, det and adjugate of Cint if not done already. '''
+        if self._rank is None:
+            if self.progress:
+                self.progress.total = 2 * self.n
+            result = ldlt(self._cint, self.progress)
+            if result is None:
+                if self.progress:
+                    self.progress.total = self.progress.done + self.n
+                result = bareiss(self._cint, self.progress)
+            (self._rank, self._det, self._adj) = result
+
+    def rank(self):
+        self.eliminate()
+        return self._rank
+
+    def det(self):
+        self.eliminate()
+        if self._det == 0:
+            return sympy.Integer(0)
+        scale = sympy.Rational(self.lscale)**self.n
+        for item in self.bnorms:
+            scale = scale * item
+        return sympy.Rational(self._det) / scale
+
+    def logdet(self):
+        ''' Returns the natural log of det(C) from that of Cint without forming det(C). '''
+        self.eliminate()
+        with mpmath.workdps(LOG_DPS):
+            return log_value(self._det) - self.n * log_value(self.lscale) - mpmath.fsum([log_value(item) for item in self.bnorms])
+
+    def inv(self):
+        self.eliminate()
+        if self._adj is None:
+            raise ZeroDivisionError('Matrix det == 0; not invertible.')
+        n = self.n
+        return sympy.Matrix(n, n, lambda i, j:
+            sympy.Rational(self.lscale * self._adj[i][j], self._det) * self._roots[i][j])
+
+
+class FloatEngine(object):
+    '''
+    Fast float64 engine. C is a float ndarray and the rank, det
+    and inverse come from LAPACK (eigvalsh, slogdet and a Cholesky solve).
+    The results are returned as sympy matrices of floats so the rest of the 
+    calculation and the output formatting are unchanged.
+
+    If the rank decision or the condition number of C is borderline, or if an
+    entry of the inverse is too close to zero to decide if effects are
+    correlated, then self.borderline is set to a reason string and the
+    caller should use the exact engine instead.
+    '''
+    def __init__(self, cint, bnorms, lscale):
+        super(FloatEngine,self).__init__()
+        self.msg = 'Numeric engine: float64\n'
+        self.borderline = None
+        scale = 1/np.sqrt(np.array([float(item) for item in bnorms]))
+        cmat = np.array(np.asarray(cint).tolist(), dtype=float) * np.outer(scale, scale) / lscale
+        cmat = (cmat + cmat.T)/2  # C is symmetric, remove any rounding error
+        self.n = n = cmat.shape[0]
+        self.cmat = sympy.Matrix(cmat.tolist())
+
+        # The rank is the number of eigenvalues that are clearly nonzero.
+        eig = np.linalg.eigvalsh(cmat)
+        emax = np.abs(eig).max()
+        tol = emax * n * np.finfo(float).eps
+        self._rank = int(np.sum(eig > tol))
+        if np.any((np.abs(eig) > tol) & (np.abs(eig) < emax/FLOAT_COND_LIMIT)):
+            self.borderline = 'condition number of C is %.3g' % (emax/np.abs(eig).min())
+            return 
+        if self._rank < n:
+            return 
+
+        (sign, logdet) = np.linalg.slogdet(cmat)
+        self._det = sign * np.exp(logdet)
+        self._logdet = logdet
+
+        # Inverse from the Cholesky factor: C = L*L' so inv(C) = inv(L)'*inv(L)
+        lower = np.linalg.cholesky(cmat)
+        linv = np.linalg.solve(lower, np.eye(n))
+        cinv = np.dot(linv.T, linv)
+
+        # Entries below the rounding error of the inverse are zero. Any others 
+        # that are close to it can't be decided in floating point.
+        cond = emax/eig.min()
+        err = cond * n * np.finfo(float).eps * np.abs(cinv).max()
+        if np.any((np.abs(cinv) > err) & (np.abs(cinv) < 1000*err)):
+            self.borderline = 'inverse of C has entries close to zero'
+            return 
+        cinv[np.abs(cinv) <= err] = 0
+        self._cinv = sympy.Matrix(cinv.tolist())
+
+    def rank(self):
+        return self._rank
+
+    def det(self):
+        if self._rank < self.n:
+            return 0.0
+        return self._det
+
+    def logdet(self):
+        if self._rank < self.n:
+            return -np.inf
+        return self._logdet
+
+    def inv(self):
+        if self._rank < self.n:
+            raise ZeroDivisionError('Matrix det == 0; not invertible.')
+        return self._cinv
+
+
+def make_engine(bmat, lmat, cint, bnorms, lscale, numeric='exact', progress=None):
+    '''
+    Returns the engine selected by numeric for calculating C, its rank,
+    determinant and inverse. bmat and lmat are the normalised sympy matrices,
+    which are only used by the sympy engine, cint is the integer matrix from 
+    accumulate_cint(), bnorms are the squared normalising constants of each 
+    row of B and lscale is the Lambda scale p*m^2.
+    The float engine escalates to the exact engine if its result is borderline.
+    Each engine has a msg which says which engine produced the result. 
+    progress is passed to the exact engine.
+    '''
+    if numeric == 'sympy':
+        return SympyEngine(bmat, lmat)
+    elif numeric == 'float':
+        engine = FloatEngine(cint, bnorms, lscale)
+        if not engine.borderline:
+            return engine
+        reason = engine.borderline
+        engine = ExactEngine(cint, bnorms, lscale, progress)
+        engine.msg = 'Numeric engine: exact (float64 was borderline, %s)\n' % reason
+        return engine
+    else:
+        return ExactEngine(cint, bnorms, lscale, progress)
+
+
+###############################
+# Incremental design evaluation
+###############################
+
+class IncrementalDesign(object):
+    '''
+    Keeps C for a design so that when a few choice sets are added, removed or
+    swapped the new det(C), efficiency and C^-1 are found without recalculating
+    them. As in accumulate_cint() a choice set whose options have the integer
+    B columns b_1 .. b_m adds to Cint
+        U*M*U'  where U = [b_1 - b_m, .., b_(m-1) - b_m] and M = m*I - J
+    which has rank m-1. Cint is updated exactly as integers and its float 
+    inverse and log det with the Woodbury identity and the matrix determinant
+    lemma, so each change costs O(numEffects^2 * m) instead of a new 
+    calculation. The inverse is recalculated from Cint after REFRESH_UPDATES
+    updates, or when an update is badly conditioned e.g. removing a set makes
+    C singular. exact() gives the exact engine for the current design, whose
+    results are the same as the full calculation's.
+
+    Repeated choice sets are counted once, as the calculation removes them,
+    so p is the number of different choice sets. choose2fis are the 1-based
+    pairs of factors of the two factor interactions in the model.
+    '''
+    def __init__(self, levels, msize, choose2fis=(), chsets=None):
+        super(IncrementalDesign,self).__init__()
+        self.levels = [int(item) for item in levels]
+        self.msize = int(msize)
+        self.choose2fis = [tuple(item) for item in choose2fis]
+        self.orthogpolys = construct_poly_contrasts()
+        self.bnorms = contrast_norms(self.levels, self.choose2fis)
+        self.n = n = len(self.bnorms)
+        self.counts = {}  # the number of times each choice set has been added
+        self.p = 0
+        self.cint = np.zeros((n, n), dtype=np.int64)
+        self.maxb = 0     # the largest entry of B so far
+        # M^-1 = (I + J)/m and det(M) = m^(m-2)
+        m = self.msize
+        self.minv = (np.eye(m-1) + np.ones((m-1, m-1)))/float(m)
+        self.logdet_m = (m - 2) * np.log(m)
+        self._inv = None  # the float inverse of Cint, None if it must be recalculated
+        self.updates = 0
+        self.columns = {}  # the B column of each tmt code used so far
+        if chsets is not None:
+            for row in np.asarray(chsets).tolist():
+                self.add(row)
+
+    def set_key(self, row):
+        ''' Returns the tmt codes of the options of a choice set given as a row of in_chsets.dat '''
+        design = Design.from_rows([row], self.levels, self.msize)
+        if len(design.repeats()) > 0:
+            raise ValueError('Repeated treatment combination in choice set %s.' % ' '.join([str(item) for item in row]))
+        return tuple(design.codes[0].tolist())
+
+    def contribution(self, key):
+        ''' Returns U for the choice set with these tmt codes, as integers. '''
+        new = [code for code in key if code not in self.columns]
+        if new:
+            tmts = decode_treatments(new, self.levels)
+            bcols = np.asarray(construct_bmat(tmts, self.levels, self.choose2fis, self.orthogpolys))
+            self.maxb = max(self.maxb, int(np.abs(bcols).max()))
+            for (i, code) in enumerate(new):
+                self.columns[code] = bcols[:,i]
+        bcols = np.column_stack([self.columns[code] for code in key])
+        return bcols[:,:-1] - bcols[:,-1:]
+
+    def update(self, key, sign):
+        ''' Adds (sign 1) or removes (sign -1) the contribution of a choice set. '''
+        u = self.contribution(key)
+        m = self.msize
+        # Use python integers if the sums could overflow 64 bit integers.
+        if self.cint.dtype != object and 2 * (self.p + 1) * m**2 * self.maxb**2 >= 2**62:
+            self.cint = self.cint.astype(object)
+        if self.cint.dtype == object:
+            u = u.astype(object)
+        usum = u.sum(axis=1).reshape(-1, 1)
+        self.cint = self.cint + sign * (m * np.dot(u, u.T) - np.dot(usum, usum.T))
+
+        if self._inv is None:
+            return  # it is recalculated when it is next needed
+        # Woodbury: (A + s*U*M*U')^-1 = A^-1 - W*S^-1*W' where W = A^-1*U and
+        # S = s*M^-1 + U'*W, and det(A + s*U*M*U') = det(A)*det(S)*det(s*M).
+        u = np.array(u.tolist(), dtype=float)
+        w = np.dot(self._inv, u)
+        s = sign * self.minv + np.dot(u.T, w)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            cond = np.linalg.cond(s)
+        if not cond <= FLOAT_COND_LIMIT:  # also if it is nan
+            self._inv = None
+            return
+        (s_sign, s_logdet) = np.linalg.slogdet(s)
+        self._inv = self._inv - np.dot(w, np.linalg.solve(s, w.T))
+        self._inv = (self._inv + self._inv.T)/2
+        self._sign = self._sign * s_sign * sign**(m-1)
+        self._logdet = self._logdet + s_logdet + self.logdet_m
+        # The rounding errors add up so start again from Cint now and then.
+        self.updates = self.updates + 1
+        if self.updates >= REFRESH_UPDATES:
+            self._inv = None
+            self.refresh()
+
+    def refresh(self):
+        ''' Recalculates the rank, log det and inverse of Cint from Cint. '''
+        if self._inv is not None:
+            return
+        cint = np.array(self.cint.tolist(), dtype=float)
+        eig = np.linalg.eigvalsh(cint)
+        emax = np.abs(eig).max()
+        tol = emax * self.n * np.finfo(float).eps
+        self._rank = int(np.sum(eig > tol))
+        self.updates = 0
+        if self._rank < self.n:
+            return
+        (self._sign, self._logdet) = np.linalg.slogdet(cint)
+        self._inv = np.linalg.inv(cint)
+
+    def add(self, row):
+        ''' Adds a choice set given as a row of in_chsets.dat '''
+        self.add_codes(self.set_key(row))
+
+    def remove(self, row):
+        ''' Removes a choice set given as a row of in_chsets.dat '''
+        self.remove_codes(self.set_key(row))
+
+    def swap(self, old, new):
+        ''' Replaces the choice set old with new. '''
+        self.swap_codes(self.set_key(old), self.set_key(new))
+
+    def score_swap(self, old, new):
+        ''' As for score_swap_codes() with the choice sets as rows of in_chsets.dat '''
+        return self.score_swap_codes(self.set_key(old), self.set_key(new))
+
+    def add_codes(self, key):
+        ''' Adds a choice set given as the tuple of the tmt codes of its options. '''
+        self.counts[key] = self.counts.get(key, 0) + 1
+        if self.counts[key] == 1:
+            self.update(key, 1)
+            self.p = self.p + 1
+
+    def remove_codes(self, key):
+        ''' Removes a choice set given as the tuple of the tmt codes of its options. '''
+        if key not in self.counts:
+            rows = decode_treatments(key, self.levels).ravel().tolist()
+            raise ValueError('Choice set %s is not in the design.' % ' '.join([str(item) for item in rows]))
+        self.counts[key] = self.counts[key] - 1
+        if self.counts[key] == 0:
+            del self.counts[key]
+            self.update(key, -1)
+            self.p = self.p - 1
+
+    def swap_codes(self, old, new):
+        ''' Replaces the choice set with the tmt codes old with new. '''
+        self.remove_codes(old)
+        self.add_codes(new)
+
+    def score(self):
+        ''' Returns (rank, log det) of C, which sort in the order of better designs. '''
+        return (self.rank(), self.logdet())
+
+    def score_swap_codes(self, old, new):
+        '''
+        Returns the score() the design would have if the choice set old was 
+        replaced by new, without changing the design. When C stays nonsingular
+        the swap is a rank 2(m-1) update so its det is found with the matrix
+        determinant lemma, in O(numEffects^2 * m), otherwise the swap is made
+        and then undone.
+        '''
+        self.refresh()
+        if self._inv is not None and self.counts.get(old) == 1 and new not in self.counts:
+            m = self.msize
+            u = np.array(np.hstack([self.contribution(old), self.contribution(new)]).tolist(), dtype=float)
+            # the inverse of diag(-M, M) 
+            minv = np.zeros((2*(m-1), 2*(m-1)))
+            minv[:m-1,:m-1] = -self.minv
+            minv[m-1:,m-1:] = self.minv
+            s = minv + np.dot(u.T, np.dot(self._inv, u))
+            (s_sign, s_logdet) = np.linalg.slogdet(s)
+            # det(diag(-M, M)) = (-1)^(m-1) * det(M)^2 and det(C) must stay positive
+            if s_sign * (-1)**(m-1) > 0:
+                logdet = self._logdet + s_logdet + 2 * self.logdet_m
+                logdet = logdet - np.sum(np.log(self.bnorms)) - self.n * np.log(self.lscale())
+                if logdet > self.logdet() - np.log(FLOAT_COND_LIMIT):
+                    return (self.n, logdet)
+            # else C is singular or nearly so and the rank has to be found
+        self.swap_codes(old, new)
+        score = self.score()
+        self.swap_codes(new, old)
+        return score
+
+    def lscale(self):
+        ''' The Lambda scale p*m^2, C = D*Cint*D/lscale '''
+        return self.p * self.msize**2
+
+    def rank(self):
+        self.refresh()
+        if self._inv is not None:
+            return self.n
+        return self._rank
+
+    def logdet(self):
+        ''' Returns the natural log of det(C), or -inf if C is singular. '''
+        self.refresh()
+        if self._inv is None or self._sign <= 0:
+            return -np.inf
+        return self._logdet - np.sum(np.log(self.bnorms)) - self.n * np.log(self.lscale())
+
+    def det(self):
+        ''' Returns det(C) as a float. '''
+        return float(np.exp(self.logdet()))
+
+    def inv(self):
+        ''' Returns C^-1 as a float ndarray, C^-1 = lscale * D^-1 * Cint^-1 * D^-1 '''
+        self.refresh()
+        if self._inv is None:
+            raise ZeroDivisionError('Matrix det == 0; not invertible.')
+        roots = np.sqrt(np.array(self.bnorms, dtype=float))
+        return self.lscale() * self._inv * np.outer(roots, roots)
+
+    def efficiency(self, optdet):
+        ''' Returns the efficiency in % compared with a design whose det(C) is optdet. '''
+        if self.rank() < self.n:
+            return 0.0
+        return log_efficiency(self.logdet(), log_value(optdet), self.n)
+
+    def exact(self, progress=None):
+        ''' Returns the ExactEngine for the current design. '''
+        return ExactEngine(self.cint, self.bnorms, self.lscale(), progress)
+
+
 #########################################
 # Here are the main calculation functions
 #########################################
 
+@cancellable
 def CheckSets_MainEffects(inputs):
     '''
     inputs:  a dictionary of all input variables, in this case: 
@@ -454,7 +1826,9 @@ def CheckSets_MainEffects(inputs):
     optdet = 1  # optimal det
     
     # Create formatted outputs vars as a dictionary.
-    outputs = {}
+    outputs = Outputs()
+    progress = inputs['progress']
+    progress.outputs = outputs
     
     # The text of this message string will be printed to the browser 
     msg = '' 
@@ -470,10 +1844,20 @@ def CheckSets_MainEffects(inputs):
     # Construct the othogonal polynomial contrasts.
     orthogpolys = construct_poly_contrasts()
     
+    progress.start('parse', msg)
+
+    # the choice sets as mixed-radix tmt codes, one row per choice set
+    try:
+        design = Design.from_rows(choicesets, levels, choicesetsize)
+    except ValueError as e:
+        msg += '%s\n' % e
+        msg += 'Cannot continue calculation.\n'
+        outputs['msg'] = msg
+        return outputs
+    
     # check that each choiceset is made up of unique tmts
-    for i in range(len(choicesets)): # loop through each choice set
-        if len(unique(np.matrix(choicesets[i]).reshape(choicesetsize, factors))) != choicesetsize:
-            msg += 'Repeated treatment combination in choice set %d.\n' % (i+1)
+    for i in design.repeats():
+        msg += 'Repeated treatment combination in choice set %d.\n' % (i+1)
     
     if msg != '':
         msg += 'Cannot continue calculation.\n'
@@ -481,24 +1865,16 @@ def CheckSets_MainEffects(inputs):
         return outputs
     
     # construct a matrix of all unique tmt combinations
-    allTmts = unique(np.matrix(choicesets).reshape(choicesetsize * p, factors)) 
+    allTmts = np.matrix(design.treatments())
     # recalculate the number of tmt combinations
     t = len(allTmts) 
+    # index from each tmt combination to its column in B
+    index = TreatmentIndex(allTmts, levels)
     
-    # within each choiceset, sort the options lexicographically
-    choicesets = [lexico(np.matrix(item)) for item in choicesets] 
-    # reshape the choicesets into a 2D matrix
-    choicesets = np.vstack([np.hstack(item) for item in choicesets]) 
-    
-    # check for duplicates
-    dup = [] # a list of duplicate choicesets
-    # loop through each choiceset except the last
-    for i in range(len(choicesets)-1): 
-        # loop through each remaining choiceset 
-        for j in range(i+1, len(choicesets)): 
-            # check if all entries are the same in both choicesets
-            if all([choicesets[i,k]==choicesets[j,k] for k in range(np.shape(choicesets[i])[1])]): 
-                dup.append(j+1) # append to the list
+    progress.start('duplicates', msg)
+
+    # check for duplicates, the options must match in the order given
+    dup = design.duplicates() # a list of duplicate choicesets
     
     if len(dup) > 0:
         if len(dup) == 1:
@@ -507,101 +1883,60 @@ def CheckSets_MainEffects(inputs):
             tmp = str(list(np.sort(dup))).replace('[','').replace(']','')
             msg += 'Warning: choice sets %s are duplicates.\n' % tmp
     
-    choicesets = unique(choicesets) # remove repeated rows (if any)
-    p = len(choicesets) # number of unique choice sets
+    design = design.unique() # remove repeated rows (if any)
+    p = len(design) # number of unique choice sets
     
     # update output info
     msg += 'Number of choicesets: %d \n' % p
     
+    progress.start('B matrix', msg)
+
     # construct the b matrix
-    bmat = np.matrix([0 for i in np.arange(numEffects * t)]).reshape(numEffects, t) 
-    
-    # define the main effects contrasts
-    for tmt in range(t): # loop through each tmt 
-        TopRow = 0
-        for f in range(factors): # loop through each factor
-            BottomRow = TopRow
-            TopRow = TopRow + levels[f] - 1
-            # get the orthogonal polynomial contrasts for the given factor
-            poly = orthogpolys[levels[f] - 2] 
-            # assign the main effects
-            bmat[BottomRow:TopRow,tmt] = poly[:,allTmts[tmt,f]] 
-    
-    # convert to sympy
-    bmat = sympy.Matrix(bmat)
-    levels = sympy.Matrix(levels)
-    
-    # normalise the main effects 
-    TopRow = 0
-    for f in range(factors): # loop through each factor
-        BottomRow = TopRow
-        TopRow = TopRow + levels[f] - 1
-        # get the orthogonal polynomial contrasts for the given factor
-        poly =  sympy.Matrix(orthogpolys[levels[f] - 2]) 
-        # calculate the normalising constant for each component
-        norm = [sympy.sqrt(sum(([innerItem**2 for innerItem in poly[item,:]])*np.prod(levels))/levels[f]) for item in range(poly.shape[0])] 
-        # normalise
-        bmat[BottomRow:TopRow,:] = [bmat[BottomRow:TopRow,:][i,:]/norm[i] for i in range(len(norm))] 
-    
-    # construct the lambda matrix
-    # initialise a matrix
-    lmat = np.matrix([0 for i in np.arange(t * t)]).reshape(t, t) 
-    # initialise an array of indicies
-    lind = np.matrix([0 for i in np.arange(p * choicesetsize)]).reshape(p, choicesetsize) 
+    bmat = construct_bmat(allTmts, levels, [], orthogpolys)
     
-    # get the index for each option in each choiceset
-    for ch in range(p): # loop through each choiceset
-        EndCol = 0
-        for op in range(choicesetsize): # loop thought each option in the choiceset
-            StartCol = EndCol
-            EndCol = StartCol + factors
-            for tmt in range(t): # loop though each tmt
-                if all([choicesets[ch,StartCol+k] == allTmts[tmt,k] for k in range(factors)]): 
-                    lind[ch,op] = tmt 
-    
-    # calculate lambda
-    for ch in range(p): # loop through each choiceset
-        for i in range(choicesetsize-1): # loop through each option except the last
-            for j in range(i+1, choicesetsize): # loop through each remaining option
-                lmat[lind[ch,i], lind[ch,j]] = lmat[lind[ch,i], lind[ch,j]] - 1
-                lmat[lind[ch,j], lind[ch,i]] = lmat[lind[ch,j], lind[ch,i]] - 1
+    # keep the integer contrasts and their squared norms for the exact engine
+    bint = bmat
+    bnorms = contrast_norms(levels, [])
     
-    # calculate the diagonal entries of lambda
-    for diag in range(t):
-        lmat[diag,diag] = -np.sum(lmat[diag])
+    # normalise each row of B and convert to sympy
+    bmat = normalise_bmat(bint, bnorms)
+    levels = sympy.Matrix(levels)
     
-    lmat = sympy.Matrix(lmat)/(p*np.power(choicesetsize,2))
+    progress.start('Lambda matrix', msg)
+
+    # construct the lambda matrix, only if it is written out or used by sympy
+    lmat = None
+    if inputs.get('out_lmat', True) or inputs.get('numeric', 'exact') == 'sympy':
+        lmat = rational_matrix(construct_lambda(design, index), p*choicesetsize**2, progress)
     
     # Save bmat and lmat.
-    rows = ''
-    rows += ''.join(str(bmat)).replace('[','').replace(']','').replace(',','') + '\n'
-    outputs['bmat'] = rows
+    save_matrix(outputs, 'bmat', bmat)
     
-    rows = ''
-    rows += ''.join(str(lmat)).replace('[','').replace(']','').replace(',','') + '\n'
-    outputs['lmat'] = rows
+    if inputs.get('out_lmat', True):
+        save_matrix(outputs, 'lmat', lmat)
   
-    # Exit if this calc is taking too long.
-    if (datetime.now() - START).seconds > MAX_TIME: 
-        msg += 'Calculation is taking too long ... exiting.\n'
-        outputs['msg'] = msg
-        return outputs 
+    # Exit if this calc is taking too long or was cancelled.
+    progress.start('C matrix', msg)
+    
+    # accumulate the c matrix, before normalisation, over the choice sets
+    cint = accumulate_cint(bint, design, index, progress)
     
     # calculate the c matrix
     try:
-        cmat = bmat*lmat*bmat.T # the c matrix
-    except:
+        engine = make_engine(bmat, lmat, cint, bnorms, p*choicesetsize**2, inputs.get('numeric', 'exact'), progress)
+        cmat = engine.cmat # the c matrix
+        msg += engine.msg
+    except Exception:
         msg += 'Unable to calculate the C matrix.\n'
         msg += 'Cannot continue calculation.\n'
         outputs['msg'] = msg
         return outputs 
        
-    cRank = np.linalg.matrix_rank(cmat) # the rank of the c matrix
+    progress.start('rank', msg)
+    cRank = engine.rank() # the rank of the c matrix
     
     # Save cmat
-    rows = ''
-    rows += ''.join(str(cmat)).replace('[','').replace(']','').replace(',','') + '\n'
-    outputs['cmat'] = rows
+    save_matrix(outputs, 'cmat', cmat)
     
     # check the c matrix is of sufficient rank
     if cRank < numEffects:
@@ -613,9 +1948,10 @@ Efficiency compared with optimal design for optimal choice set size m = %s: 0%%\
         outputs['msg'] = msg
         return outputs 
     
+    progress.start('det', msg)
     try:
-        detc = cmat.det() # the determinant of the c matrix
-    except:
+        detc = engine.det() # the determinant of the c matrix
+    except Exception:
         msg += 'Unable to calculate the determinant of the C matrix\n' 
         msg += 'Cannot continue calculation.\n'
         outputs['msg'] = msg
@@ -623,53 +1959,38 @@ Efficiency compared with optimal design for optimal choice set size m = %s: 0%%\
     
     msg += 'Det C is: %s \n' % str(float(detc))
     
+    progress.start('inverse', msg)
     try:
-        cinv = cmat.inv() # invert the c matrix
-    except:
+        cinv = engine.inv() # invert the c matrix
+    except Exception:
         msg += 'Unable to calculate the inverse of the C matrix\n'  
         msg += 'Cannot continue calculation.\n'
         outputs['msg'] = msg
         return outputs 
     
+    progress.start('correlation', msg, numEffects)
     # initialise a matrix
     correln = np.matrix([0 for i in np.arange(numEffects * numEffects)]).reshape(numEffects, numEffects) 
     correln = sympy.Matrix(correln)     # convert to sympy
     for i in range(numEffects):         # loop through each row
+        progress.step()
         for j in range(numEffects):     # loop through each column
             correln[i, j] = cinv[i, j]/sympy.sqrt(cinv[i, i] * cinv[j, j])
     
     # Save cinv and correln.
-    rows = ''
-    rows += ''.join(str(cinv)).replace('[','').replace(']','').replace(',','') + '\n'
-    outputs['cinv'] = rows     
-    rows = ''
-    rows += ''.join(str(correln)).replace('[','').replace(']','').replace(',','') + '\n'
-    outputs['correln'] = rows
-    
-    # calculate the determinant of the optimal design
-    prodlevels = np.product(levels)
-    Sumdiffs = list(np.repeat(0, factors))
-    optdet = 1
-    optdet2 = np.power((1/prodlevels), numEffects)
-    for q in range(factors):
-        if levels[q] == 2:
-            if choicesetsize%2 == 0:
-                Sumdiffs[q] = np.power(choicesetsize, 2)/4
-            else:
-                Sumdiffs[q] = (np.power(choicesetsize, 2) - 1)/4
-        else:
-            if levels[q] >= choicesetsize:
-                Sumdiffs[q] = choicesetsize * (choicesetsize - 1)/2
-            else:
-                x = choicesetsize//levels[q]
-                y = choicesetsize%levels[q]
-                Sumdiffs[q] = (np.power(choicesetsize, 2) - (levels[q] * np.power(x, 2) + 2 * x * y + y))/2
-        optdet = optdet * np.power(((2 * levels[q] * Sumdiffs[q])/(np.power(choicesetsize, 2) * (levels[q] - 1) * prodlevels)), (levels[q] - 1))
+    save_matrix(outputs, 'cinv', cinv)
+    save_matrix(outputs, 'correln', correln)
+    
+    progress.start('flags', msg)
+    
+    # calculate the log of the determinant of the optimal design
+    (logoptdet, logoptdet2) = log_optimal_det_main(levels, choicesetsize)
     
     # calculate efficiency
-    if detc > 0 and optdet > 0:
-       eff = 100*np.power(detc/optdet,sympy.Rational(1, numEffects))
-       eff2 = 100*np.power(detc/optdet2,sympy.Rational(1, numEffects))
+    if detc > 0:
+       logdet = engine.logdet()
+       eff = log_efficiency(logdet, logoptdet, numEffects)
+       eff2 = log_efficiency(logdet, logoptdet2, numEffects)
        # output to user
        msg += 'Efficiency compared with optimal design for choice set size m = %s: %s%% \n' % (choicesetsize, round(eff, 6))
        msg += 'Efficiency compared with optimal design for optimal choice set size m = %s: %s%% \n' % (lcm(levels), round(eff2, 6))
@@ -698,6 +2019,7 @@ Efficiency compared with optimal design for optimal choice set size m = %s: 0%%\
     return outputs
 
     
+@cancellable
 def CheckSets_All2fis(inputs):
     '''
     inputs:  a dictionary of all input variables, in this case: 
@@ -712,7 +2034,9 @@ def CheckSets_All2fis(inputs):
     optdet = inputs['det']
     
     # Create formatted outputs vars as a dictionary.
-    outputs = {}
+    outputs = Outputs()
+    progress = inputs['progress']
+    progress.outputs = outputs
     
     # The text of this message string will be printed to the browser 
     msg = '' 
@@ -731,10 +2055,20 @@ def CheckSets_All2fis(inputs):
     # Construct the othogonal polynomial contrasts.
     orthogpolys = construct_poly_contrasts()
     
+    progress.start('parse', msg)
+
+    # the choice sets as mixed-radix tmt codes, one row per choice set
+    try:
+        design = Design.from_rows(choicesets, levels, choicesetsize)
+    except ValueError as e:
+        msg += '%s\n' % e
+        msg += 'Cannot continue calculation.\n'
+        outputs['msg'] = msg
+        return outputs
+    
     # check that each choiceset is made up of unique tmts
-    for i in range(len(choicesets)): # loop through each choice set
-        if len(unique(np.matrix(choicesets[i]).reshape(choicesetsize, factors))) != choicesetsize:
-            msg += 'Repeated treatment combination in choice set %d.\n' % (i+1)
+    for i in design.repeats():
+        msg += 'Repeated treatment combination in choice set %d.\n' % (i+1)
     
     if msg != '':
        msg += 'Cannot continue calculation.\n'
@@ -742,23 +2076,15 @@ def CheckSets_All2fis(inputs):
        return outputs
     
     # construct a matrix of all unique tmt combinations
-    allTmts = unique(np.matrix(choicesets).reshape(choicesetsize * p, factors)) 
+    allTmts = np.matrix(design.treatments())
     t = len(allTmts) # recalculate the number of tmt combinations
+    # index from each tmt combination to its column in B
+    index = TreatmentIndex(allTmts, levels)
     
-    # within each choiceset, sort the options lexicographically
-    choicesets = [lexico(np.matrix(item)) for item in choicesets] 
-    # reshape the choicesets into a 2D matrix
-    choicesets = np.vstack([np.hstack(item) for item in choicesets]) 
-    
-    # check for duplicates
-    dup = [] # a list of duplicate choicesets
-    # loop through each choiceset except the last
-    for i in range(len(choicesets)-1): 
-        # loop through each remaining choiceset 
-        for j in range(i+1, len(choicesets)): 
-            # check if all entries are the same in both choicesets
-            if all([choicesets[i,k]==choicesets[j,k] for k in range(np.shape(choicesets[i])[1])]): 
-                dup.append(j+1) # append to the list
+    progress.start('duplicates', msg)
+
+    # check for duplicates, the options must match in the order given
+    dup = design.duplicates() # a list of duplicate choicesets
     
     if len(dup) > 0:
        if len(dup) == 1:
@@ -767,137 +2093,60 @@ def CheckSets_All2fis(inputs):
           tmp = str(list(np.sort(dup))).replace('[','').replace(']','')
           msg += 'Warning: choice sets %s are duplicates.\n' % tmp
     
-    choicesets = unique(choicesets) # remove repeated rows (if any)
-    p = len(choicesets) # number of unique choice sets
+    design = design.unique() # remove repeated rows (if any)
+    p = len(design) # number of unique choice sets
     
     # update output info
     msg += 'Number of choicesets: %d \n' % p
     
+    progress.start('B matrix', msg)
+
     # construct the b matrix
-    # initialise a matrix
-    bmat = np.matrix([0 for i in np.arange(numEffects * t)]).reshape(numEffects, t) 
-    
-    # define the main effects contrasts
-    for tmt in range(t): # loop through each tmt 
-        TopRow = 0
-        for f in range(factors): # loop through each factor
-            BottomRow = TopRow
-            TopRow = TopRow + levels[f] - 1
-            # get the orthogonal polynomial contrasts for the given factor
-            poly = orthogpolys[levels[f] - 2] 
-            # assign the main effects
-            bmat[BottomRow:TopRow,tmt] = poly[:,allTmts[tmt,f]] 
-       
-    # define the interaction contrasts
-    if len(choose2fis) > 0:
-       RowIndex = numME
-       for i in range(len(choose2fis)): # loop through each interaction
-            # get the orthogonal polynomial contrasts for the first factor
-            poly1 = orthogpolys[levels[choose2fis[i][0]-1] - 2] 
-            # get the orthogonal polynomial contrasts for the second factor
-            poly2 = orthogpolys[levels[choose2fis[i][1]-1] - 2] 
-            # loop through each main effect contrast of the first factor
-            for me1 in range(len(poly1)): 
-                # loop through each main effect contrast of the second factor
-                for me2 in range(len(poly2)): 
-                    for tmt in range(t): # loop through each tmt 
-                        # define the interaction contrast componenet
-                        bmat[RowIndex,tmt] = poly1[me1,allTmts[tmt,choose2fis[i][0]-1]] * poly2[me2,allTmts[tmt,choose2fis[i][1]-1]] 
-                    RowIndex = RowIndex + 1    
-    
-    # convert to sympy
-    bmat = sympy.Matrix(bmat)
-    levels = sympy.Matrix(levels)
+    bmat = construct_bmat(allTmts, levels, choose2fis, orthogpolys)
     
-    # normalise the main effects 
-    TopRow = 0
-    for f in range(factors): # loop through each factor
-        BottomRow = TopRow
-        TopRow = TopRow + levels[f] - 1
-        # get the orthogonal polynomial contrasts for the given factor
-        poly =  sympy.Matrix(orthogpolys[levels[f] - 2]) 
-        norm = [sympy.sqrt(sum(([innerItem**2 for innerItem in poly[item,:]])*np.prod(levels))/levels[f]) for item in range(poly.shape[0])]  # calculate the normalising constant for each component
-        # normalise
-        bmat[BottomRow:TopRow,:] = [bmat[BottomRow:TopRow,:][i,:]/norm[i] for i in range(len(norm))] 
-    
-    # normalise the interactions
-    if len(choose2fis) > 0:
-        RowIndex = numME
-        # loop through each interaction
-        for i in range(len(choose2fis)): 
-            # get the orthogonal polynomial contrasts for the first factor
-            poly1 = orthogpolys[levels[choose2fis[i][0]-1] - 2] 
-            # get the orthogonal polynomial contrasts for the second factor
-            poly2 = orthogpolys[levels[choose2fis[i][1]-1] - 2] 
-            # loop through each main effect contrast of the first factor
-            for me1 in range(poly1.shape[0]): 
-                # loop through each main effect contrast of the second factor
-                for me2 in range(poly2.shape[0]): 
-                    # define... a thing
-                    poly = [poly1[me1,lv1] * poly2[me2,lv2] for lv1 in range(poly1.shape[1]) for lv2 in range(poly2.shape[1])] 
-                    # calculate the normalising constant 
-                    norm = sympy.sqrt(sum(([innerItem**2 for innerItem in poly])*np.prod(levels))/(levels[choose2fis[i][0]-1] * levels[choose2fis[i][1]-1]))  
-                    bmat[RowIndex,:] = bmat[RowIndex,:]/norm # normalise
-                    RowIndex = RowIndex + 1
-    
-    # construct the lambda matrix
-    lmat = np.matrix([0 for i in np.arange(t * t)]).reshape(t, t) 
-    # initialise an array of indicies
-    lind = np.matrix([0 for i in np.arange(p * choicesetsize)]).reshape(p, choicesetsize) 
+    # keep the integer contrasts and their squared norms for the exact engine
+    bint = bmat
+    bnorms = contrast_norms(levels, choose2fis)
     
-    # get the index for each option in each choiceset
-    for ch in range(p): # loop through each choiceset
-        EndCol = 0
-        for op in range(choicesetsize): # loop thought each option in the choiceset
-            StartCol = EndCol
-            EndCol = StartCol + factors
-            for tmt in range(t): # loop thought each tmt
-                if all([choicesets[ch,StartCol+k] == allTmts[tmt,k] for k in range(factors)]): 
-                    lind[ch,op] = tmt 
-    
-    # calculate lambda
-    for ch in range(p): # loop through each choiceset
-        for i in range(choicesetsize-1): # loop through each option except the last
-            for j in range(i+1, choicesetsize): # loop through each remaining option
-                lmat[lind[ch,i], lind[ch,j]] = lmat[lind[ch,i], lind[ch,j]] - 1
-                lmat[lind[ch,j], lind[ch,i]] = lmat[lind[ch,j], lind[ch,i]] - 1
-    
-    # calculate the diagonal entries of lambda
-    for diag in range(t):
-        lmat[diag,diag] = -np.sum(lmat[diag])
+    # normalise each row of B and convert to sympy
+    bmat = normalise_bmat(bint, bnorms)
+    levels = sympy.Matrix(levels)
     
-    lmat = sympy.Matrix(lmat)/(p*(choicesetsize**2))
+    progress.start('Lambda matrix', msg)
+
+    # construct the lambda matrix, only if it is written out or used by sympy
+    lmat = None
+    if inputs.get('out_lmat', True) or inputs.get('numeric', 'exact') == 'sympy':
+        lmat = rational_matrix(construct_lambda(design, index), p*choicesetsize**2, progress)
     
     # Save bmat and lmat.
-    rows = ''
-    rows += ''.join(str(bmat)).replace('[','').replace(']','').replace(',','') + '\n'
-    outputs['bmat'] = rows
+    save_matrix(outputs, 'bmat', bmat)
     
-    rows = ''
-    rows += ''.join(str(lmat)).replace('[','').replace(']','').replace(',','') + '\n'
-    outputs['lmat'] = rows
+    if inputs.get('out_lmat', True):
+        save_matrix(outputs, 'lmat', lmat)
     
-    # Exit if this calc is taking too long.
-    if (datetime.now() - START).seconds > MAX_TIME: 
-        msg += 'Calculation is taking too long ... exiting.\n'
-        outputs['msg'] = msg
-        return outputs 
+    # Exit if this calc is taking too long or was cancelled.
+    progress.start('C matrix', msg)
+    
+    # accumulate the c matrix, before normalisation, over the choice sets
+    cint = accumulate_cint(bint, design, index, progress)
     
     # calculate the c matrix
     try:
-        cmat = bmat*lmat*bmat.T # the c matrix
-    except:
+        engine = make_engine(bmat, lmat, cint, bnorms, p*choicesetsize**2, inputs.get('numeric', 'exact'), progress)
+        cmat = engine.cmat # the c matrix
+        msg += engine.msg
+    except Exception:
         msg += 'Unable to calculate the C matrix.\n'
         msg += 'Cannot continue calculation.\n'
         outputs['msg'] = msg
         return outputs 
     
-    cRank = np.linalg.matrix_rank(cmat) # the rank of the c matrix
+    progress.start('rank', msg)
+    cRank = engine.rank() # the rank of the c matrix
     
     # Save cmat
-    rows = ''
-    rows += ''.join(str(cmat)).replace('[','').replace(']','').replace(',','') + '\n'
-    outputs['cmat'] = rows
+    save_matrix(outputs, 'cmat', cmat)
     
     # check the c matrix is of sufficient rank
     if cRank < numEffects:
@@ -906,9 +2155,10 @@ def CheckSets_All2fis(inputs):
         outputs['msg'] = msg
         return outputs 
     
+    progress.start('det', msg)
     try:
-        detc = cmat.det() # the determinant of the c matrix
-    except:
+        detc = engine.det() # the determinant of the c matrix
+    except Exception:
         msg += 'Unable to calculate the determinant of the C matrix\n' 
         msg += 'Cannot continue calculation.\n'
         outputs['msg'] = msg
@@ -916,41 +2166,42 @@ def CheckSets_All2fis(inputs):
     
     msg += 'Det C is: %s \n' % str(float(detc))
     
+    progress.start('inverse', msg)
     try:
-        cinv = cmat.inv() # invert the c matrix
-    except:
+        cinv = engine.inv() # invert the c matrix
+    except Exception:
         msg += 'Unable to calculate the inverse of the C matrix\n'  
         msg += 'Cannot continue calculation.\n'
         outputs['msg'] = msg
         return outputs 
     
+    progress.start('correlation', msg, numEffects)
     correln = np.matrix([0 for i in np.arange(numEffects * numEffects)]).reshape(numEffects, numEffects) # initialise a matrix
     correln = sympy.Matrix(correln) # convert to sympy
     for i in range(numEffects): # loop through each row
+        progress.step()
         for j in range(numEffects): # loop through each column
             correln[i, j] = cinv[i, j]/sympy.sqrt(cinv[i, i] * cinv[j, j])
     
     # Save cinv and correln.
-    rows = ''
-    rows += ''.join(str(cinv)).replace('[','').replace(']','').replace(',','') + '\n'
-    outputs['cinv'] = rows
+    save_matrix(outputs, 'cinv', cinv)
+    
+    save_matrix(outputs, 'correln', correln)
     
-    rows = ''
-    rows += ''.join(str(correln)).replace('[','').replace(']','').replace(',','') + '\n'
-    outputs['correln'] = rows
+    progress.start('flags', msg)
     
     # If all factor are binary then calculate calculate the determinant of
     # the optimal design for the input choice set size.
     BinLvls = all([item==2 for item in levels]) # determine if all levels are binary
+    logoptdet = None
     if BinLvls: 
-        if factors%2 == 0:
-            optdet = np.power(((choicesetsize-1)*(factors+2)/(choicesetsize*(factors+1)*np.power(2,factors))), (factors+factors*(factors-1)/2))
-        else:
-            optdet = np.power(((choicesetsize-1)*(factors+1)/(choicesetsize*factors*np.power(2,factors))), (factors+factors (factors-1)/2))
+        logoptdet = log_optimal_det_2fis(factors, choicesetsize)
+    elif optdet > 0:
+        logoptdet = log_value(optdet)
     
     # calculate efficiency
-    if detc > 0 and optdet > 0:
-        eff = 100*np.power(detc/optdet,sympy.Rational(1, numEffects)) 
+    if detc > 0 and logoptdet is not None:
+        eff = log_efficiency(engine.logdet(), logoptdet, numEffects)
         if BinLvls:
             msg += 'Efficiency compared with optimal design: %s%% \n' % round(eff, 6)
         else:
@@ -1002,6 +2253,7 @@ def CheckSets_All2fis(inputs):
     return outputs
 
 
+@cancellable
 def CheckSets_Some2fis(inputs):
     '''
     inputs:  a dictionary of all input variables, in this case: 
@@ -1020,7 +2272,9 @@ def CheckSets_Some2fis(inputs):
     msg = '' 
     
     # Create formatted outputs vars as a dictionary.
-    outputs = {}
+    outputs = Outputs()
+    progress = inputs['progress']
+    progress.outputs = outputs
     
     # calculate a few little bits and pieces
     p = len(choicesets) # the number of choice sets
@@ -1035,10 +2289,20 @@ def CheckSets_Some2fis(inputs):
     # Construct the othogonal polynomial contrasts.
     orthogpolys = construct_poly_contrasts()
     
+    progress.start('parse', msg)
+
+    # the choice sets as mixed-radix tmt codes, one row per choice set
+    try:
+        design = Design.from_rows(choicesets, levels, choicesetsize)
+    except ValueError as e:
+        msg += '%s\n' % e
+        msg += 'Cannot continue calculation.\n'
+        outputs['msg'] = msg
+        return outputs
+    
     # check that each choiceset is made up of unique tmts
-    for i in range(len(choicesets)): # loop through each choice set
-        if len(unique(np.matrix(choicesets[i]).reshape(choicesetsize, factors))) != choicesetsize:
-            msg += 'Repeated treatment combination in choice set %d.\n' % (i+1)
+    for i in design.repeats():
+        msg += 'Repeated treatment combination in choice set %d.\n' % (i+1)
     
     if msg != '':
         msg += 'Cannot continue calculation.\n'
@@ -1046,23 +2310,15 @@ def CheckSets_Some2fis(inputs):
         return outputs
     
     # construct a matrix of all unique tmt combinations
-    allTmts = unique(np.matrix(choicesets).reshape(choicesetsize * p, factors)) 
+    allTmts = np.matrix(design.treatments())
     t = len(allTmts) # recalculate the number of tmt combinations
+    # index from each tmt combination to its column in B
+    index = TreatmentIndex(allTmts, levels)
     
-    # within each choiceset, sort the options lexicographically
-    choicesets = [lexico(np.matrix(item)) for item in choicesets] 
-    # reshape the choicesets into a 2D matrix
-    choicesets = np.vstack([np.hstack(item) for item in choicesets]) 
-    
-    # check for duplicates
-    dup = [] # a list of duplicate choicesets
-    # loop through each choiceset except the last
-    for i in range(len(choicesets)-1): 
-        # loop through each remaining choiceset 
-        for j in range(i+1, len(choicesets)): 
-            # check if all entries are the same in both choicesets
-            if all([choicesets[i,k]==choicesets[j,k] for k in range(np.shape(choicesets[i])[1])]): 
-                dup.append(j+1) # append to the list
+    progress.start('duplicates', msg)
+
+    # check for duplicates, the options must match in the order given
+    dup = design.duplicates() # a list of duplicate choicesets
     
     if len(dup) > 0:
         if len(dup) == 1:
@@ -1071,136 +2327,60 @@ def CheckSets_Some2fis(inputs):
             tmp = str(list(np.sort(dup))).replace('[','').replace(']','')
             msg += 'Warning: choice sets %s are duplicates.\n' % tmp
     
-    choicesets = unique(choicesets) # remove repeated rows (if any)
-    p = len(choicesets) # number of unique choice sets
+    design = design.unique() # remove repeated rows (if any)
+    p = len(design) # number of unique choice sets
     
     # update output info
     msg += 'Number of choicesets: %d \n' % p
     
+    progress.start('B matrix', msg)
+
     # construct the b matrix
-    bmat = np.matrix([0 for i in np.arange(numEffects * t)]).reshape(numEffects, t) # initialise a matrix
-    
-    # define the main effects contrasts
-    for tmt in range(t): # loop through each tmt 
-        TopRow = 0
-        for f in range(factors): # loop through each factor
-            BottomRow = TopRow
-            TopRow = TopRow + levels[f] - 1
-            # get the orthogonal polynomial contrasts for the given factor
-            poly = orthogpolys[levels[f] - 2] 
-            # assign the main effects
-            bmat[BottomRow:TopRow,tmt] = poly[:,allTmts[tmt,f]] 
-       
-    # define the interaction contrasts
-    if len(choose2fis) > 0:
-        RowIndex = numME
-        for i in range(len(choose2fis)): 
-            # get the orthogonal polynomial contrasts for the first factor
-            poly1 = orthogpolys[levels[choose2fis[i][0]-1] - 2] 
-            # get the orthogonal polynomial contrasts for the second factor
-            poly2 = orthogpolys[levels[choose2fis[i][1]-1] - 2] 
-            # loop through each main effect contrast of the first factor
-            for me1 in range(len(poly1)): 
-                # loop through each main effect contrast of the second factor
-                for me2 in range(len(poly2)): 
-                    for tmt in range(t): # loop through each tmt 
-                        # define the interaction contrast componenet
-                        bmat[RowIndex,tmt] = poly1[me1,allTmts[tmt,choose2fis[i][0]-1]] * poly2[me2,allTmts[tmt,choose2fis[i][1]-1]] 
-                    RowIndex = RowIndex + 1    
-    
-    # convert to sympy
-    bmat = sympy.Matrix(bmat)
-    levels = sympy.Matrix(levels)
-    
-    # normalise the main effects 
-    TopRow = 0
-    for f in range(factors): # loop through each factor
-        BottomRow = TopRow
-        TopRow = TopRow + levels[f] - 1
-        # get the orthogonal polynomial contrasts for the given factor
-        poly =  sympy.Matrix(orthogpolys[levels[f] - 2]) 
-        # calculate the normalising constant for each component
-        norm = [sympy.sqrt(sum(([innerItem**2 for innerItem in poly[item,:]])*np.prod(levels))/levels[f]) for item in range(poly.shape[0])]  
-        # normalise
-        bmat[BottomRow:TopRow,:] = [bmat[BottomRow:TopRow,:][i,:]/norm[i] for i in range(len(norm))] 
-    
-    # normalise the interactions
-    if len(choose2fis) > 0:
-        RowIndex = numME
-        for i in range(len(choose2fis)): 
-            # get the orthogonal polynomial contrasts for the first factor
-            poly1 = orthogpolys[levels[choose2fis[i][0]-1] - 2] 
-            # get the orthogonal polynomial contrasts for the second factor
-            poly2 = orthogpolys[levels[choose2fis[i][1]-1] - 2] 
-            # loop through each main effect contrast of the first factor
-            for me1 in range(poly1.shape[0]): 
-                # loop through each main effect contrast of the second factor
-                for me2 in range(poly2.shape[0]): 
-                    # define... a thing
-                    poly = [poly1[me1,lv1] * poly2[me2,lv2] for lv1 in range(poly1.shape[1]) for lv2 in range(poly2.shape[1])] 
-                    # calculate the normalising constant 
-                    norm = sympy.sqrt(sum(([innerItem**2 for innerItem in poly])*np.prod(levels))/(levels[choose2fis[i][0]-1] * levels[choose2fis[i][1]-1]))  
-                    bmat[RowIndex,:] = bmat[RowIndex,:]/norm # normalise
-                    RowIndex = RowIndex + 1
-    
-    # construct the lambda matrix, initialise a matrix
-    lmat = np.matrix([0 for i in np.arange(t * t)]).reshape(t, t) 
-    # initialise an array of indicies
-    lind = np.matrix([0 for i in np.arange(p * choicesetsize)]).reshape(p, choicesetsize) 
+    bmat = construct_bmat(allTmts, levels, choose2fis, orthogpolys)
     
-    # get the index for each option in each choiceset
-    for ch in range(p): # loop through each choiceset
-        EndCol = 0
-        for op in range(choicesetsize): # loop thought each option in the choiceset
-            StartCol = EndCol
-            EndCol = StartCol + factors
-            for tmt in range(t): # loop thought each tmt
-                if all([choicesets[ch,StartCol+k] == allTmts[tmt,k] for k in range(factors)]): 
-                    lind[ch,op] = tmt 
-    
-    # calculate lambda
-    for ch in range(p): # loop through each choiceset
-        for i in range(choicesetsize-1): # loop through each option except the last
-            for j in range(i+1, choicesetsize): # loop through each remaining option
-                lmat[lind[ch,i], lind[ch,j]] = lmat[lind[ch,i], lind[ch,j]] - 1
-                lmat[lind[ch,j], lind[ch,i]] = lmat[lind[ch,j], lind[ch,i]] - 1
+    # keep the integer contrasts and their squared norms for the exact engine
+    bint = bmat
+    bnorms = contrast_norms(levels, choose2fis)
     
-    # calculate the diagonal entries of lambda
-    for diag in range(t):
-        lmat[diag,diag] = -np.sum(lmat[diag])
+    # normalise each row of B and convert to sympy
+    bmat = normalise_bmat(bint, bnorms)
+    levels = sympy.Matrix(levels)
     
-    lmat = sympy.Matrix(lmat)/(p*(choicesetsize**2))
+    progress.start('Lambda matrix', msg)
+
+    # construct the lambda matrix, only if it is written out or used by sympy
+    lmat = None
+    if inputs.get('out_lmat', True) or inputs.get('numeric', 'exact') == 'sympy':
+        lmat = rational_matrix(construct_lambda(design, index), p*choicesetsize**2, progress)
     
     # Save bmat and lmat.
-    rows = ''
-    rows += ''.join(str(bmat)).replace('[','').replace(']','').replace(',','') + '\n'
-    outputs['bmat'] = rows
+    save_matrix(outputs, 'bmat', bmat)
     
-    rows = ''
-    rows += ''.join(str(lmat)).replace('[','').replace(']','').replace(',','') + '\n'
-    outputs['lmat'] = rows
+    if inputs.get('out_lmat', True):
+        save_matrix(outputs, 'lmat', lmat)
     
-    # Exit if this calc is taking too long.
-    if (datetime.now() - START).seconds > MAX_TIME: 
-        msg += 'Calculation is taking too long ... exiting.\n'
-        outputs['msg'] = msg
-        return outputs 
+    # Exit if this calc is taking too long or was cancelled.
+    progress.start('C matrix', msg)
+    
+    # accumulate the c matrix, before normalisation, over the choice sets
+    cint = accumulate_cint(bint, design, index, progress)
     
     # calculate the c matrix
     try:
-        cmat = bmat*lmat*bmat.T # the c matrix
-    except:
+        engine = make_engine(bmat, lmat, cint, bnorms, p*choicesetsize**2, inputs.get('numeric', 'exact'), progress)
+        cmat = engine.cmat # the c matrix
+        msg += engine.msg
+    except Exception:
         msg += 'Unable to calculate the C matrix.\n'
         msg += 'Cannot continue calculation.\n'
         outputs['msg'] = msg
         return outputs 
     
-    cRank = np.linalg.matrix_rank(cmat) # the rank of the c matrix
+    progress.start('rank', msg)
+    cRank = engine.rank() # the rank of the c matrix
     
     # Save cmat
-    rows = ''
-    rows += ''.join(str(cmat)).replace('[','').replace(']','').replace(',','') + '\n'
-    outputs['cmat'] = rows
+    save_matrix(outputs, 'cmat', cmat)
     
     # check the c matrix is of sufficient rank
     if cRank < numEffects:
@@ -1209,9 +2389,10 @@ def CheckSets_Some2fis(inputs):
         outputs['msg'] = msg
         return outputs 
     
+    progress.start('det', msg)
     try:
-        detc = cmat.det() # the determinant of the c matrix
-    except:
+        detc = engine.det() # the determinant of the c matrix
+    except Exception:
         msg += 'Unable to calculate the determinant of the C matrix\n' 
         msg += 'Cannot continue calculation.\n'
         outputs['msg'] = msg
@@ -1219,42 +2400,45 @@ def CheckSets_Some2fis(inputs):
     
     msg += 'Det C is: %s \n' % str(float(detc))
     
+    progress.start('inverse', msg)
     try:
-        cinv = cmat.inv() # invert the c matrix
-    except:
+        cinv = engine.inv() # invert the c matrix
+    except Exception:
         msg += 'Unable to calculate the inverse of the C matrix\n'  
         msg += 'Cannot continue calculation.\n'
         outputs['msg'] = msg
         return outputs 
     
+    progress.start('correlation', msg, numEffects)
     # initialise a matrix
     correln = np.matrix([0 for i in np.arange(numEffects * numEffects)]).reshape(numEffects, numEffects) 
     correln = sympy.Matrix(correln)     # convert to sympy
     for i in range(numEffects):         # loop through each row
+        progress.step()
         for j in range(numEffects):     # loop through each column
             correln[i, j] = cinv[i, j]/sympy.sqrt(cinv[i, i] * cinv[j, j])
     
     # Save cinv and correln.
-    rows = ''
-    rows += ''.join(str(cinv)).replace('[','').replace(']','').replace(',','') + '\n'
-    outputs['cinv'] = rows
+    save_matrix(outputs, 'cinv', cinv)
+    
+    save_matrix(outputs, 'correln', correln)
     
-    rows = ''
-    rows += ''.join(str(correln)).replace('[','').replace(']','').replace(',','') + '\n'
-    outputs['correln'] = rows
+    progress.start('flags', msg)
     
     # If all factor are binary then calculate calculate the determinant 
     # of the optimal design for the input choice set size
     BinLvls = all([item==2 for item in levels]) # determine if all levels are binary
+    # the optimal design is only known when the model has all the 2fis
+    BinLvls = BinLvls and numInts == factors*(factors-1)/2
+    logoptdet = None
     if BinLvls: 
-        if factors%2 == 0:
-            optdet = np.power(((choicesetsize-1)*(factors+2)/(choicesetsize*(factors+1)*np.power(2,factors))), (factors+factors*(factors-1)/2))
-        else:
-            optdet = np.power(((choicesetsize-1)*(factors+1)/(choicesetsize*factors*np.power(2,factors))), (factors+factors (factors-1)/2))
+        logoptdet = log_optimal_det_2fis(factors, choicesetsize)
+    elif optdet > 0:
+        logoptdet = log_value(optdet)
     
     # calculate efficiency
-    if detc > 0 and optdet > 0:
-        eff = 100*np.power(detc/optdet,sympy.Rational(1, numEffects)) 
+    if detc > 0 and logoptdet is not None:
+        eff = log_efficiency(engine.logdet(), logoptdet, numEffects)
         if BinLvls:
             msg += 'Efficiency compared with optimal design: %s%% \n' % round(eff, 6)
         else:
@@ -1305,6 +2489,7 @@ def CheckSets_Some2fis(inputs):
 
 
 
+@cancellable
 def ConstructSets_All2fis(inputs):
     '''
     inputs:  a dictionary of all input variables, in this case: 
@@ -1323,7 +2508,9 @@ def ConstructSets_All2fis(inputs):
     msg = '' 
     
     # Create formatted outputs vars as a dictionary.
-    outputs = {}
+    outputs = Outputs()
+    progress = inputs['progress']
+    progress.outputs = outputs
     
     # calculate a few little bits and pieces
     factors = len(levels) # number of factors
@@ -1362,63 +2549,46 @@ def ConstructSets_All2fis(inputs):
         outputs['msg'] = msg
         return outputs 
     
-    # convert a few things to myComb type
-    tmts = np.array([myComb(val=item, nmod=levels) for item in tmts]) 
-    generators = np.array([[myComb(val=chSet, nmod=levels) for chSet in gen] for gen in generators]) 
-    
     # Construct the othogonal polynomial contrasts.
     orthogpolys = construct_poly_contrasts()
     
-    # construct a matrix of choicesets
-    choicesets = np.array([0 for i in np.arange(t*g * choicesetsize * factors)]).reshape(t*g, choicesetsize, factors)
-    
-    # get a list of tmt/generator combinations
-    gen_tmt = [pair for pair in itertools.product(tmts, generators)] 
-    # extract the first option (tmt) from the list
-    firstOption = [item[0].val for item in gen_tmt] 
-    # generate the remaining options by adding the generator to the tmt
-    remainingOptions = [[row[0] + item for item in row[1]] for row in gen_tmt] 
-    
-    for ch1 in range(len(gen_tmt)): # loop thought each gen/tmt combo
-       choicesets[ch1][0] = firstOption[ch1] # assign the first option
-       for ch in range(len(remainingOptions[ch1])): # loop through each generator
-          choicesets[ch1][ch+1] = remainingOptions[ch1][ch] # assign the generated option
+    progress.start('parse', msg)
+
+    # construct the choicesets by adding each generator to each tmt
+    try:
+        design = Design.from_generators(tmts, generators, levels, choicesetsize)
+    except ValueError as e:
+        msg += '%s\n' % e
+        msg += 'Cannot continue calculation.\n'
+        outputs['msg'] = msg
+        return outputs
     
     # check that each choiceset is made up of unique tmts
-    for i in range(len(choicesets)): # loop through each choice set
-        if len(unique(np.matrix(choicesets[i]))) != len(choicesets[i]):
-            msg += 'Repeated treatment combination in choice set %d.\n' % (i+1)
+    for i in design.repeats():
+        msg += 'Repeated treatment combination in choice set %d.\n' % (i+1)
     
     if msg != '':
         msg += 'Cannot continue calculation.\n'
         outputs['msg'] = msg
         return outputs
              
-    # saved an unordered copy of the choicesets for output (reshaped into a 2D matrix)
-    choicesets_out = np.matrix(np.vstack([np.hstack(item) for item in choicesets])) 
+    # Save an unordered copy of the choicesets
+    outputs['chsets'] = design.to_text()
+    outputs.arrays['chsets'] = design.to_rows()
     
-    # Save choicesets
-    rows = '' 
-    for row in choicesets_out:
-        rows += ''.join(str(row)).replace('[','').replace(']','') + '\n'
-    outputs['chsets'] = rows
-    
-    allTmts = np.matrix(np.vstack(choicesets)) # construct a matrix of all tmt combinations
-    allTmts = unique(allTmts) # remove repeated tmt combos
+    # construct a matrix of all unique tmt combinations
+    allTmts = np.matrix(design.treatments())
     t = len(allTmts) # recalculate the number of tmt combinations
+    # index from each tmt combination to its column in B
+    index = TreatmentIndex(allTmts, levels)
     
     # within each choiceset, sort the options lexicographically
-    choicesets = [lexico(np.matrix(item)) for item in choicesets] 
-    # reshape the choicesets into a 2D matrix
-    choicesets = np.vstack([np.hstack(item) for item in choicesets]) 
+    design = design.sorted()
     
+    progress.start('duplicates', msg)
+
     # check for duplicates
-    dup = list() # initialise a list of duplicate choicesets
-    for i in range(len(choicesets)-1): # loop through each choiceset except the last
-        for j in range(i+1, len(choicesets)): # loop through each remaining choiceset 
-            # check if all entries are the same in both choicesets
-            if all([choicesets[i,k]==choicesets[j,k] for k in range(np.shape(choicesets[i])[1])]): 
-                dup.append(j+1) # append to the list
+    dup = design.duplicates() # a list of duplicate choicesets
     if len(dup) > 0:
         if len(dup) == 1:
             msg += 'Warning: choice set %s is a duplicate.\n' % dup[0]
@@ -1426,138 +2596,60 @@ def ConstructSets_All2fis(inputs):
             tmp = str(list(np.sort(dup))).replace('[','').replace(']','')
             msg += 'Warning: choice sets %s are duplicates.\n' % tmp
     
-    choicesets = unique(choicesets) # remove repeated rows (if any)
-    p = len(choicesets) # number of unique choice sets
+    design = design.unique() # remove repeated rows (if any)
+    p = len(design) # number of unique choice sets
     
     # update output info
     msg += 'Number of choicesets: %d \n' % p
     
-    # construct the b matrix, initialise a matrix
-    bmat = np.matrix([0 for i in np.arange(numEffects * t)]).reshape(numEffects, t) 
-    
-    # define the main effects contrasts
-    for tmt in range(t): # loop through each tmt 
-        TopRow = 0
-        for f in range(factors): # loop through each factor
-            BottomRow = TopRow
-            TopRow = TopRow + levels[f] - 1
-            # get the orthogonal polynomial contrasts for the given factor
-            poly = orthogpolys[levels[f] - 2] 
-            # assign the main effects
-            bmat[BottomRow:TopRow,tmt] = poly[:,allTmts[tmt,f]] 
-       
-    # define the interaction contrasts
-    if len(choose2fis) > 0:
-        RowIndex = numME
-        for i in range(len(choose2fis)): # loop through each interaction
-            # get the orthogonal polynomial contrasts for the first factor
-            poly1 = orthogpolys[levels[choose2fis[i][0]-1] - 2] 
-            # get the orthogonal polynomial contrasts for the second factor
-            poly2 = orthogpolys[levels[choose2fis[i][1]-1] - 2] 
-            # loop through each main effect contrast of the first factor
-            for me1 in range(len(poly1)): 
-                # loop through each main effect contrast of the second factor
-                for me2 in range(len(poly2)): 
-                    for tmt in range(t): # loop through each tmt 
-                        # define the interaction contrast componenet
-                        bmat[RowIndex,tmt] = poly1[me1,allTmts[tmt,choose2fis[i][0]-1]] * poly2[me2,allTmts[tmt,choose2fis[i][1]-1]] 
-                    RowIndex = RowIndex + 1
-    
-    # convert to sympy
-    bmat = sympy.Matrix(bmat)
-    levels = sympy.Matrix(levels)
-    
-    # normalise the main effects 
-    TopRow = 0
-    for f in range(factors): # loop through each factor
-        BottomRow = TopRow
-        TopRow = TopRow + levels[f] - 1
-        # get the orthogonal polynomial contrasts for the given factor
-        poly =  sympy.Matrix(orthogpolys[levels[f] - 2]) 
-        # calculate the normalising constant for each component
-        norm = [sympy.sqrt(sum(([innerItem**2 for innerItem in poly[item,:]])*np.prod(levels))/levels[f]) for item in range(poly.shape[0])]  
-        # normalise
-        bmat[BottomRow:TopRow,:] = [bmat[BottomRow:TopRow,:][i,:]/norm[i] for i in range(len(norm))] 
-    
-    # normalise the interactions
-    if len(choose2fis) > 0:
-        RowIndex = numME
-        for i in range(len(choose2fis)): # loop through each interaction
-            # get the orthogonal polynomial contrasts for the first factor
-            poly1 = orthogpolys[levels[choose2fis[i][0]-1] - 2] 
-            # get the orthogonal polynomial contrasts for the second factor
-            poly2 = orthogpolys[levels[choose2fis[i][1]-1] - 2] 
-            # loop through each main effect contrast of the first factor
-            for me1 in range(poly1.shape[0]): 
-                # loop through each main effect contrast of the second factor
-                for me2 in range(poly2.shape[0]): 
-                    # define... a thing
-                    poly = [poly1[me1,lv1] * poly2[me2,lv2] for lv1 in range(poly1.shape[1]) for lv2 in range(poly2.shape[1])] 
-                    # calculate the normalising constant 
-                    norm = sympy.sqrt(sum(([innerItem**2 for innerItem in poly])*np.prod(levels))/(levels[choose2fis[i][0]-1] * levels[choose2fis[i][1]-1]))  
-                    # normalise
-                    bmat[RowIndex,:] = bmat[RowIndex,:]/norm 
-                    RowIndex = RowIndex + 1
-    
-    
-    # construct the lambda matrix, initialise a matrix
-    lmat = np.matrix([0 for i in np.arange(t * t)]).reshape(t, t) 
-    # initialise an array of indecies
-    lind = np.matrix([0 for i in np.arange(p * choicesetsize)]).reshape(p, choicesetsize) 
+    progress.start('B matrix', msg)
+
+    # construct the b matrix
+    bmat = construct_bmat(allTmts, levels, choose2fis, orthogpolys)
     
-    # get the index for each option in each choiceset
-    for ch in range(p): # loop through each choiceset
-        EndCol = 0
-        for op in range(choicesetsize): # loop thought each option in the choiceset
-            StartCol = EndCol
-            EndCol = StartCol + factors
-            for tmt in range(t): # loop thought each tmt
-                if all([choicesets[ch,StartCol+k] == allTmts[tmt,k] for k in range(factors)]): 
-                    lind[ch,op] = tmt 
-    
-    # calculate lambda
-    for ch in range(p): # loop through each choiceset
-        for i in range(choicesetsize-1): # loop through each option except the last
-            for j in range(i+1, choicesetsize): # loop through each remaining option
-                lmat[lind[ch,i], lind[ch,j]] = lmat[lind[ch,i], lind[ch,j]] - 1
-                lmat[lind[ch,j], lind[ch,i]] = lmat[lind[ch,j], lind[ch,i]] - 1
+    # keep the integer contrasts and their squared norms for the exact engine
+    bint = bmat
+    bnorms = contrast_norms(levels, choose2fis)
     
-    # calculate the diagonal entries of lambda
-    for diag in range(t):
-        lmat[diag,diag] = -np.sum(lmat[diag])
+    # normalise each row of B and convert to sympy
+    bmat = normalise_bmat(bint, bnorms)
+    levels = sympy.Matrix(levels)
     
-    lmat = sympy.Matrix(lmat)/(p*(choicesetsize**2))
+    progress.start('Lambda matrix', msg)
+
+    # construct the lambda matrix, only if it is written out or used by sympy
+    lmat = None
+    if inputs.get('out_lmat', True) or inputs.get('numeric', 'exact') == 'sympy':
+        lmat = rational_matrix(construct_lambda(design, index), p*choicesetsize**2, progress)
     
     # Save bmat and lmat.
-    rows = ''
-    rows += ''.join(str(bmat)).replace('[','').replace(']','').replace(',','')  + '\n'
-    outputs['bmat'] = rows
+    save_matrix(outputs, 'bmat', bmat)
     
-    rows = ''
-    rows += ''.join(str(lmat)).replace('[','').replace(']','').replace(',','') + '\n'
-    outputs['lmat'] = rows
+    if inputs.get('out_lmat', True):
+        save_matrix(outputs, 'lmat', lmat)
     
-    # Exit if this calc is taking too long.
-    if (datetime.now() - START).seconds > MAX_TIME: 
-        msg += 'Calculation is taking too long ... exiting.\n'
-        outputs['msg'] = msg
-        return outputs 
+    # Exit if this calc is taking too long or was cancelled.
+    progress.start('C matrix', msg)
+    
+    # accumulate the c matrix, before normalisation, over the choice sets
+    cint = accumulate_cint(bint, design, index, progress)
     
     # calculate the c matrix
     try:
-        cmat = bmat*lmat*bmat.T # the c matrix
-    except:
+        engine = make_engine(bmat, lmat, cint, bnorms, p*choicesetsize**2, inputs.get('numeric', 'exact'), progress)
+        cmat = engine.cmat # the c matrix
+        msg += engine.msg
+    except Exception:
         msg += 'Unable to calculate the C matrix.\n'
         msg += 'Cannot continue calculation.\n'
         outputs['msg'] = msg
         return outputs 
     
-    cRank = np.linalg.matrix_rank(cmat) # the rank of the c matrix
+    progress.start('rank', msg)
+    cRank = engine.rank() # the rank of the c matrix
     
     # Save cmat
-    rows = ''
-    rows += ''.join(str(cmat)).replace('[','').replace(']','').replace(',','') + '\n'
-    outputs['cmat'] = rows
+    save_matrix(outputs, 'cmat', cmat)
     
     # check the c matrix is of sufficient rank
     if cRank < numEffects:
@@ -1566,9 +2658,10 @@ def ConstructSets_All2fis(inputs):
         outputs['msg'] = msg
         return outputs 
     
+    progress.start('det', msg)
     try:
-        detc = cmat.det() # the determinant of the c matrix
-    except:
+        detc = engine.det() # the determinant of the c matrix
+    except Exception:
         msg += 'Unable to calculate the determinant of the C matrix\n' 
         msg += 'Cannot continue calculation.\n'
         outputs['msg'] = msg
@@ -1576,42 +2669,43 @@ def ConstructSets_All2fis(inputs):
     
     msg += 'Det C is: %s \n' % str(float(detc))
     
+    progress.start('inverse', msg)
     try:
-        cinv = cmat.inv() # invert the c matrix
-    except:
+        cinv = engine.inv() # invert the c matrix
+    except Exception:
         msg += 'Unable to calculate the inverse of the C matrix\n'  
         msg += 'Cannot continue calculation.\n'
         outputs['msg'] = msg
         return outputs 
     
+    progress.start('correlation', msg, numEffects)
     # initialise a matrix
     correln = np.matrix([0 for i in np.arange(numEffects * numEffects)]).reshape(numEffects, numEffects) 
     correln = sympy.Matrix(correln)     # convert to sympy
     for i in range(numEffects):         # loop through each row
+        progress.step()
         for j in range(numEffects):      # loop through each column
             correln[i, j] = cinv[i, j]/sympy.sqrt(cinv[i, i] * cinv[j, j])
     
     # Save cinv and correln.
-    rows = ''
-    rows += ''.join(str(cinv)).replace('[','').replace(']','').replace(',','') + '\n'
-    outputs['cinv'] = rows
+    save_matrix(outputs, 'cinv', cinv)
+    
+    save_matrix(outputs, 'correln', correln)
     
-    rows = ''
-    rows += ''.join(str(correln)).replace('[','').replace(']','').replace(',','') + '\n'
-    outputs['correln'] = rows
+    progress.start('flags', msg)
     
     # If all factor are binary then calculate calculate the determinant 
     # of the optimal design for the input choice set size.
     BinLvls = all([item==2 for item in levels]) # determine if all levels are binary
+    logoptdet = None
     if BinLvls: 
-        if factors%2 == 0:
-            optdet = np.power(((choicesetsize-1)*(factors+2)/(choicesetsize*(factors+1)*np.power(2,factors))), (factors+factors*(factors-1)/2))
-        else:
-            optdet = np.power(((choicesetsize-1)*(factors+1)/(choicesetsize*factors*np.power(2,factors))), (factors+factors (factors-1)/2))
+        logoptdet = log_optimal_det_2fis(factors, choicesetsize)
+    elif optdet > 0:
+        logoptdet = log_value(optdet)
     
     # calculate efficiency
-    if detc > 0 and optdet > 0:
-        eff = 100*np.power(detc/optdet,sympy.Rational(1, numEffects)) 
+    if detc > 0 and logoptdet is not None:
+        eff = log_efficiency(engine.logdet(), logoptdet, numEffects)
         if BinLvls:
             msg += 'Efficiency compared with optimal design: %s%% \n' % round(eff, 6)
         else:
@@ -1664,6 +2758,7 @@ def ConstructSets_All2fis(inputs):
     return outputs
 
 
+@cancellable
 def ConstructSets_Some2fis(inputs):
     '''
     inputs:  a dictionary of all input variables, in this case: 
@@ -1682,7 +2777,9 @@ def ConstructSets_Some2fis(inputs):
     msg = '' 
     
     # Create formatted outputs vars as a dictionary.
-    outputs = {}
+    outputs = Outputs()
+    progress = inputs['progress']
+    progress.outputs = outputs
     
     # calculate a few little bits and pieces
     factors = len(levels) # number of factors
@@ -1720,63 +2817,46 @@ def ConstructSets_Some2fis(inputs):
         outputs['msg'] = msg
         return outputs 
     
-    # convert a few things to myComb type
-    tmts = np.array([myComb(val=item, nmod=levels) for item in tmts]) 
-    generators = np.array([[myComb(val=chSet, nmod=levels) for chSet in gen] for gen in generators]) 
-    
     # Construct the othogonal polynomial contrasts.
     orthogpolys = construct_poly_contrasts()
     
-    # construct a matrix of choicesets
-    choicesets = np.array([0 for i in np.arange(t*g * choicesetsize * factors)]).reshape(t*g, choicesetsize, factors)
-    
-    # get a list of tmt/generator combinations
-    gen_tmt = [pair for pair in itertools.product(tmts, generators)] 
-    # extract the first option (tmt) from the list
-    firstOption = [item[0].val for item in gen_tmt] 
-    # generate the remaining options by adding the generator to the tmt
-    remainingOptions = [[row[0] + item for item in row[1]] for row in gen_tmt] 
-    
-    for ch1 in range(len(gen_tmt)): # loop thought each gen/tmt combo
-        choicesets[ch1][0] = firstOption[ch1] # assign the first option
-        for ch in range(len(remainingOptions[ch1])): # loop through each generator
-            choicesets[ch1][ch+1] = remainingOptions[ch1][ch] # assign the generated option
+    progress.start('parse', msg)
+
+    # construct the choicesets by adding each generator to each tmt
+    try:
+        design = Design.from_generators(tmts, generators, levels, choicesetsize)
+    except ValueError as e:
+        msg += '%s\n' % e
+        msg += 'Cannot continue calculation.\n'
+        outputs['msg'] = msg
+        return outputs
        
     # check that each choiceset is made up of unique tmts
-    for i in range(len(choicesets)): # loop through each choice set
-        if len(unique(np.matrix(choicesets[i]))) != len(choicesets[i]):
-               msg += 'Repeated treatment combination in choice set %d.\n' % (i+1)
+    for i in design.repeats():
+        msg += 'Repeated treatment combination in choice set %d.\n' % (i+1)
     
     if msg != '':
         msg += 'Cannot continue calculation.\n'
         outputs['msg'] = msg
         return outputs
              
-    # saved an unordered copy of the choicesets for output (reshaped into a 2D matrix)
-    choicesets_out = np.matrix(np.vstack([np.hstack(item) for item in choicesets])) 
+    # Save an unordered copy of the choicesets
+    outputs['chsets'] = design.to_text()
+    outputs.arrays['chsets'] = design.to_rows()
     
-    # Save choicesets
-    rows = '' 
-    for row in choicesets_out:
-        rows += ''.join(str(row)).replace('[','').replace(']','') + '\n'
-    outputs['chsets'] = rows
-    
-    allTmts = np.matrix(np.vstack(choicesets)) # construct a matrix of all tmt combinations
-    allTmts = unique(allTmts) # remove repeated tmt combos
+    # construct a matrix of all unique tmt combinations
+    allTmts = np.matrix(design.treatments())
     t = len(allTmts) # recalculate the number of tmt combinations
+    # index from each tmt combination to its column in B
+    index = TreatmentIndex(allTmts, levels)
     
     # within each choiceset, sort the options lexicographically
-    choicesets = [lexico(np.matrix(item)) for item in choicesets] 
-    # reshape the choicesets into a 2D matrix
-    choicesets = np.vstack([np.hstack(item) for item in choicesets]) 
+    design = design.sorted()
     
+    progress.start('duplicates', msg)
+
     # check for duplicates
-    dup = list() # initialise a list of duplicate choicesets
-    for i in range(len(choicesets)-1): # loop through each choiceset except the last
-        for j in range(i+1, len(choicesets)): # loop through each remaining choiceset 
-            # check if all entries are the same in both choicesets
-            if all([choicesets[i,k]==choicesets[j,k] for k in range(np.shape(choicesets[i])[1])]): 
-                dup.append(j+1) # append to the list
+    dup = design.duplicates() # a list of duplicate choicesets
     if len(dup) > 0:
         if len(dup) == 1:
                msg += 'Warning: choice set %s is a duplicate.\n' % dup[0]
@@ -1784,135 +2864,60 @@ def ConstructSets_Some2fis(inputs):
                tmp = str(list(np.sort(dup))).replace('[','').replace(']','')
                msg += 'Warning: choice sets %s are duplicates.\n' % tmp
     
-    choicesets = unique(choicesets) # remove repeated rows (if any)
-    p = len(choicesets) # number of unique choice sets
+    design = design.unique() # remove repeated rows (if any)
+    p = len(design) # number of unique choice sets
     
     # update output info
     msg += 'Number of choicesets: %d \n' % p
     
-    # construct the b matrix, initialise a matrix
-    bmat = np.matrix([0 for i in np.arange(numEffects * t)]).reshape(numEffects, t) 
-    
-    # define the main effects contrasts
-    for tmt in range(t): # loop through each tmt 
-       TopRow = 0
-       for f in range(factors): # loop through each factor
-            BottomRow = TopRow
-            TopRow = TopRow + levels[f] - 1
-            poly = orthogpolys[levels[f] - 2] 
-            # get the orthogonal polynomial contrasts for the given factor
-            bmat[BottomRow:TopRow,tmt] = poly[:,allTmts[tmt,f]] # assign the main effects
-
-    # define the interaction contrasts
-    if len(choose2fis) > 0:
-        RowIndex = numME
-        for i in range(len(choose2fis)): # loop through each interaction
-            # get the orthogonal polynomial contrasts for the first factor
-            poly1 = orthogpolys[levels[choose2fis[i][0]-1] - 2] 
-            # get the orthogonal polynomial contrasts for the second factor
-            poly2 = orthogpolys[levels[choose2fis[i][1]-1] - 2] 
-            # loop through each main effect contrast of the first factor
-            for me1 in range(len(poly1)): 
-                # loop through each main effect contrast of the second factor
-                for me2 in range(len(poly2)): 
-                    for tmt in range(t): # loop through each tmt 
-                        # define the interaction contrast componenet
-                        bmat[RowIndex,tmt] = poly1[me1,allTmts[tmt,choose2fis[i][0]-1]] * poly2[me2,allTmts[tmt,choose2fis[i][1]-1]] 
-                    RowIndex = RowIndex + 1
-    
-    # convert to sympy
-    bmat = sympy.Matrix(bmat)
-    levels = sympy.Matrix(levels)
-    
-    # normalise the main effects 
-    TopRow = 0
-    for f in range(factors): # loop through each factor
-        BottomRow = TopRow
-        TopRow = TopRow + levels[f] - 1
-        # get the orthogonal polynomial contrasts for the given factor
-        poly =  sympy.Matrix(orthogpolys[levels[f] - 2]) 
-        # calculate the normalising constant for each component
-        norm = [sympy.sqrt(sum(([innerItem**2 for innerItem in poly[item,:]])*np.prod(levels))/levels[f]) for item in range(poly.shape[0])]  
-        # normalise
-        bmat[BottomRow:TopRow,:] = [bmat[BottomRow:TopRow,:][i,:]/norm[i] for i in range(len(norm))] 
-    
-    # normalise the interactions
-    if len(choose2fis) > 0:
-        RowIndex = numME
-        for i in range(len(choose2fis)): # loop through each interaction
-            # get the orthogonal polynomial contrasts for the first factor
-            poly1 = orthogpolys[levels[choose2fis[i][0]-1] - 2] 
-            # get the orthogonal polynomial contrasts for the second factor
-            poly2 = orthogpolys[levels[choose2fis[i][1]-1] - 2] 
-            # loop through each main effect contrast of the first factor
-            for me1 in range(poly1.shape[0]): 
-                # loop through each main effect contrast of the second factor
-                for me2 in range(poly2.shape[0]): 
-                    # define... a thing
-                    poly = [poly1[me1,lv1] * poly2[me2,lv2] for lv1 in range(poly1.shape[1]) for lv2 in range(poly2.shape[1])] 
-                    # calculate the normalising constant 
-                    norm = sympy.sqrt(sum(([innerItem**2 for innerItem in poly])*np.prod(levels))/(levels[choose2fis[i][0]-1] * levels[choose2fis[i][1]-1]))  
-                    bmat[RowIndex,:] = bmat[RowIndex,:]/norm # normalise
-                    RowIndex = RowIndex + 1
-    
-    # construct the lambda matrix, initialise a matrix
-    lmat = np.matrix([0 for i in np.arange(t * t)]).reshape(t, t) 
-    # initialise an array of indecies
-    lind = np.matrix([0 for i in np.arange(p * choicesetsize)]).reshape(p, choicesetsize) 
+    progress.start('B matrix', msg)
+
+    # construct the b matrix
+    bmat = construct_bmat(allTmts, levels, choose2fis, orthogpolys)
     
-    # get the index for each option in each choiceset
-    for ch in range(p): # loop through each choiceset
-        EndCol = 0
-        for op in range(choicesetsize): # loop thought each option in the choiceset
-            StartCol = EndCol
-            EndCol = StartCol + factors
-            for tmt in range(t): # loop thought each tmt
-                if all([choicesets[ch,StartCol+k] == allTmts[tmt,k] for k in range(factors)]): 
-                    lind[ch,op] = tmt 
-    
-    # calculate lambda
-    for ch in range(p): # loop through each choiceset
-        for i in range(choicesetsize-1): # loop through each option except the last
-            for j in range(i+1, choicesetsize): # loop through each remaining option
-                lmat[lind[ch,i], lind[ch,j]] = lmat[lind[ch,i], lind[ch,j]] - 1
-                lmat[lind[ch,j], lind[ch,i]] = lmat[lind[ch,j], lind[ch,i]] - 1
+    # keep the integer contrasts and their squared norms for the exact engine
+    bint = bmat
+    bnorms = contrast_norms(levels, choose2fis)
     
-    # calculate the diagonal entries of lambda
-    for diag in range(t):
-        lmat[diag,diag] = -np.sum(lmat[diag])
+    # normalise each row of B and convert to sympy
+    bmat = normalise_bmat(bint, bnorms)
+    levels = sympy.Matrix(levels)
     
-    lmat = sympy.Matrix(lmat)/(p*(choicesetsize**2))
+    progress.start('Lambda matrix', msg)
+
+    # construct the lambda matrix, only if it is written out or used by sympy
+    lmat = None
+    if inputs.get('out_lmat', True) or inputs.get('numeric', 'exact') == 'sympy':
+        lmat = rational_matrix(construct_lambda(design, index), p*choicesetsize**2, progress)
     
     # Save bmat and lmat.
-    rows = ''
-    rows += ''.join(str(bmat)).replace('[','').replace(']','').replace(',','') + '\n'
-    outputs['bmat'] = rows
+    save_matrix(outputs, 'bmat', bmat)
     
-    rows = ''
-    rows += ''.join(str(lmat)).replace('[','').replace(']','').replace(',','') + '\n'
-    outputs['lmat'] = rows
+    if inputs.get('out_lmat', True):
+        save_matrix(outputs, 'lmat', lmat)
     
-    # Exit if this calc is taking too long.
-    if (datetime.now() - START).seconds > MAX_TIME: 
-        msg += 'Calculation is taking too long ... exiting.\n'
-        outputs['msg'] = msg
-        return outputs 
+    # Exit if this calc is taking too long or was cancelled.
+    progress.start('C matrix', msg)
+    
+    # accumulate the c matrix, before normalisation, over the choice sets
+    cint = accumulate_cint(bint, design, index, progress)
     
     # calculate the c matrix
     try:
-        cmat = bmat*lmat*bmat.T # the c matrix
-    except:
+        engine = make_engine(bmat, lmat, cint, bnorms, p*choicesetsize**2, inputs.get('numeric', 'exact'), progress)
+        cmat = engine.cmat # the c matrix
+        msg += engine.msg
+    except Exception:
         msg += 'Unable to calculate the C matrix.\n'
         msg += 'Cannot continue calculation.\n'
         outputs['msg'] = msg
         return outputs 
     
-    cRank = np.linalg.matrix_rank(cmat) # the rank of the c matrix
+    progress.start('rank', msg)
+    cRank = engine.rank() # the rank of the c matrix
     
     # Save cmat
-    rows = ''
-    rows += ''.join(str(cmat)).replace('[','').replace(']','').replace(',','') + '\n'
-    outputs['cmat'] = rows
+    save_matrix(outputs, 'cmat', cmat)
     
     # check the c matrix is of sufficient rank
     if cRank < numEffects:
@@ -1921,9 +2926,10 @@ def ConstructSets_Some2fis(inputs):
         outputs['msg'] = msg
         return outputs 
     
+    progress.start('det', msg)
     try:
-        detc = cmat.det() # the determinant of the c matrix
-    except:
+        detc = engine.det() # the determinant of the c matrix
+    except Exception:
         msg += 'Unable to calculate the determinant of the C matrix\n' 
         msg += 'Cannot continue calculation.\n'
         outputs['msg'] = msg
@@ -1931,33 +2937,34 @@ def ConstructSets_Some2fis(inputs):
     
     msg += 'Det C is: %s \n' % str(float(detc))
     
+    progress.start('inverse', msg)
     try:
-        cinv = cmat.inv() # invert the c matrix
-    except:
+        cinv = engine.inv() # invert the c matrix
+    except Exception:
         msg += 'Unable to calculate the inverse of the C matrix\n'  
         msg += 'Cannot continue calculation.\n'
         outputs['msg'] = msg
         return outputs 
     
+    progress.start('correlation', msg, numEffects)
     # initialise a matrix
     correln = np.matrix([0 for i in np.arange(numEffects * numEffects)]).reshape(numEffects, numEffects) 
     correln = sympy.Matrix(correln)     # convert to sympy
     for i in range(numEffects):         # loop through each row
+        progress.step()
         for j in range(numEffects):     # loop through each column
             correln[i, j] = cinv[i, j]/sympy.sqrt(cinv[i, i] * cinv[j, j])
     
     # Save cinv and correln.
-    rows = ''
-    rows += ''.join(str(cinv)).replace('[','').replace(']','').replace(',','') + '\n'
-    outputs['cinv'] = rows
+    save_matrix(outputs, 'cinv', cinv)
     
-    rows = ''
-    rows += ''.join(str(correln)).replace('[','').replace(']','').replace(',','') + '\n'
-    outputs['correln'] = rows
+    save_matrix(outputs, 'correln', correln)
+    
+    progress.start('flags', msg)
     
     # calculate efficiency
     if detc > 0 and optdet > 0:
-        eff = 100*np.power(detc/optdet,sympy.Rational(1, numEffects)) 
+        eff = log_efficiency(engine.logdet(), log_value(optdet), numEffects)
         # output to user
         msg += 'Efficiency compared with input det C: %s%% \n' % round(eff, 6)
     
@@ -2008,6 +3015,7 @@ def ConstructSets_Some2fis(inputs):
     return outputs
 
 
+@cancellable
 def ConstructSets_MainEffects(inputs):
     '''
     inputs : a dictionary of all input variables, in this case: 
@@ -2023,7 +3031,9 @@ def ConstructSets_MainEffects(inputs):
     optdet = 1  # optimal det
     
     # Create formatted outputs vars as a dictionary.
-    outputs = {}
+    outputs = Outputs()
+    progress = inputs['progress']
+    progress.outputs = outputs
     
     # The text of this message string will be printed to the browser 
     # to provide an informative message to the user.
@@ -2073,71 +3083,46 @@ def ConstructSets_MainEffects(inputs):
         outputs['msg'] = msg
         return outputs 
     
-    # convert a few things to myComb type
-    tmts = np.array([myComb(val=item, nmod=levels) for item in tmts]) 
-    generators = np.array([[myComb(val=chSet, nmod=levels) for chSet in gen] for gen in generators]) 
-    
     # Construct the othogonal polynomial contrasts.
     orthogpolys = construct_poly_contrasts()
-
-    # construct a matrix of choicesets
-    choicesets = np.array([0 for i in np.arange(t*g * choicesetsize * factors)]).reshape(t*g, choicesetsize, factors)
-    
-    # get a list of tmt/generator combinations
-    gen_tmt = [pair for pair in itertools.product(tmts, generators)] 
-    
-    # extract the first option (tmt) from the list
-    firstOption = [item[0].val for item in gen_tmt] 
-    
-    # generate the remaining options by adding the generator to the tmt
-    remainingOptions = [[row[0] + item for item in row[1]] for row in gen_tmt] 
     
-    # loop though each gen/tmt combo
-    for ch1 in range(len(gen_tmt)): 
-        # assign the first option
-        choicesets[ch1][0] = firstOption[ch1] 
-        # loop through each generator
-        for ch in range(len(remainingOptions[ch1])): 
-            # assign the generated option
-            choicesets[ch1][ch+1] = remainingOptions[ch1][ch] 
+    progress.start('parse', msg)
+
+    # construct the choicesets by adding each generator to each tmt
+    try:
+        design = Design.from_generators(tmts, generators, levels, choicesetsize)
+    except ValueError as e:
+        msg += '%s\n' % e
+        msg += 'Cannot continue calculation.\n'
+        outputs['msg'] = msg
+        return outputs
     
     # check that each choiceset is made up of unique tmts
-    for i in range(len(choicesets)): # loop through each choice set
-        if len(unique(np.matrix(choicesets[i]))) != len(choicesets[i]):
-            msg += 'Repeated treatment combination in choice set %d.\n' % (i+1)
+    for i in design.repeats():
+        msg += 'Repeated treatment combination in choice set %d.\n' % (i+1)
    
     if msg != '':
         msg += 'Cannot continue calculation.\n'
         outputs['msg'] = msg
         return outputs
         
-    # saved an unordered copy of the choicesets for output (reshaped into a 2D matrix)
-    choicesets_out = np.matrix(np.vstack([np.hstack(item) for item in choicesets])) 
-   
-    # Save choicesets
-    rows = '' 
-    for row in choicesets_out:
-        rows += ''.join(str(row)).replace('[','').replace(']','') + '\n'
-    outputs['chsets'] = rows
-
-    allTmts = np.vstack(choicesets) # construct a matrix of all tmt combinations
-    allTmts = unique(np.matrix(allTmts)) # remove repeated tmt combos
+    # Save an unordered copy of the choicesets
+    outputs['chsets'] = design.to_text()
+    outputs.arrays['chsets'] = design.to_rows()
+
+    # construct a matrix of all unique tmt combinations
+    allTmts = np.matrix(design.treatments())
     t = len(allTmts) # recalculate the number of tmt combinations
+    # index from each tmt combination to its column in B
+    index = TreatmentIndex(allTmts, levels)
     
     # within each choiceset, sort the options lexicographically
-    choicesets = [lexico(np.matrix(item)) for item in choicesets] 
-    # reshape the choicesets into a 2D matrix
-    choicesets = np.vstack([np.hstack(item) for item in choicesets]) 
+    design = design.sorted()
     
+    progress.start('duplicates', msg)
+
     # check for duplicates
-    dup = [] # a list of duplicate choicesets
-    # loop through each choiceset except the last
-    for i in range(len(choicesets)-1): 
-        # loop through each remaining choiceset 
-        for j in range(i+1, len(choicesets)): 
-            # check if all entries are the same in both choicesets
-            if all([choicesets[i,k]==choicesets[j,k] for k in range(np.shape(choicesets[i])[1])]): 
-                dup.append(j+1) # append to the list
+    dup = design.duplicates() # a list of duplicate choicesets
 
     if len(dup) > 0:
         if len(dup) == 1:
@@ -2146,101 +3131,60 @@ def ConstructSets_MainEffects(inputs):
             tmp = str(list(np.sort(dup))).replace('[','').replace(']','')
             msg += 'Warning: choice sets %s are duplicates.\n' % tmp
     
-    choicesets = unique(choicesets) # remove repeated rows (if any)
-    p = len(choicesets) # number of unique choice sets
+    design = design.unique() # remove repeated rows (if any)
+    p = len(design) # number of unique choice sets
     
     # update output info
     msg += 'Number of choicesets: %d \n' % p
     
+    progress.start('B matrix', msg)
+
     # construct the b matrix
-    bmat = np.matrix([0 for i in np.arange(numEffects * t)]).reshape(numEffects, t) 
-    
-    # define the main effects contrasts
-    for tmt in range(t): # loop through each tmt 
-        TopRow = 0
-        for f in range(factors): # loop through each factor
-            BottomRow = TopRow
-            TopRow = TopRow + levels[f] - 1
-            # get the orthogonal polynomial contrasts for the given factor
-            poly = orthogpolys[levels[f] - 2] 
-            # assign the main effects
-            bmat[BottomRow:TopRow,tmt] = poly[:,allTmts[tmt,f]] 
-    
-    # convert to sympy
-    bmat = sympy.Matrix(bmat)
-    levels = sympy.Matrix(levels)
+    bmat = construct_bmat(allTmts, levels, [], orthogpolys)
     
-    # normalise the main effects 
-    TopRow = 0
-    for f in range(factors): # loop through each factor
-        BottomRow = TopRow
-        TopRow = TopRow + levels[f] - 1
-        # get the orthogonal polynomial contrasts for the given factor
-        poly =  sympy.Matrix(orthogpolys[levels[f] - 2]) 
-        # calculate the normalising constant for each component
-        norm = [sympy.sqrt(sum(([innerItem**2 for innerItem in poly[item,:]])*np.prod(levels))/levels[f]) for item in range(poly.shape[0])] 
-        # normalise
-        bmat[BottomRow:TopRow,:] = [bmat[BottomRow:TopRow,:][i,:]/norm[i] for i in range(len(norm))] 
-    
-    # construct the lambda matrix
-    # initialise a matrix
-    lmat = np.matrix([0 for i in np.arange(t * t)]).reshape(t, t) 
-    # initialise an array of indicies
-    lind = np.matrix([0 for i in np.arange(p * choicesetsize)]).reshape(p, choicesetsize) 
+    # keep the integer contrasts and their squared norms for the exact engine
+    bint = bmat
+    bnorms = contrast_norms(levels, [])
     
-    # get the index for each option in each choiceset
-    for ch in range(p): # loop through each choiceset
-        EndCol = 0
-        for op in range(choicesetsize): # loop thought each option in the choiceset
-            StartCol = EndCol
-            EndCol = StartCol + factors
-            for tmt in range(t): # loop though each tmt
-                if all([choicesets[ch,StartCol+k] == allTmts[tmt,k] for k in range(factors)]): 
-                    lind[ch,op] = tmt 
-    
-    # calculate lambda
-    for ch in range(p): # loop through each choiceset
-        for i in range(choicesetsize-1): # loop through each option except the last
-            for j in range(i+1, choicesetsize): # loop through each remaining option
-                lmat[lind[ch,i], lind[ch,j]] = lmat[lind[ch,i], lind[ch,j]] - 1
-                lmat[lind[ch,j], lind[ch,i]] = lmat[lind[ch,j], lind[ch,i]] - 1
+    # normalise each row of B and convert to sympy
+    bmat = normalise_bmat(bint, bnorms)
+    levels = sympy.Matrix(levels)
     
-    # calculate the diagonal entries of lambda
-    for diag in range(t):
-        lmat[diag,diag] = -np.sum(lmat[diag])
-     
-    lmat = sympy.Matrix(lmat)/(p*np.power(choicesetsize,2))
+    progress.start('Lambda matrix', msg)
+
+    # construct the lambda matrix, only if it is written out or used by sympy
+    lmat = None
+    if inputs.get('out_lmat', True) or inputs.get('numeric', 'exact') == 'sympy':
+        lmat = rational_matrix(construct_lambda(design, index), p*choicesetsize**2, progress)
    
     # Save bmat and lmat.
-    rows = ''
-    rows += ''.join(str(bmat)).replace('[','').replace(']','').replace(',','') + '\n'
-    outputs['bmat'] = rows
+    save_matrix(outputs, 'bmat', bmat)
     
-    rows = ''
-    rows += ''.join(str(lmat)).replace('[','').replace(']','').replace(',','') + '\n'
-    outputs['lmat'] = rows
+    if inputs.get('out_lmat', True):
+        save_matrix(outputs, 'lmat', lmat)
     
-    # Exit if this calc is taking too long.
-    if (datetime.now() - START).seconds > MAX_TIME: 
-        msg += 'Calculation is taking too long ... exiting.\n'
-        outputs['msg'] = msg
-        return outputs 
+    # Exit if this calc is taking too long or was cancelled.
+    progress.start('C matrix', msg)
+    
+    # accumulate the c matrix, before normalisation, over the choice sets
+    cint = accumulate_cint(bint, design, index, progress)
     
     # calculate the c matrix
     try:
-        cmat = bmat*lmat*bmat.T # the c matrix
-    except:
+        engine = make_engine(bmat, lmat, cint, bnorms, p*choicesetsize**2, inputs.get('numeric', 'exact'), progress)
+        cmat = engine.cmat # the c matrix
+        msg += engine.msg
+    except Exception:
         msg += 'Unable to calculate the C matrix.\n'
         msg += 'Cannot continue calculation.\n'
         outputs['msg'] = msg
         return outputs 
         
-    cRank = np.linalg.matrix_rank(cmat) # the rank of the c matrix
+    progress.start('rank', msg)
+    cRank = engine.rank() # the rank of the c matrix
    
     # Save cmat
-    rows = ''
-    rows += ''.join(str(cmat)).replace('[','').replace(']','').replace(',','') + '\n'
-    outputs['cmat'] = rows
+    save_matrix(outputs, 'cmat', cmat)
 
     # check the c matrix is of sufficient rank
     if cRank < numEffects:
@@ -2252,9 +3196,10 @@ Efficiency compared with optimal design for optimal choice set size m = %s: 0%%\
         outputs['msg'] = msg
         return outputs 
     
+    progress.start('det', msg)
     try:
-        detc = cmat.det() # the determinant of the c matrix
-    except:
+        detc = engine.det() # the determinant of the c matrix
+    except Exception:
         msg += 'Unable to calculate the determinant of the C matrix\n' 
         msg += 'Cannot continue calculation.\n'
         outputs['msg'] = msg
@@ -2262,54 +3207,39 @@ Efficiency compared with optimal design for optimal choice set size m = %s: 0%%\
      
     msg += 'Det C is: %s \n' % str(float(detc))
     
+    progress.start('inverse', msg)
     try:
-        cinv = cmat.inv() # invert the c matrix
-    except:
+        cinv = engine.inv() # invert the c matrix
+    except Exception:
         msg += 'Unable to calculate the inverse of the C matrix\n'  
         msg += 'Cannot continue calculation.\n'
         outputs['msg'] = msg
         return outputs 
     
+    progress.start('correlation', msg, numEffects)
     # initialise a matrix
     correln = np.matrix([0 for i in np.arange(numEffects * numEffects)]).reshape(numEffects, numEffects) 
     correln = sympy.Matrix(correln)     # convert to sympy
     for i in range(numEffects):         # loop through each row
+        progress.step()
         for j in range(numEffects):     # loop through each column
             correln[i, j] = cinv[i, j]/sympy.sqrt(cinv[i, i] * cinv[j, j])
 
     # Save cinv and correln.
-    rows = ''
-    rows += ''.join(str(cinv)).replace('[','').replace(']','').replace(',','') + '\n'
-    outputs['cinv'] = rows
+    save_matrix(outputs, 'cinv', cinv)
 
-    rows = ''
-    rows += ''.join(str(correln)).replace('[','').replace(']','').replace(',','') + '\n'
-    outputs['correln'] = rows
+    save_matrix(outputs, 'correln', correln)
+    
+    progress.start('flags', msg)
 
-    # calculate the determinant of the optimal design
-    prodlevels = np.product(levels)
-    Sumdiffs = list(np.repeat(0, factors))
-    optdet = 1
-    optdet2 = np.power((1/prodlevels), numEffects)
-    for q in range(factors):
-        if levels[q] == 2:
-            if choicesetsize%2 == 0:
-                Sumdiffs[q] = np.power(choicesetsize, 2)/4
-            else:
-                Sumdiffs[q] = (np.power(choicesetsize, 2) - 1)/4
-        else:
-            if levels[q] >= choicesetsize:
-                Sumdiffs[q] = choicesetsize * (choicesetsize - 1)/2
-            else:
-                x = choicesetsize//levels[q]
-                y = choicesetsize%levels[q]
-                Sumdiffs[q] = (np.power(choicesetsize, 2) - (levels[q] * np.power(x, 2) + 2 * x * y + y))/2
-        optdet = optdet * np.power(((2 * levels[q] * Sumdiffs[q])/(np.power(choicesetsize, 2) * (levels[q] - 1) * prodlevels)), (levels[q] - 1))
+    # calculate the log of the determinant of the optimal design
+    (logoptdet, logoptdet2) = log_optimal_det_main(levels, choicesetsize)
     
     # calculate efficiency
-    if detc > 0 and optdet > 0:
-        eff = 100*np.power(detc/optdet,sympy.Rational(1, numEffects))
-        eff2 = 100*np.power(detc/optdet2,sympy.Rational(1, numEffects))
+    if detc > 0:
+        logdet = engine.logdet()
+        eff = log_efficiency(logdet, logoptdet, numEffects)
+        eff2 = log_efficiency(logdet, logoptdet2, numEffects)
         # output to user
         msg += 'Efficiency compared with optimal design for choice set size m = %s: %s%% \n' % (choicesetsize, round(eff, 6))
         msg += 'Efficiency compared with optimal design for optimal choice set size m = %s: %s%% \n' % (lcm(levels), round(eff2, 6))
@@ -2339,6 +3269,634 @@ Efficiency compared with optimal design for optimal choice set size m = %s: 0%%\
 
 
 
+######################################
+# Library interface to the calculation
+######################################
+
+# The calculation function for each operation and effects.
+CALCULATIONS = {
+    ('check', 'main'): CheckSets_MainEffects,
+    ('check', 'mplusall'): CheckSets_All2fis,
+    ('check', 'mplussome'): CheckSets_Some2fis,
+    ('construct', 'main'): ConstructSets_MainEffects,
+    ('construct', 'mplusall'): ConstructSets_All2fis,
+    ('construct', 'mplussome'): ConstructSets_Some2fis,
+}
+
+
+def evaluate_design(levels, msize, chsets=None, tmts=None, gens=None, effects='main', 
+                    twofis=None, det=None, deadline=None, numeric='exact', out_lmat=True, 
+                    progress=None):
+    '''
+    Evaluates a design without reading or writing any files or using any 
+    global state, so it can be called from other programs and threads.
+    levels:   a list of the number of levels of each factor 
+    msize:    the choice set size m
+    chsets:   the choice sets to check, one per row 
+    tmts, gens: or the tmts and generators to construct the choice sets from
+    effects:  main, mplusall or mplussome
+    twofis:   the pairs of factors (from 1) of the 2fis for mplussome e.g. [[1,2],[2,3]]
+    det:      the optimal determinant of C if known, else None
+    deadline: a datetime after which the calculation gives up, or None 
+    numeric:  the engine for C, det and inverse: exact, float or sympy
+    out_lmat: False to skip constructing Lambda 
+    progress: a Progress to report the progress to and to cancel the calculation,
+              if it has no deadline then it is given this deadline 
+    The matrices can be arrays, lists of rows or text as in the input files.
+    Returns an Outputs dict of the text of each output file without the 
+    "out_" and ".dat", e.g. outputs['msg'], and the matrices in outputs.arrays.
+    Problems with the design are reported in outputs['msg'], a ValueError is 
+    only raised for args that can't be used at all.
+    '''
+    if effects not in ('main', 'mplusall', 'mplussome'):
+        raise ValueError('effects must be one of: main, mplusall, mplussome')
+    if numeric not in ('exact', 'float', 'sympy'):
+        raise ValueError('numeric must be one of: exact, float, sympy')
+    if chsets is not None:
+        operation = 'check'
+    elif tmts is not None and gens is not None:
+        operation = 'construct'
+    else:
+        raise ValueError('either chsets or both tmts and gens must be given')
+
+    levels = [int(item) for item in levels]
+    msize = int(msize)
+    factors = len(levels)
+    if isinstance(twofis, basestring):
+        # '1,2 3,4' --> [[1, 2], [3, 4]]
+        twofis = [[int(char) for char in item.split(',')] for item in twofis.split()]
+    if det is not None:
+        det = float(det)
+    if progress is None:
+        progress = Progress(deadline)
+    elif progress.deadline is None:
+        progress.deadline = deadline
+
+    inputs = {'levels': levels, 'msize': msize, 'twofis': twofis, 'det': det, 
+              'deadline': progress.deadline, 'numeric': numeric, 'out_lmat': out_lmat,
+              'progress': progress}
+
+    # Check the matrices have the right number of columns.
+    msg = ''
+    if operation == 'check':
+        matrices = [('chsets', chsets, msize * factors)]
+    else:
+        matrices = [('tmts', tmts, factors), ('gens', gens, (msize - 1) * factors)]
+    for (name, mat, width) in matrices:
+        try:
+            inputs[name] = as_int_matrix(mat, width)
+        except ValueError as e:
+            msg += 'Problem with %s: %s\n' % (name, e)
+    if msg != '':
+        outputs = Outputs()
+        outputs['msg'] = msg + 'Cannot continue calculation.\n'
+        return outputs
+
+    return CALCULATIONS[(operation, effects)](inputs)
+
+
+#######################
+# Search for generators
+#######################
+
+def model_2fis(effects, factors, twofis=None):
+    ''' Returns the 1-based pairs of factors of the 2fis in the effects model. '''
+    if effects == 'mplusall':
+        return list(itertools.combinations(range(1, factors + 1), 2))
+    elif effects == 'mplussome':
+        return [tuple(item) for item in twofis]
+    return []
+
+
+def float_logdet(cint, bnorms, lscale):
+    '''
+    Returns the natural log of det(C) where C = D*Cint*D/lscale as for the 
+    ExactEngine, found in float64. Returns -inf if C is singular, deciding
+    the rank as the FloatEngine does.
+    '''
+    cint = np.array(np.asarray(cint).tolist(), dtype=float)
+    n = cint.shape[0]
+    eig = np.linalg.eigvalsh(cint)
+    tol = np.abs(eig).max() * n * np.finfo(float).eps
+    if np.sum(eig > tol) < n:
+        return -np.inf
+    return np.sum(np.log(eig)) - np.sum(np.log(np.array(bnorms, dtype=float))) - n * np.log(lscale)
+
+
+def score_candidates(job):
+    '''
+    Returns the log det(C) of the design constructed from tmts by each of the 
+    candidate generators. job is a tuple (tmts, levels, msize, choose2fis, 
+    candidates) so it can be sent to a process pool.
+    '''
+    (tmts, levels, msize, choose2fis, candidates) = job
+    orthogpolys = construct_poly_contrasts()
+    bnorms = contrast_norms(levels, choose2fis)
+    scores = []
+    for gens in candidates:
+        # as for construct, sets that differ only in the order of their options are the same
+        design = Design.from_generators(tmts, gens, levels, msize).sorted().unique()
+        allTmts = design.treatments()
+        index = TreatmentIndex(allTmts, levels)
+        bint = construct_bmat(allTmts, levels, choose2fis, orthogpolys)
+        cint = accumulate_cint(bint, design, index)
+        scores.append(float_logdet(cint, bnorms, len(design) * msize**2))
+    return scores
+
+
+def ncombinations(n, r):
+    ''' Returns n choose r. '''
+    if r < 0 or r > n:
+        return 0
+    result = 1
+    for i in range(r):
+        result = result * (n - i) // (i + 1)
+    return result
+
+
+def candidate_generators(levels, msize, count=1, samples=None, seed=1):
+    '''
+    Returns a list of candidate generators for the search, each a (count, 
+    m-1, k) array of count sets of m-1 different nonzero generators. The
+    order of the generators in a set and of the sets does not change C so 
+    each combination is only given once. All of them are returned if there
+    are no more than samples, else samples different ones chosen at random.
+    '''
+    if samples is None:
+        samples = SEARCH_SAMPLES
+    levels = [int(item) for item in levels]
+    size = 1
+    for lvl in levels:
+        size *= lvl
+    nsets = ncombinations(size - 1, msize - 1)
+    if nsets == 0:
+        raise ValueError('m = %d is more than the %d treatment combinations' % (msize, size))
+
+    # The generators are chosen as their tmt codes, 0 is the zero generator.
+    if ncombinations(nsets, count) <= samples:
+        sets = itertools.combinations(xrange(1, size), msize - 1)
+        chosen = list(itertools.combinations(list(sets), count))
+    else:
+        # Only the codes that are drawn are made, however many tmts there are.
+        rand = random.Random(seed)
+        chosen = set()
+        while len(chosen) < samples:
+            gen_sets = set()
+            while len(gen_sets) < count:
+                codes = set()
+                while len(codes) < msize - 1:
+                    codes.add(rand.randrange(1, size))
+                gen_sets.add(tuple(sorted(codes)))
+            chosen.add(tuple(sorted(gen_sets)))
+        chosen = sorted(chosen)
+    codes = np.array([code for item in chosen for gen_set in item for code in gen_set], dtype=code_dtype(levels))
+    vectors = decode_treatments(codes, levels).reshape(len(chosen), count, msize - 1, len(levels))
+    return list(vectors)
+
+
+def search_generators(tmts, levels, msize, effects='main', twofis=None, det=None, count=1,
+                      top=10, samples=None, processes=None, seed=1, progress=None):
+    '''
+    Searches for the generators that give the most efficient design when 
+    constructed from tmts. Every candidate from candidate_generators() is 
+    scored by det(C) in float64, spread over a pool of processes, one for 
+    each cpu if processes is None. 
+    Returns a tuple (results, searched) where searched is the number of 
+    candidates and results is a list of the top results, best first, each a
+    dict with the generators 'gens' as rows of in_gens.dat, 'logdet', 'det' and 
+    'efficiency' in % or None if the optimal det is not known. For main 
+    effects the efficiency is compared with the optimal design, otherwise 
+    with det if it is given.
+    progress, if given, is stepped for each block of candidates and this
+    raises Cancelled if it is cancelled or its deadline passes.
+    '''
+    levels = [int(item) for item in levels]
+    msize = int(msize)
+    if isinstance(twofis, basestring):
+        twofis = [[int(char) for char in item.split(',')] for item in twofis.split()]
+    tmts = as_int_matrix(tmts, len(levels))
+    encode_treatments(tmts, levels)  # checks the range of the values
+    choose2fis = model_2fis(effects, len(levels), twofis)
+    numEffects = len(contrast_norms(levels, choose2fis))
+    logoptdet = None
+    if effects == 'main':
+        logoptdet = log_optimal_det_main(levels, msize)[0]
+    elif det:
+        logoptdet = log_value(det)
+
+    candidates = candidate_generators(levels, msize, count, samples, seed)
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    if multiprocessing.current_process().daemon:
+        processes = 1  # e.g. in a worker of choice_pool.py, which can't have children
+    block = max(1, min(SEARCH_BLOCK, len(candidates) // (4 * processes)))
+    jobs = [(tmts, levels, msize, choose2fis, candidates[start:start+block])
+            for start in range(0, len(candidates), block)]
+    if progress:
+        progress.start('search', total=len(jobs))
+
+    scores = []
+    pool = None
+    try:
+        if processes > 1 and len(jobs) > 1:
+            pool = multiprocessing.Pool(processes)
+            results = pool.imap(score_candidates, jobs)
+        else:
+            results = itertools.imap(score_candidates, jobs)
+        for result in results:
+            scores.extend(result)
+            if progress:
+                progress.step()
+    finally:
+        if pool:
+            pool.terminate()
+
+    order = sorted(range(len(candidates)), key=lambda i: -scores[i])
+    best = []
+    for i in order[:top]:
+        logdet = scores[i]
+        efficiency = None
+        if logoptdet is not None and logdet > -np.inf:
+            efficiency = log_efficiency(logdet, logoptdet, numEffects)
+        best.append({'gens': candidates[i].reshape(count, -1).tolist(), 'logdet': logdet,
+                     'det': float(np.exp(logdet)), 'efficiency': efficiency})
+    return (best, len(candidates))
+
+
+def search_text(results):
+    '''
+    Returns the results of search_generators() as the text of out_search.dat,
+    a header line and then a tab separated line for each result with the 
+    rows of its generators separated by ; e.g.
+    rank    det C           efficiency  gens
+    1       1.5625e-02      100.000000  1 1 1 0; 0 1 1 1
+    '''
+    text = 'rank\tdet C\tefficiency\tgens\n'
+    for (rank, result) in enumerate(results):
+        if result['efficiency'] is None:
+            efficiency = ''
+        else:
+            efficiency = '%.6f' % result['efficiency']
+        gens = '; '.join([' '.join([str(item) for item in row]) for row in result['gens']])
+        text += '%d\t%.6e\t%s\t%s\n' % (rank + 1, result['det'], efficiency, gens)
+    return text
+
+
+##########################
+# Optimise the choice sets
+##########################
+
+def random_set_codes(rand, size, msize):
+    ''' Returns a tuple of msize different random tmt codes from 0 to size-1. '''
+    codes = []
+    while len(codes) < msize:
+        code = rand.randrange(size)
+        if code not in codes:
+            codes.append(code)
+    return tuple(codes)
+
+
+def exchange_design(levels, msize, choose2fis, keys, deadline, seed=1, progress=None):
+    '''
+    Improves a design by coordinate exchange. keys are the choice sets as 
+    tuples of the tmt codes of their options. In turn each option of each set,
+    in a random order, is replaced by the tmt that gives C the largest rank 
+    and then log det, scored with IncrementalDesign.score_swap_codes(). The
+    candidate tmts are all of them if there are no more than
+    OPTIMISE_CANDIDATES, else a random sample of that many for each option.
+    It ends when a pass over every option makes no improvement or at the
+    deadline, a time.time(). progress, if given, is checked after each set.
+    Returns a tuple (keys, score) of the improved design and its score().
+    '''
+    rand = random.Random(seed)
+    size = int(np.prod(levels))
+    design = IncrementalDesign(levels, msize, choose2fis)
+    for key in keys:
+        design.add_codes(key)
+    keys = list(keys)
+    best = design.score()
+
+    improved = True
+    while improved and time.time() < deadline:
+        improved = False
+        for i in rand.sample(range(len(keys)), len(keys)):
+            for j in range(msize):
+                if size <= OPTIMISE_CANDIDATES:
+                    candidates = range(size)
+                else:
+                    candidates = [rand.randrange(size) for item in range(OPTIMISE_CANDIDATES)]
+                old = keys[i]
+                choice = None
+                for code in candidates:
+                    if code in old:
+                        continue  # the tmt would be repeated in the set
+                    new = old[:j] + (code,) + old[j+1:]
+                    if new in design.counts:
+                        continue  # it would be a duplicate set
+                    score = design.score_swap_codes(old, new)
+                    # Only take a clear improvement so rounding can't make it cycle.
+                    if score[0] > best[0] or (score[0] == best[0] and score[1] > best[1] + 1e-9):
+                        (best, choice) = (score, new)
+                if choice is not None:
+                    design.swap_codes(old, choice)
+                    keys[i] = choice
+                    improved = True
+            if progress:
+                progress.check()
+            if time.time() >= deadline:
+                break
+    return (keys, design.score())
+
+
+def exchange_start(job, progress=None):
+    '''
+    Runs exchange_design() for one start of optimise_design(), in a process 
+    pool or not. job is a tuple (levels, msize, choose2fis, keys, deadline, 
+    share, seed) and the start runs for share seconds from when it begins but
+    not past the deadline.
+    '''
+    (levels, msize, choose2fis, keys, deadline, share, seed) = job
+    deadline = min(deadline, time.time() + share)
+    return exchange_design(levels, msize, choose2fis, keys, deadline, seed, progress)
+
+
+def optimise_design(levels, msize, chsets=None, p=None, effects='main', twofis=None,
+                    budget=None, starts=None, processes=None, seed=1, progress=None):
+    '''
+    Improves a design by coordinate exchange with exchange_design(), from 
+    starts designs, OPTIMISE_STARTS if None. The first start is chsets, if 
+    given, and the others are random designs of the same number of choice 
+    sets, or of p choice sets if there is no chsets. The starts are run on a
+    pool of processes, one for each cpu if processes is None, or one after
+    another in a process that can't have a pool, e.g. a worker of 
+    choice_pool.py. All the starts end within budget seconds, OPTIMISE_TIME 
+    if None, and not past the deadline of progress. Each is given an equal 
+    share of the budget, and when they are run one after another a start 
+    that ends early leaves its time to the starts after it.
+    Returns a dict with the improved 'chsets' as rows of in_chsets.dat, its
+    'rank' and 'logdet' of C, the 'start_rank' and 'start_logdet' of chsets
+    (None if there was no chsets) and the number of 'starts'.
+    Raises Cancelled if the progress is cancelled or its deadline passes, and 
+    ValueError for a design that can't be used.
+    '''
+    levels = [int(item) for item in levels]
+    msize = int(msize)
+    if isinstance(twofis, basestring):
+        twofis = [[int(char) for char in item.split(',')] for item in twofis.split()]
+    choose2fis = model_2fis(effects, len(levels), twofis)
+    size = int(np.prod(levels))
+    if msize < 2 or msize > size:
+        raise ValueError('The choice set size must be from 2 to the %d treatment combinations.' % size)
+    if budget is None:
+        budget = OPTIMISE_TIME
+    deadline = time.time() + budget
+    if progress and progress.deadline:
+        deadline = min(deadline, time.time() + (progress.deadline - datetime.now()).total_seconds())
+
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    if multiprocessing.current_process().daemon:
+        processes = 1  # e.g. in a worker of choice_pool.py, which can't have children
+    if starts is None:
+        starts = OPTIMISE_STARTS
+
+    first = None
+    if chsets is not None:
+        design = Design.from_rows(as_int_matrix(chsets, msize * len(levels)), levels, msize)
+        if len(design.repeats()) > 0:
+            raise ValueError('Repeated treatment combination in choice set %d.' % (design.repeats()[0] + 1))
+        first = [tuple(row) for row in design.codes.tolist()]
+        p = len(first)
+    if not p:
+        raise ValueError('There must be at least one choice set.')
+
+    # The starts run in rounds of one for each process.
+    share = budget / float((starts + processes - 1) // processes)
+    rand = random.Random(seed)
+    jobs = []
+    for start in range(starts):
+        if start == 0 and first is not None:
+            keys = first
+        else:
+            keys = [random_set_codes(rand, size, msize) for i in range(p)]
+        jobs.append((levels, msize, choose2fis, keys, deadline, share, seed + start))
+
+    if progress:
+        progress.start('optimise', total=len(jobs))
+    results = []
+    pool = None
+    try:
+        if processes > 1 and len(jobs) > 1:
+            pool = multiprocessing.Pool(min(processes, len(jobs)))
+            pending = pool.imap(exchange_start, jobs)
+            while len(results) < len(jobs):
+                try:
+                    results.append(pending.next(1))
+                except multiprocessing.TimeoutError:
+                    pass
+                else:
+                    if progress:
+                        progress.step()
+                if progress:
+                    progress.check()
+        else:
+            for job in jobs:
+                if results and time.time() >= deadline:
+                    break
+                # an equal share of the time that is left
+                share = (deadline - time.time()) / (len(jobs) - len(results))
+                results.append(exchange_start(job[:5] + (share,) + job[6:], progress))
+                if progress:
+                    progress.step()
+    finally:
+        if pool:
+            pool.terminate()
+
+    (keys, score) = max(results, key=lambda item: item[1])
+    rows = decode_treatments(np.array(keys).ravel(), levels).reshape(p, msize * len(levels))
+    result = {'chsets': rows.tolist(), 'rank': score[0], 'logdet': score[1], 
+              'start_rank': None, 'start_logdet': None, 'starts': len(results)}
+    if first is not None:
+        design = IncrementalDesign(levels, msize, choose2fis)
+        for key in first:
+            design.add_codes(key)
+        (result['start_rank'], result['start_logdet']) = design.score()
+    return result
+
+
+def optimise_inputs(inputs, effects, progress):
+    '''
+    Runs optimise_design() on a dictionary of inputs from parse_input_texts()
+    and evaluates the improved design with evaluate_design(). The outputs
+    are those of check with the improved choice sets as outputs['chsets'].
+    '''
+    try:
+        result = optimise_design(inputs['levels'], inputs['msize'], chsets=inputs['chsets'], 
+                                 effects=effects, twofis=inputs.get('twofis'), progress=progress)
+    except ValueError as e:
+        outputs = Outputs()
+        outputs['msg'] = '%s\nCannot continue calculation.\n' % e
+        return outputs
+    except Cancelled as e:
+        outputs = Outputs()
+        outputs['msg'] = '%s\n' % e
+        return outputs
+
+    outputs = evaluate_design(inputs['levels'], inputs['msize'], chsets=result['chsets'], effects=effects,
+                              twofis=inputs.get('twofis'), det=inputs.get('det'), 
+                              numeric=NUMERIC, out_lmat=OUT_LMAT, progress=progress)
+    design = Design.from_rows(result['chsets'], inputs['levels'], inputs['msize'])
+    outputs['chsets'] = design.to_text()
+    outputs.arrays['chsets'] = design.to_rows()
+    starts = '%d start%s' % (result['starts'], 's'[:result['starts'] > 1])
+    if result['logdet'] > result['start_logdet'] or result['rank'] > result['start_rank']:
+        msg = 'The choice sets were improved by coordinate exchange from %s: log det C %s --> %s\n' % (
+            starts, format_logdet(result['start_logdet']), format_logdet(result['logdet']))
+    else:
+        msg = 'The choice sets could not be improved by coordinate exchange from %s.\n' % starts
+    outputs['msg'] = msg + outputs['msg']
+    return outputs
+
+
+def format_logdet(logdet):
+    ''' Returns log det C as text, which is -inf if C is singular. '''
+    if logdet == -np.inf:
+        return '-inf (C is singular)'
+    return '%.6f' % logdet
+
+
+def start_progress(progress=None):
+    ''' Returns progress, or a new Progress, with a deadline of MAX_TIME from now if it has none. '''
+    if progress is None:
+        progress = Progress()
+    if progress.deadline is None:
+        progress.deadline = datetime.now() + timedelta(seconds=MAX_TIME)
+    return progress
+
+
+def evaluate_inputs(inputs, operation, effects, progress):
+    '''
+    Runs evaluate_design() on a dictionary of inputs from parse_input_texts(),
+    or optimise_inputs() for the optimise operation.
+    '''
+    if operation == 'optimise':
+        return optimise_inputs(inputs, effects, progress)
+    if operation == 'check':
+        matrices = {'chsets': inputs['chsets']}
+    else:
+        matrices = {'tmts': inputs['tmts'], 'gens': inputs['gens']}
+    return evaluate_design(inputs['levels'], inputs['msize'], effects=effects, 
+                           twofis=inputs.get('twofis'), det=inputs.get('det'), 
+                           numeric=NUMERIC, out_lmat=OUT_LMAT, progress=progress,
+                           **matrices)
+
+
+def run_calculation(input_dir, operation, effects, progress=None):
+    '''
+    Reads the input files in input_dir, performs the calculation for the 
+    operation (check or construct) and effects (main, mplusall or mplussome)
+    with evaluate_design() and writes the output files to input_dir. The args
+    must already have been checked. This is used by main() and by the 
+    long-lived workers in choice_pool.py. progress is as for evaluate_design(),
+    it is given a deadline of MAX_TIME if it does not have one.
+    '''
+    progress = start_progress(progress)
+
+    cwd = os.getcwd()
+    os.chdir(input_dir)
+    try:
+        ################################################################# 
+        # Construct list of expected input files, open them, extract data
+        ################################################################# 
+
+        # This is a list of the expected data input and output variables. 
+        (expected_inputs, expected_outputs) = get_expected_io(operation, effects)
+
+        # Read in data and do some checking of all input values. 
+        # If a file contains nothing or text strings instead of numbers then 
+        # the inputs value for that variable will be boolean False.
+        errors = []
+        inputs = read_input_files(input_dir, expected_inputs, errors)
+        if errors:
+            write_output_files({'msg': ''.join(errors) + 'Cannot continue calculation.\n'})
+            return
+
+        ######################
+        # Perform calculations
+        ######################
+
+        outputs = evaluate_inputs(inputs, operation, effects, progress)
+
+        # Write output files. 
+        write_output_files(outputs)
+    finally:
+        os.chdir(cwd)
+
+
+def run_calculation_texts(texts, operation, effects, progress=None):
+    '''
+    The same as run_calculation() but without any files. texts is a dictionary
+    of the contents of each input file e.g. texts['levels'] is the contents of
+    in_levels.dat. Returns a dictionary of the contents of each output file 
+    e.g. outputs['msg'] is the contents of out_msg.dat, and outputs['errors'] 
+    is what would have been written to errors.txt.
+    '''
+    progress = start_progress(progress)
+    (expected_inputs, expected_outputs) = get_expected_io(operation, effects)
+
+    log = []
+    errors = []
+    inputs = parse_input_texts(texts, expected_inputs, errors, log.append)
+    if errors:
+        outputs = {'msg': ''.join(errors) + 'Cannot continue calculation.\n'}
+    else:
+        outputs = dict(evaluate_inputs(inputs, operation, effects, progress))
+    outputs['errors'] = ''.join(log)
+    return outputs
+
+
+def run_search(input_dir, effects, top, progress=None):
+    '''
+    Reads the construct input files in input_dir and searches for the top 
+    generators with search_generators(), as many sets of generators as there
+    are rows in in_gens.dat. Writes the results to out_search.dat and the 
+    output files of the construct calculation for the best generators. 
+    '''
+    progress = start_progress(progress)
+
+    cwd = os.getcwd()
+    os.chdir(input_dir)
+    try:
+        (expected_inputs, expected_outputs) = get_expected_io('construct', effects)
+        errors = []
+        inputs = read_input_files(input_dir, expected_inputs, errors)
+        if errors:
+            write_output_files({'msg': ''.join(errors) + 'Cannot continue calculation.\n'})
+            return
+
+        try:
+            (results, searched) = search_generators(inputs['tmts'], inputs['levels'], inputs['msize'], effects,
+                                        inputs.get('twofis'), inputs.get('det'), count=len(inputs['gens']),
+                                        top=top, progress=progress)
+        except ValueError as e:
+            write_output_files({'msg': '%s\nCannot continue calculation.\n' % e})
+            return
+        except Cancelled as e:
+            write_output_files({'msg': '%s\n' % e})
+            return
+
+        outputs = evaluate_design(inputs['levels'], inputs['msize'], tmts=inputs['tmts'], 
+                                  gens=results[0]['gens'], effects=effects, twofis=inputs.get('twofis'),
+                                  det=inputs.get('det'), numeric=NUMERIC, out_lmat=OUT_LMAT, 
+                                  progress=progress)
+        gens = '; '.join([' '.join([str(item) for item in row]) for row in results[0]['gens']])
+        outputs['msg'] = 'Best generators of the %d searched: %s\n' % (searched, gens) + outputs['msg']
+        outputs['search'] = search_text(results)
+        write_output_files(outputs)
+    finally:
+        os.chdir(cwd)
+
+
 ##################
 # Main starts here
 ##################
@@ -2359,83 +3917,89 @@ def main():
     # Check program arguments
     ##########################
         
+    global NUMERIC, OUT_LMAT, SEARCH, OPTIMISE_TIME
+
+    # The options --numeric, --no-lmat, --search and --time can be given after the three args.
+    args = sys.argv[1:]
+    if '--time' in args:
+        index = args.index('--time')
+        try:
+            OPTIMISE_TIME = float(args[index+1])
+        except (IndexError, ValueError):
+            OPTIMISE_TIME = 0
+        del args[index:index+2]
+        if OPTIMISE_TIME <= 0:
+            usage()
+            print 'Error, --time must be followed by the number of seconds to optimise for'
+            sys.exit()
+    if '--search' in args:
+        index = args.index('--search')
+        try:
+            SEARCH = int(args[index+1])
+        except (IndexError, ValueError):
+            SEARCH = 0
+        del args[index:index+2]
+        if SEARCH < 1:
+            usage()
+            print 'Error, --search must be followed by the number of generators to find'
+            sys.exit()
+    if '--no-lmat' in args:
+        OUT_LMAT = False
+        args.remove('--no-lmat')
+    if '--numeric' in args:
+        index = args.index('--numeric')
+        try:
+            NUMERIC = args[index+1]
+        except IndexError:
+            NUMERIC = None
+        del args[index:index+2]
+        if NUMERIC != 'exact' and NUMERIC != 'float' and NUMERIC != 'sympy':
+            usage()
+            print 'Error, --numeric options must be: exact | float | sympy'
+            sys.exit()
+
     # There must be three args. 
-    if len(sys.argv) != 4: 
+    if len(args) != 3: 
         usage()
         print 'Error, number of args must be three.'
         sys.exit()
 
     # First arg must be a directory which contains the input data files. 
     # We attempt to change into this directory.
-    input_dir = sys.argv[1]
+    input_dir = os.path.abspath(args[0])
     try:
         os.chdir(input_dir)
     except:
         usage()
-        print 'Error, input data directory %s does not exist.' % input_dir
+        print 'Error, input data directory %s does not exist.' % args[0]
         sys.exit()
 
-    # Second arg must be either check or construct i.e. the operation to perform.
-    operation = sys.argv[2]
-    if operation != 'check' and operation != 'construct':
+    # Second arg must be either check, construct or optimise i.e. the operation to perform.
+    operation = args[1]
+    if operation != 'check' and operation != 'construct' and operation != 'optimise':
         usage()
-        print 'Error, second arg options must be: check | construct'
+        print 'Error, second arg options must be: check | construct | optimise'
         sys.exit()
 
     # Third arg must be either main, mplusall or mplussome i.e. the effects to estimate.
-    effects = sys.argv[3]
+    effects = args[2]
     if effects != 'main' and effects != 'mplusall' and effects != 'mplussome':
         usage()
         print 'Error, third arg options must be: main | mplusall | mplussome'
         sys.exit()
 
- 
-    ################################################################# 
-    # Construct list of expected input files, open them, extract data
-    ################################################################# 
 
-    # This is a list of the expected data input and output variables. 
-    (expected_inputs, expected_outputs) = get_expected_io(operation, effects)
+    if SEARCH and operation != 'construct':
+        usage()
+        print 'Error, --search can only be used with construct'
+        sys.exit()
 
-    # Read in data and do some checking of all input values. 
-    # If a file contains nothing or text strings instead of numbers then 
-    # the inputs value for that variable will be boolean False.
-    inputs = read_input_files(input_dir, expected_inputs)
-
-    #print expected_inputs
-    #print inputs
-    #print type(inputs['twofis'])
-
-    ######################
-    # Perform calculations
-    ######################
-
-    # At this stage we expect all inputs to be present. 
-    # The program now runs one of these funcs depending on the web input.
-    if operation == 'check' and effects == 'main':
-        outputs = CheckSets_MainEffects(inputs)
-    elif operation == 'check' and effects == 'mplusall':
-        outputs = CheckSets_All2fis(inputs)
-    elif operation == 'check' and effects=='mplussome':
-        outputs = CheckSets_Some2fis(inputs)
-    elif operation == 'construct' and effects == 'main':
-        outputs = ConstructSets_MainEffects(inputs)
-    elif operation == 'construct' and effects == 'mplusall':
-        outputs = ConstructSets_All2fis(inputs)
-    elif operation == 'construct' and effects == 'mplussome':
-        outputs = ConstructSets_Some2fis(inputs)
+    # Run the calculation, or the search, in the input directory.
+    if SEARCH:
+        run_search(input_dir, effects, SEARCH)
     else:
-        pass
-
-    #actual_outout = outputs.keys()
-    #actual_outout.sort()
-    #print 'EI: ', expected_inputs   # Expected Input 
-    #print 'AI: ', inputs
-    #print 'EO: ', expected_outputs  # Expected Output
-    #print 'AO: ', actual_outout     # Actual Output
+        run_calculation(input_dir, operation, effects)
 
-    # Write output files. 
-    write_output_files(outputs)
 
 if __name__ == '__main__':
     main()
@@ -7,5 +7,5 @@
 today=`date +%Y.%m.%d`
 
 # Tarball just the code for the client and the test directory.
-tar cvf choice_to_emily_$today.tar choice.py choice_common.py process_choices.py test
+tar cvf choice_to_emily_$today.tar choice.py choice_common.py choice_pool.py choice_cache.py process_choices.py benchmark.py generate_design.py scaling.py test
 
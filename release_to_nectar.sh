@@ -22,7 +22,7 @@ today=`date +%Y.%m.%d`
 tarball="choice_release_$today.tar"
 
 # List of files and directories to tarball
-files="choice.py choice_common.py process_choices.py static_choice views" 
+files="choice.py choice_common.py choice_pool.py choice_cache.py process_choices.py static_choice views" 
 
 # Tar em !
 # Note we prefix the files/dirs with choice_$today.
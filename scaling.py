@@ -0,0 +1,297 @@
+#!/usr/bin/env python
+'''
+Scaling curves of process_choices.py on random designs of increasing size
+Author: Mike Lake
+Copyright 2013 Mike Lake
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+Usage: ./scaling.py [options]
+
+A design is made by generate_design.py for every combination of the values of
+the options below and process_choices.py is run on it as a new process. Each
+option takes a list of values separated by commas.
+
+Options:
+    --operation list  check and/or construct, default check
+    --effects list    main, mplusall and/or mplussome, default main
+    --k list          the number of factors, default 3,4,5
+    --levels list     the levels of every factor, or mixed, default 2,3
+    --m list          the choice set sizes, default 2,3
+    --p list          the numbers of choice sets, default 10,100,1000
+    --twofis density  the fraction of the pairs that are two factor interactions
+                      for mplussome, default 0.5
+    --gens g          the number of sets of generators for construct, default 1
+    --seed seed       the seed of the random designs, default 1
+    --timeout secs    a run is killed after this long, default 300
+    --numeric engine  passed to process_choices.py: exact, float or sympy
+    --no-lmat         passed to process_choices.py
+    -o name           write the report to name.json and name.csv, the default
+                      name is reports/scaling_<date>_<commit>
+
+For each design the report has the parameters, the number of effects, t the
+number of different treatment combinations, the wall time, cpu time and peak
+memory of each stage, and the status: ok, singular (the design cannot estimate
+the effects), errors (the calculation reported another error), timeout or 
+failed. A singular design is made again up to ATTEMPTS times, so that the det,
+inverse and correlation stages are timed, unless it is too small to estimate
+the effects. The attempts of each design and the number of estimable and 
+singular designs are in the report.
+The p are run from the smallest and once a design times out the larger p with
+the same other parameters are skipped, as they would time out too.
+
+Versions:
+2026.10.18: First version.
+2026.10.18: The reports are written to the reports directory by default.
+2026.10.18: A singular design is made again up to ATTEMPTS times and the report
+            has the number of estimable and singular designs.
+'''
+
+import os, sys, json, shutil, time, signal
+import subprocess
+from tempfile import mkdtemp
+from datetime import datetime
+
+import benchmark
+import generate_design
+
+# The defaults for each option that takes a list of values.
+SWEEP = [('operation', ['check']),
+         ('effects',   ['main']),
+         ('k',         [3, 4, 5]),
+         ('levels',    [2, 3]),
+         ('m',         [2, 3]),
+         ('p',         [10, 100, 1000])]
+
+TIMEOUT = 300  # the default seconds a run can take before it is killed
+ATTEMPTS = 5   # the most designs made for a case until one is not singular
+
+# The message of process_choices.py for a design that can't estimate the effects.
+SINGULAR = 'The determinant of the C matrix is zero'
+
+# The stages in the order of the csv columns.
+STAGES = ['parse', 'duplicates', 'B matrix', 'Lambda matrix', 'C matrix', 'rank',
+          'det', 'inverse', 'correlation', 'flags', 'formatting', 'total']
+
+
+def usage():
+    print __doc__[__doc__.index('Usage:'):__doc__.index('For each design')]
+
+
+def run_design(workdir, operation, effects, options, timeout):
+    '''
+    Runs process_choices.py on the input files in workdir. Returns a tuple
+    (status, wall, stages, message) where stages are from out_timings.dat.
+    '''
+    start = time.time()
+    proc = subprocess.Popen([sys.executable, './process_choices.py', workdir, operation, effects] + options,
+                            stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    # Poll rather than wait so the run can be killed at the timeout.
+    while proc.poll() is None and time.time() - start < timeout:
+        time.sleep(0.05)
+    wall = time.time() - start
+    if proc.poll() is None:
+        os.kill(proc.pid, signal.SIGKILL)
+        proc.wait()
+        return ('timeout', wall, [], 'killed after %d seconds' % timeout)
+
+    output = proc.stdout.read()
+    if proc.returncode != 0:
+        return ('failed', wall, [], ''.join(output.strip().splitlines()[-1:]))
+
+    timings = os.path.join(workdir, 'out_timings.dat')
+    if os.path.exists(timings):
+        stages = benchmark.read_timings(timings)
+    else:
+        stages = []
+    # An error in the calculation is written to out_msg.dat and ends it.
+    msg = os.path.join(workdir, 'out_msg.dat')
+    if os.path.exists(msg):
+        text = open(msg).read()
+        lines = text.strip().splitlines()
+        if lines and lines[-1].startswith('Cannot continue calculation'):
+            # The error is the line before it.
+            if SINGULAR in text:
+                return ('singular', wall, stages, ''.join(lines[-2:-1]))
+            return ('errors', wall, stages, ''.join(lines[-2:-1]))
+    return ('ok', wall, stages, '')
+
+
+def run_case(case, twofis, gens, seed, options, timeout):
+    '''
+    Generates the design for case, a dict of the sweep values, and runs it.
+    A singular design is generated again, up to ATTEMPTS times, unless it has 
+    too few choice sets or tmts to estimate the effects whatever they are.
+    '''
+    for attempt in range(ATTEMPTS):
+        (texts, size) = generate_design.generate_design(case['operation'], case['effects'], case['k'],
+                                                        case['levels'], case['m'], case['p'],
+                                                        twofis=twofis, gens=gens, seed=seed, attempt=attempt)
+        tempdir = mkdtemp(prefix='choice.scaling.')
+        try:
+            generate_design.write_design(tempdir, texts)
+            (status, wall, stages, message) = run_design(tempdir, case['operation'], case['effects'], options, timeout)
+        finally:
+            shutil.rmtree(tempdir)
+        # C has rank at most p(m-1) and t-1 so then no design is estimable.
+        too_small = size['numEffects'] > min(size['p'] * (size['m'] - 1), size['t'] - 1)
+        if status != 'singular' or too_small:
+            break
+
+    result = dict(case)
+    result.update({'levels': ' '.join([str(level) for level in size['levels']]),
+                   't': size['t'], 'numEffects': size['numEffects'],
+                   'status': status, 'attempts': attempt + 1, 'wall': wall, 'message': message,
+                   'stages': [{'stage': stage, 'wall': stage_wall, 'cpu': cpu, 'peak_rss_mb': rss}
+                              for (stage, stage_wall, cpu, rss) in stages]})
+    rss = [stage[3] for stage in stages if stage[3] is not None]
+    result['peak_rss_mb'] = max(rss) if rss else None
+    return result
+
+
+def cases(sweep):
+    '''
+    Returns the list of dicts of every combination of the sweep values, with
+    the p of each combination of the other values together from the smallest.
+    '''
+    combinations = [{}]
+    for (name, values) in sweep:
+        if name == 'p':
+            values = sorted(values)
+        combinations = [dict(case, **{name: value}) for case in combinations for value in values]
+    return combinations
+
+
+def write_csv(report, filename):
+    ''' Writes a row for each design with the wall time of each stage as a column. '''
+    fh = open(filename, 'w')
+    columns = ['operation', 'effects', 'k', 'levels', 'm', 'p', 't', 'numEffects', 'status', 'attempts', 'wall']
+    fh.write(','.join(columns + ['%s_s' % stage.replace(' ', '_') for stage in STAGES] + ['peak_rss_mb']) + '\n')
+    for result in report['results']:
+        stages = dict([(item['stage'], item['wall']) for item in result['stages']])
+        values = [str(result[column]) for column in columns[:-1]] + ['%.4f' % result['wall']]
+        for stage in STAGES:
+            if stage in stages:
+                values.append('%.4f' % stages[stage])
+            else:
+                values.append('')
+        if result['peak_rss_mb'] is None:
+            values.append('')
+        else:
+            values.append('%.1f' % result['peak_rss_mb'])
+        fh.write(','.join(values) + '\n')
+    fh.close()
+
+
+def main():
+
+    args = sys.argv[1:]
+    sweep = list(SWEEP)
+    names = [name for (name, values) in SWEEP]
+    twofis = 0.5
+    gens = 1
+    seed = 1
+    timeout = TIMEOUT
+    options = []
+    name = None
+    while args:
+        arg = args.pop(0)
+        try:
+            if arg.startswith('--') and arg[2:] in names:
+                values = args.pop(0).split(',')
+                if arg[2:] in ('k', 'm', 'p'):
+                    values = [int(value) for value in values]
+                elif arg == '--levels':
+                    values = [value if value == 'mixed' else int(value) for value in values]
+                sweep[names.index(arg[2:])] = (arg[2:], values)
+            elif arg == '--twofis':
+                twofis = float(args.pop(0))
+            elif arg == '--gens':
+                gens = int(args.pop(0))
+            elif arg == '--seed':
+                seed = int(args.pop(0))
+            elif arg == '--timeout':
+                timeout = float(args.pop(0))
+            elif arg == '--numeric':
+                options.extend([arg, args.pop(0)])
+            elif arg == '--no-lmat':
+                options.append(arg)
+            elif arg == '-o':
+                name = os.path.abspath(args.pop(0))
+            else:
+                usage()
+                print 'Error, unknown option %s' % arg
+                sys.exit(1)
+        except (IndexError, ValueError) as e:
+            usage()
+            print 'Error, with option %s: %s' % (arg, e)
+            sys.exit(1)
+
+    # process_choices.py is run from the directory of this script.
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+
+    commit = benchmark.git_commit()
+    now = datetime.now()
+    if name is None:
+        if not os.path.isdir(benchmark.REPORTS):
+            os.makedirs(benchmark.REPORTS)
+        name = os.path.join(benchmark.REPORTS, 'scaling_%s_%s' % (now.strftime('%Y.%m.%d'), (commit or 'unknown').replace('+', 'plus')))
+
+    report = {'commit': commit, 'date': now.strftime('%Y-%m-%d %H:%M:%S'),
+              'options': options, 'versions': benchmark.versions(),
+              'twofis': twofis, 'gens': gens, 'seed': seed, 'timeout': timeout,
+              'results': []}
+
+    print '%-9s %-9s %3s %-8s %2s %6s %6s %6s %9s %8s  %s' % ('operation', 'effects', 'k', 'levels',
+        'm', 'p', 't', 'effects', 'wall (s)', 'rss (MB)', 'status')
+    timed_out = []
+    for case in cases(sweep):
+        others = dict([(key, case[key]) for key in case.keys() if key != 'p'])
+        if others in timed_out:
+            print '%-9s %-9s %3d %-8s %2d %6d %6s %6s %9s %8s  skipped' % (case['operation'], case['effects'],
+                case['k'], case['levels'], case['m'], case['p'], '', '', '', '')
+            continue
+        try:
+            result = run_case(case, twofis, gens, seed, options, timeout)
+        except ValueError as e:
+            # e.g. m is more than the number of treatment combinations
+            print '%-9s %-9s %3d %-8s %2d %6d  not possible: %s' % (case['operation'], case['effects'],
+                case['k'], case['levels'], case['m'], case['p'], e)
+            continue
+        report['results'].append(result)
+        if result['status'] == 'timeout':
+            timed_out.append(others)
+        if result['peak_rss_mb'] is None:
+            rss = ''
+        else:
+            rss = '%.1f' % result['peak_rss_mb']
+        print '%-9s %-9s %3d %-8s %2d %6d %6d %6d %9.3f %8s  %s' % (result['operation'], result['effects'],
+            result['k'], result['levels'][:8], result['m'], result['p'], result['t'], result['numEffects'],
+            result['wall'], rss, result['status'])
+
+    statuses = [result['status'] for result in report['results']]
+    report['estimable'] = statuses.count('ok')
+    report['singular'] = statuses.count('singular')
+
+    fh = open(name + '.json', 'w')
+    json.dump(report, fh, indent=1, sort_keys=True)
+    fh.close()
+    write_csv(report, name + '.csv')
+    print ''
+    print 'Estimable designs: %d, singular designs: %d' % (report['estimable'], report['singular'])
+    print 'Report written to %s.json and %s.csv' % (name, name)
+
+
+if __name__ == '__main__':
+    main()
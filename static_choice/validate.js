@@ -461,10 +461,10 @@ function verify() {
 	// radiobuttons groups.
 	var expect = ["factors", "levels", "msize"];
 
-	corc = radioValue(form.corc);     // check or construct
+	corc = radioValue(form.corc);     // check, construct or optimise
 	effect = radioValue(form.effect); // main, mplus2 or mplussome
 
-	if (corc == "check")
+	if (corc == "check" || corc == "optimise")
 		{ expect = expect.concat("chsets") }
 	else
 		{ expect = expect.concat("tmts", "gens") }
@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+
+'''
+Checks that parse_int_matrix() and evaluate_design() read text input the
+same whether it is str or unicode, e.g. inputs loaded from json.
+Run from the top directory: ./test/test_parse.py
+or with pytest. There is no output if all OK.
+'''
+
+import os, sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+from process_choices import parse_int_matrix, evaluate_design
+
+TEST_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def read_text(test, name):
+    ''' Returns the contents of in_name.dat of a test. '''
+    with open(os.path.join(TEST_DIR, test, 'in_%s.dat' % name)) as fh:
+        return fh.read()
+
+
+def test_parse_unicode():
+    text = '0 1 -2\n\n3 +4 5\n'
+    expected = np.array([[0, 1, -2], [3, 4, 5]], dtype=np.int32)
+    assert np.all(parse_int_matrix(text) == expected)
+    assert np.all(parse_int_matrix(unicode(text)) == expected)
+    assert parse_int_matrix(u' \n', 3).shape == (0, 3)
+    for bad in [u'0 1\n2 x\n', u'0 1\n2 \u0663\n', u'0 1\n2\n']:
+        try:
+            parse_int_matrix(bad)
+        except ValueError:
+            pass
+        else:
+            assert False, bad
+
+
+def test_evaluate_unicode():
+    levels = [int(item) for item in read_text('check_main_1', 'levels').split()]
+    msize = int(read_text('check_main_1', 'msize'))
+    chsets = read_text('check_main_1', 'chsets')
+    outputs = evaluate_design(levels, msize, chsets=chsets, effects='main')
+    unicode_outputs = evaluate_design(levels, msize, chsets=unicode(chsets), effects='main')
+    assert 'cmat' in outputs.arrays
+    assert unicode_outputs['msg'] == outputs['msg']
+    assert unicode_outputs['cmat'] == outputs['cmat']
+
+
+if __name__ == '__main__':
+    test_parse_unicode()
+    test_evaluate_unicode()
@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+
+'''
+Checks that search_generators() scores each set of generators the same as
+the design that construct makes from them. 
+Run from the top directory: ./test/test_search.py 
+or with pytest. There is no output if all OK.
+'''
+
+import os, sys, itertools
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+from process_choices import search_generators, evaluate_design
+
+
+def construct_det(tmts, levels, msize, gens):
+    ''' Returns det(C) of the design construct makes from tmts and gens, or 0. '''
+    outputs = evaluate_design(levels, msize, tmts=tmts, gens=gens, effects='main')
+    if 'cmat' not in outputs.arrays:
+        return 0.0
+    return float(outputs.arrays['cmat'].det())
+
+
+def check_scores(tmts, levels, msize):
+    ''' Checks every candidate of the search against construct. '''
+    (results, searched) = search_generators(tmts, levels, msize, top=None, processes=1)
+    assert len(results) == searched
+    for result in results:
+        det = construct_det(tmts, levels, msize, result['gens'])
+        if result['logdet'] == -np.inf:
+            assert det == 0, (result['gens'], det)
+        else:
+            assert abs(result['det'] - det) <= 1e-9 * det, (result['gens'], result['det'], det)
+
+
+def test_binary_part_factorial():
+    # Choice sets that differ only in the order of their options are duplicates.
+    tmts = [list(tmt) for tmt in itertools.product(range(2), repeat=3)][:6]
+    check_scores(tmts, [2, 2, 2], 2)
+    (results, searched) = search_generators(tmts, [2, 2, 2], 2, top=1, processes=1)
+    assert results[0]['gens'] == [[1, 1, 1]]
+    assert round(results[0]['efficiency'], 6) == 100.0
+
+
+def test_three_level_factorial():
+    tmts = [list(tmt) for tmt in itertools.product(range(3), repeat=2)]
+    check_scores(tmts, [3, 3], 3)
+
+
+if __name__ == '__main__':
+    test_binary_part_factorial()
+    test_three_level_factorial()
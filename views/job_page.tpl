@@ -0,0 +1,81 @@
+%include head
+%include top.tpl title='Discrete Choice Experiments'
+
+<p>Click here to return to the <a href="/choice">Choice Experiment Page</a>
+</p>
+
+<div id="running">
+<p>Your design is being calculated. The results will be shown on this page
+when they are ready. You can also come back to this page later.
+</p>
+<p>Job: {{ job }} <span id="waited"></span></p>
+<p>Stage: <span id="stage">waiting to start</span></p>
+<p><input type="button" id="cancel" value="Cancel" onclick="cancel_job();" /></p>
+</div>
+
+<div id="failed" style="display:none;">
+<p>Errors are listed below:
+</p>
+<pre id="errors"></pre>
+</div>
+
+<p>Date and time: {{ now }} </p>
+
+<script type="text/javascript">
+// Poll the status of the job every few seconds until it is done.
+var job = "{{ job }}";
+var started = new Date();
+function poll()
+	{
+	var request = new XMLHttpRequest();
+	request.onreadystatechange = function()
+		{
+		if (request.readyState != 4)
+			return;
+		var status = {status: "running"};
+		if (request.status == 200)
+			status = JSON.parse(request.responseText);
+		if (status.status == "done")
+			{
+			window.location = "/choice/result/" + job;
+			}
+		else if (status.status == "queued" || status.status == "running")
+			{
+			var seconds = Math.round((new Date() - started)/1000);
+			document.getElementById("waited").textContent = "(waited " + seconds + " seconds)";
+			if (status.status == "queued")
+				document.getElementById("stage").textContent = "waiting for a free worker";
+			var progress = status.progress;
+			if (progress && progress.stage)
+				{
+				var stage = progress.stage;
+				if (progress.total > 0)
+					stage = stage + " (" + progress.done + " of " + progress.total + ")";
+				document.getElementById("stage").textContent = stage;
+				}
+			setTimeout(poll, 2000);
+			}
+		else
+			{
+			hide("running");
+			document.getElementById("errors").textContent = status.errors || "Error: the job was not found.";
+			show("failed");
+			}
+		}
+	request.open("GET", "/choice/status/" + job, true);
+	request.send();
+	}
+// Ask for the job to be cancelled, the polling then shows when it has ended.
+function cancel_job()
+	{
+	var request = new XMLHttpRequest();
+	request.open("POST", "/choice/cancel/" + job, true);
+	request.send();
+	document.getElementById("cancel").disabled = true;
+	document.getElementById("stage").textContent = "cancelling";
+	}
+setTimeout(poll, 1000);
+</script>
+
+%include tail
+
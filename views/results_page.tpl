@@ -3,6 +3,10 @@
 
 <p><a href="../">Return to Discrete Choice Experiments</a>
 &nbsp; 
+%if permalink:
+<a href="/choice/result/{{ permalink }}">Permalink to these results</a>
+&nbsp; 
+%end
 %if test:
 <span style="color:red;font-weight:bold;">Running in TEST mode! 
 {{ outputs['errors'] }} 
@@ -37,6 +41,12 @@
 %if 'chsets' in inputs:
   <h2>You entered the following choice sets to be checked:</h2>
   <pre class="results">{{ inputs['chsets'] }}</pre>
+%if permalink and 'chsets' not in outputs:
+<form action="/choice/optimise/{{ permalink }}" method="post">
+<p><input type="submit" value="Improve these choice sets" /> 
+by changing their options to increase the determinant of C.</p>
+</form>
+%end
 %end
 
 <div class="container">
@@ -70,8 +80,29 @@ None entered
 <pre class="results">Time taken was {{ time }} seconds. 
 {{ outputs['msg'] }}</pre>
 
+%if outputs.get('timings'):
+<p id="timings_show"><a href="#" onclick="show('timings'); hide('timings_show'); return false;">Show the time taken by each stage</a></p>
+<div id="timings" style="display:none;">
+<h2>Time Taken by Each Stage</h2>
+<p><a href="#" onclick="hide('timings'); show('timings_show'); return false;">Hide</a></p>
+<table>
+%for line in outputs['timings'].splitlines():
+<tr>
+%for item in line.split('\t'):
+<td>{{ item }}</td>
+%end
+</tr>
+%end
+</table>
+</div>
+%end
+
 %if 'chsets' in outputs:
+%if 'chsets' in inputs:
+<h2>Improved Choice Sets</h2>
+%else:
 <h2>Choice Sets Created</h2>
+%end
 <pre class="results">{{ outputs['chsets'] }}</pre>
 %end
 
@@ -59,10 +59,12 @@ Tests: <input type="button" value="Test 1" onclick="test_1();"/> &nbsp;
 <h2>What type of operation do you wish to perform?</h2>
 
 <div id="corc1" class="radiobuttons">
-<!-- inputs: corc[check|construct]--> 
+<!-- inputs: corc[check|construct|optimise]--> 
 <p>
 <input type="radio" id="corc_chk" name="corc" value="check" onclick="show('change'); hide('gen');"/> 
         Check your own choice sets <br>
+<input type="radio" id="corc_opt" name="corc" value="optimise" onclick="show('change'); hide('gen');"/> 
+        Improve your own choice sets <br>
 <input type="radio" id="corc_con" name="corc" value="construct" onclick="show('gen'); hide('change');" checked="checked" /> 
         Construct choice sets 
 </p>